@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ContextLens.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core.assets import StaticAssetsApp  # noqa: E402  (needs settings loaded)
+from core.warmup import LifespanApp  # noqa: E402
+from core.websocket import WebSocketApp  # noqa: E402
+
+application = LifespanApp(StaticAssetsApp(WebSocketApp(django_application)))
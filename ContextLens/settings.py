@@ -10,11 +10,16 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Deployment profile: 'development' (default) or 'production'.
+CONTEXTLENS_ENV = os.environ.get('CONTEXTLENS_ENV', 'development')
+PRODUCTION = CONTEXTLENS_ENV == 'production'
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
@@ -22,7 +27,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-v9o@h=7%42do409*lef_+x1f(rd33y2$vknbawhw-^f+yu7bqt'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get('DJANGO_DEBUG', '0' if PRODUCTION else '1') == '1'
 
 ALLOWED_HOSTS = ['*']
 
@@ -39,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.log.RequestIdMiddleware',
+    'core.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -54,8 +61,7 @@ ROOT_URLCONF = 'ContextLens.urls'
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [BASE_DIR / 'templates']
-        ,
+        'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -75,10 +81,32 @@ WSGI_APPLICATION = 'ContextLens.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('CONTEXTLENS_DB_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+if PRODUCTION:
+    # WAL lets readers proceed while a writer commits; NORMAL sync is safe
+    # under WAL and avoids an fsync per transaction. Writers take the lock
+    # up front (IMMEDIATE) and wait up to `timeout` seconds for it instead of
+    # failing with "database is locked".
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': int(os.environ.get('CONTEXTLENS_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA busy_timeout=20000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA mmap_size=134217728;'
+            ),
+        },
+    })
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -116,6 +144,13 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
 
+# Output of `manage.py build_assets`: fingerprinted + precompressed static
+# files and templates rewritten to reference them. Used when present in the
+# production profile; served by core.assets.StaticAssetsApp in asgi.py.
+ASSETS_BUILD_DIR = BASE_DIR / 'build'
+if PRODUCTION and (ASSETS_BUILD_DIR / 'templates').is_dir():
+    TEMPLATES[0]['DIRS'].insert(0, ASSETS_BUILD_DIR / 'templates')
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:8000",
@@ -124,6 +159,208 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_ALL_ORIGINS = True
 
+# Latency tiers (see core/latency.py). Per-template-type (or per-template-name)
+# overrides of the TTFT SLO, verbosity, output token cap and effort ceiling.
+LATENCY_SLOS = {
+    'translation': {'ttft_ms': 4000},
+    'word_analysis': {'ttft_ms': 1500},
+    'sentence_analysis': {'ttft_ms': 3000},
+}
+# In-flight upstream calls (per worker) above which requests are degraded.
+LATENCY_LOAD_THRESHOLD = 8
+# Faster models to fall back to when a model is far over its SLO.
+LATENCY_FALLBACK_MODELS = {
+    'gpt-5': 'gpt-5-mini',
+}
+# Whether responses API calls ask upstream to store the response.
+RESPONSES_STORE = False
+
+# Upstream priority dispatcher (see core/scheduler.py), per worker process.
+# Word/sentence lookups get the largest share and a reserve of slots that
+# translation and bulk work can never occupy.
+SCHEDULER_MAX_CONCURRENCY = 16
+SCHEDULER_INTERACTIVE_RESERVE = 4
+SCHEDULER_WEIGHTS = {
+    'interactive_analysis': 8,
+    'interactive_translation': 3,
+    'bulk': 1,
+}
+# Seconds a call may wait for a slot before it fails with "busy".
+SCHEDULER_MAX_WAIT_SECONDS = {
+    'interactive_analysis': 15,
+    'interactive_translation': 60,
+    'bulk': 300,
+}
+
+# Per-client admission control on the stream and translate/analyze endpoints
+# (see core/admission.py). Shared by all workers through a small SQLite state
+# file.
+ADMISSION_ENABLED = True
+ADMISSION_STATE_PATH = Path(os.environ.get('CONTEXTLENS_ADMISSION_PATH', BASE_DIR / '.admission.sqlite3'))
+ADMISSION_RATE = 2.0  # sustained requests per second per client
+ADMISSION_BURST = 10
+ADMISSION_MAX_STREAMS = 4
+ADMISSION_MAX_PROMPT_TOKENS = 200000
+# Only enable behind a proxy that sets X-Forwarded-For itself.
+ADMISSION_TRUST_FORWARDED_FOR = False
+
+# Usage ledger (see core/usage.py): one UsageRecord per upstream call, written
+# in batches by a background thread.
+USAGE_LEDGER_ENABLED = True
+USAGE_BATCH_SIZE = 100
+USAGE_FLUSH_INTERVAL = 1.0
+USAGE_MAX_QUEUE = 10000
+
+# Operational endpoints (/api/usage/ and the like) answer in DEBUG, or to
+# requests sending X-Ops-Token matching OPS_TOKEN; otherwise they 404.
+OPS_TOKEN = os.environ.get('CONTEXTLENS_OPS_TOKEN', '')
+
+# Multiplexed stream transport at /ws/stream/ (ASGI only, see core/websocket.py).
+# The page falls back to the SSE endpoints when this is off or unavailable.
+# Handshakes from other sites are refused unless their Origin is listed in
+# CSRF_TRUSTED_ORIGINS or matches an explicit ALLOWED_HOSTS entry.
+WEBSOCKET_ENABLED = os.environ.get('CONTEXTLENS_WEBSOCKET', '1') == '1'
+# Concurrent streams allowed on one socket.
+WEBSOCKET_MAX_STREAMS = 8
+
+# Context-window preflight (see core/tokens.py). Prompts are counted locally
+# (exactly when the optional tiktoken package is installed, approximately
+# otherwise) before any upstream call. Oversized translations are chunked and
+# oversized analyses windowed around the selection; with PREFLIGHT_REROUTE off
+# they are rejected with 413 instead.
+PREFLIGHT_REROUTE = True
+# Output tokens kept free when the route sets no max_output_tokens.
+PREFLIGHT_OUTPUT_RESERVE = 4096
+PREFLIGHT_SAFETY_MARGIN = 0.05
+# Extra or overriding context sizes by model-name prefix, e.g. {'my-model': 32768}.
+MODEL_CONTEXT_WINDOWS = {}
+# Longer inputs use the approximate count even when tiktoken is available.
+TOKEN_EXACT_MAX_CHARS = 400000
+
+# Structured word analysis: dictionary fields (headword, IPA, senses) are
+# stored per model, prompt and word, and only the contextual fields are
+# requested when the word is looked up again.
+LEXICON_CACHE_ENABLED = True
+
+# Viewport-first translation (see core/viewport.py): requests with
+# "order": "viewport" are translated paragraph by paragraph, the paragraphs
+# in view first, by this many concurrent upstream calls per translation.
+TRANSLATION_PARAGRAPH_WORKERS = 3
+
+# Semantic cache for sentence analyses (see core/semantic_cache.py; needs
+# numpy). Selections are embedded and a cached analysis whose sentence is at
+# least SEMANTIC_CACHE_THRESHOLD cosine-similar, made with the same template
+# version, is replayed. Embeddings use the template's API configuration
+# unless SEMANTIC_CACHE_EMBEDDING_BASE_URL is set. SEMANTIC_CACHE_SEARCH is
+# 'exact' or 'approximate' (LSH candidates, rescored exactly); watch
+# /api/semantic-cache/ before lowering the threshold.
+SEMANTIC_CACHE_ENABLED = os.environ.get('CONTEXTLENS_SEMANTIC_CACHE', '0') == '1'
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.environ.get('CONTEXTLENS_EMBEDDING_MODEL', 'text-embedding-3-small')
+SEMANTIC_CACHE_EMBEDDING_BASE_URL = os.environ.get('CONTEXTLENS_EMBEDDING_BASE_URL', '')
+SEMANTIC_CACHE_EMBEDDING_API_KEY = os.environ.get('CONTEXTLENS_EMBEDDING_API_KEY', '')
+SEMANTIC_CACHE_EMBEDDING_TIMEOUT = 3.0
+SEMANTIC_CACHE_MAX_ENTRIES = 20000
+SEMANTIC_CACHE_SEARCH = 'exact'
+
+# Uploaded documents (see core/documents.py): normalized text and paragraph
+# offsets are stored per document in DOCUMENT_STORAGE_DIR.
+DOCUMENT_STORAGE_DIR = Path(os.environ.get('CONTEXTLENS_DOCUMENT_DIR', BASE_DIR / 'documents'))
+DOCUMENT_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+# Longer paragraphs are split at the nearest sentence boundary.
+DOCUMENT_MAX_PARAGRAPH_CHARS = 4000
+# Largest paragraph range one translation/analysis request may reference.
+DOCUMENT_MAX_PARAGRAPHS_PER_REQUEST = 200
+# Tried in order when a file without a BOM or <meta charset> is not UTF-8;
+# a file none of them decode is rejected.
+DOCUMENT_FALLBACK_ENCODINGS = ('gb18030',)
+
+# Compressed SSE (see core/streaming.py): translation streams of at least
+# SSE_COMPRESSION_MIN_BYTES of text are gzip/brotli encoded for clients that
+# accept it. Frames arriving within SSE_COMPRESSION_FLUSH_MS share one
+# compressor flush; pending output is never held longer than that.
+SSE_COMPRESSION = os.environ.get('CONTEXTLENS_SSE_COMPRESSION', '0') == '1'
+SSE_COMPRESSION_MIN_BYTES = 4096
+SSE_COMPRESSION_LEVEL = 5
+SSE_COMPRESSION_FLUSH_MS = 25
+SSE_COMPRESSION_FLUSH_BYTES = 16384
+
+# Hot-path microbenchmarks (manage.py bench, see core/benchmarks.py). A run
+# fails when a stage's ops/sec drops, or its peak allocation grows, by more
+# than the budget compared with the stored baseline. Per-stage overrides by
+# stage name or "stage[size]", e.g. {'preflight[5MB]': 0.5}.
+BENCH_BASELINE_FILE = BASE_DIR / 'bench_baseline.json'
+BENCH_REGRESSION_BUDGET = 0.25
+BENCH_ALLOCATION_BUDGET = 0.25
+# The database-bound stage varies more from run to run.
+BENCH_STAGE_BUDGETS = {'analysis_config': 0.5}
+
+# Worker warm-up on ASGI lifespan startup (see core/warmup.py): config
+# snapshot, URL resolver, imports, and one pooled connection per API
+# configuration in use, probed with GET /models/<model>. The responses-API
+# probe makes a tiny billed request, so it is opt-in.
+WARMUP_ENABLED = os.environ.get('CONTEXTLENS_WARMUP', '1') == '1'
+WARMUP_PROBE_TIMEOUT = 5.0
+WARMUP_PROBE_RESPONSES = False
+
+# On-demand request profiling (see core/profiling.py). Off by default: the
+# middleware is then not installed at all. Requests are profiled when they
+# send X-Profile-Token matching PROFILING_TOKEN, or at PROFILING_SAMPLE_RATE.
+PROFILING_ENABLED = os.environ.get('CONTEXTLENS_PROFILING', '0') == '1'
+PROFILING_TOKEN = os.environ.get('CONTEXTLENS_PROFILING_TOKEN', '')
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_DIR = Path(os.environ.get('CONTEXTLENS_PROFILING_DIR', BASE_DIR / 'profiles'))
+PROFILING_MAX_PROFILES = 100
+
+# Logging (see core/log.py): JSON lines with the request id, written by a
+# background thread. LOG_LEVELS sets per-module levels, e.g.
+# CONTEXTLENS_LOG_LEVELS="core.views=DEBUG,core.openai_service=WARNING";
+# they can also be changed at runtime through /api/logging/ (DEBUG only, or
+# with X-Log-Token matching LOG_ADMIN_TOKEN). Runtime changes are kept in
+# LOG_LEVELS_FILE, which every worker re-reads when it changes; delete the
+# file to go back to LOG_LEVELS on the next restart.
+LOG_LEVELS = dict(
+    item.strip().split('=', 1)
+    for item in os.environ.get('CONTEXTLENS_LOG_LEVELS', '').split(',')
+    if '=' in item
+)
+LOG_ADMIN_TOKEN = os.environ.get('CONTEXTLENS_LOG_TOKEN', '')
+LOG_LEVELS_FILE = BASE_DIR / '.log_levels'
+# Per-chunk debug records: the first chunk of a stream and every Nth one.
+LOG_CHUNK_SAMPLE_EVERY = 50
+# Records queued for the writer thread; beyond this they are dropped.
+LOG_QUEUE_SIZE = 10000
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {
+            '()': 'core.log.RequestIdFilter',
+        },
+    },
+    'formatters': {
+        'json': {
+            '()': 'core.log.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'core.log.QueuedStreamHandler',
+            'filters': ['request_id'],
+            'formatter': 'json',
+            'maxsize': LOG_QUEUE_SIZE,
+        },
+    },
+    'loggers': {
+        'core': {
+            'handlers': ['console'],
+            'level': os.environ.get('CONTEXTLENS_LOG_LEVEL', 'INFO'),
+        },
+        **{name: {'level': level.upper()} for name, level in LOG_LEVELS.items()},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,333 @@
+"""
+Per-client admission control for the endpoints that call the upstream API.
+
+Each client (a session the session store knows, else its address) gets a
+token bucket for its request rate, a cap on concurrently open streams and a
+cap on the prompt tokens of those streams. Requests over a limit are refused immediately
+with 429 and ``Retry-After`` rather than queued. The rate and stream checks
+(``admit``) run before any request work; the prompt-token cap is checked
+once the prompt has been counted (``charge``), against the lease taken by
+``admit``. Session-store answers are reused for a few minutes per process,
+so keying on the session costs a query only on a client's first request.
+
+State lives in a small SQLite file shared by every worker on the host
+(``ADMISSION_STATE_PATH``), and each check-and-update runs in one
+``BEGIN IMMEDIATE`` transaction, so the limits hold across ``serve``
+workers. Open streams are leases, released when the response is closed or
+dropped (``SSEResponse.on_close``), the WebSocket stream ends or the
+synchronous translate/analyze call returns; leases of
+dead worker processes and expired leases are swept. If the state
+file cannot be used the request is admitted (fail open) and logged.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from importlib import import_module
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.http import JsonResponse
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (
+    id TEXT PRIMARY KEY, key TEXT NOT NULL, prompt_tokens INTEGER NOT NULL,
+    pid INTEGER NOT NULL, expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS leases_key ON leases (key);
+CREATE TABLE IF NOT EXISTS rejections (reason TEXT PRIMARY KEY, count INTEGER NOT NULL);
+"""
+REJECTION_MESSAGES = {
+    'rate': 'Too many requests, please slow down.',
+    'streams': 'Too many open streams for this client.',
+    'prompt_tokens': 'Too much text in flight for this client.',
+}
+SWEEP_INTERVAL_SECONDS = 30
+IDLE_BUCKET_SECONDS = 3600
+# How long and for how many sessions a session-store lookup is reused
+SESSION_CACHE_SECONDS = 300
+SESSION_CACHE_SIZE = 10000
+
+
+@dataclass(frozen=True)
+class Limits:
+    rate: float  # sustained requests per second
+    burst: int
+    max_streams: int
+    max_prompt_tokens: int
+    lease_ttl: float
+    stream_retry_after: int
+
+    @classmethod
+    def from_settings(cls) -> 'Limits':
+        return cls(
+            rate=getattr(settings, 'ADMISSION_RATE', 2.0),
+            burst=getattr(settings, 'ADMISSION_BURST', 10),
+            max_streams=getattr(settings, 'ADMISSION_MAX_STREAMS', 4),
+            max_prompt_tokens=getattr(settings, 'ADMISSION_MAX_PROMPT_TOKENS', 200000),
+            lease_ttl=getattr(settings, 'ADMISSION_LEASE_TTL', 900),
+            stream_retry_after=getattr(settings, 'ADMISSION_STREAM_RETRY_AFTER', 2),
+        )
+
+
+@dataclass(frozen=True)
+class Decision:
+    allowed: bool
+    reason: str = ''
+    retry_after: int = 0
+    lease_id: Optional[str] = None
+
+
+class _KnownSessions:
+    """
+    Recent session-store answers, so a client's requests do not each cost a
+    session query. Entries expire after ``ttl`` seconds; the oldest are
+    evicted beyond ``maxsize``.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[bool, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def exists(self, session_key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(session_key)
+                return entry[0]
+        try:
+            exists = import_module(settings.SESSION_ENGINE).SessionStore().exists(session_key)
+        except Exception as e:
+            logger.warning('admission: session store unavailable (%s); keying on the address', e)
+            return False
+        with self._lock:
+            self._entries[session_key] = (exists, now + self.ttl)
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return exists
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+known_sessions = _KnownSessions(SESSION_CACHE_SIZE, SESSION_CACHE_SECONDS)
+
+
+def client_key(cookies, address: Optional[str], forwarded_for: Optional[str] = None) -> str:
+    """
+    Admission key: the client's session if the session store knows it, else
+    its address. An unchecked cookie would let a client get a fresh bucket
+    per request by sending a random session id.
+    """
+    session = cookies.get(settings.SESSION_COOKIE_NAME)
+    if session and known_sessions.exists(session):
+        return 'session:' + hashlib.blake2b(session.encode(), digest_size=8).hexdigest()
+    if forwarded_for and getattr(settings, 'ADMISSION_TRUST_FORWARDED_FOR', False):
+        address = forwarded_for.split(',')[0].strip()
+    return f'addr:{address or "unknown"}'
+
+
+def request_key(request) -> str:
+    return client_key(request.COOKIES, request.META.get('REMOTE_ADDR'),
+                      request.META.get('HTTP_X_FORWARDED_FOR'))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AdmissionController:
+    """Token buckets and stream leases in a host-wide SQLite file"""
+
+    def __init__(self, path, limits: Limits):
+        self.path = str(path)
+        self.limits = limits
+        self._local = threading.local()
+        self._last_sweep = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=0.5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _sweep(self, conn: sqlite3.Connection, now: float):
+        conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+        for (pid,) in conn.execute('SELECT DISTINCT pid FROM leases').fetchall():
+            if not _pid_alive(pid):
+                conn.execute('DELETE FROM leases WHERE pid = ?', (pid,))
+        conn.execute('DELETE FROM buckets WHERE updated < ?', (now - IDLE_BUCKET_SECONDS,))
+
+    def _reject(self, conn, reason: str, retry_after: float) -> Decision:
+        conn.execute('INSERT INTO rejections (reason, count) VALUES (?, 1) '
+                     'ON CONFLICT(reason) DO UPDATE SET count = count + 1', (reason,))
+        return Decision(False, reason, max(1, int(retry_after + 0.999)))
+
+    def admit(self, key: str, prompt_tokens: int = 0) -> Decision:
+        """Take a rate token and a stream lease for ``key``, charged ``prompt_tokens``"""
+        limits = self.limits
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if now - self._last_sweep > SWEEP_INTERVAL_SECONDS:
+                    self._sweep(conn, now)
+                    self._last_sweep = now
+
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = limits.burst if row is None else min(limits.burst, row[0] + (now - row[1]) * limits.rate)
+                if tokens < 1:
+                    decision = self._reject(conn, 'rate', (1 - tokens) / limits.rate)
+                else:
+                    open_streams, open_tokens = conn.execute(
+                        'SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0) FROM leases WHERE key = ? AND expires >= ?',
+                        (key, now),
+                    ).fetchone()
+                    if open_streams >= limits.max_streams:
+                        decision = self._reject(conn, 'streams', limits.stream_retry_after)
+                    elif open_streams and open_tokens + prompt_tokens > limits.max_prompt_tokens:
+                        # A single oversized request is still let through on its own
+                        decision = self._reject(conn, 'prompt_tokens', limits.stream_retry_after)
+                    else:
+                        tokens -= 1
+                        lease_id = uuid.uuid4().hex
+                        conn.execute('INSERT INTO leases (id, key, prompt_tokens, pid, expires) VALUES (?, ?, ?, ?, ?)',
+                                     (lease_id, key, prompt_tokens, os.getpid(), now + limits.lease_ttl))
+                        decision = Decision(True, lease_id=lease_id)
+                conn.execute('INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                             'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                             (key, tokens, now))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logger.warning('admission: state unavailable (%s); admitting %s', e, key)
+            return Decision(True)
+        return decision
+
+    def charge(self, key: str, decision: Decision, prompt_tokens: int) -> Decision:
+        """
+        Set the prompt tokens of the lease ``decision`` holds. If that puts
+        the client over its cap the lease is released and a rejection is
+        returned.
+        """
+        if decision.lease_id is None or not prompt_tokens:
+            return decision
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                others, other_tokens = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0) FROM leases '
+                    'WHERE key = ? AND expires >= ? AND id != ?',
+                    (key, now, decision.lease_id),
+                ).fetchone()
+                if others and other_tokens + prompt_tokens > self.limits.max_prompt_tokens:
+                    # A single oversized request is still let through on its own
+                    conn.execute('DELETE FROM leases WHERE id = ?', (decision.lease_id,))
+                    result = self._reject(conn, 'prompt_tokens', self.limits.stream_retry_after)
+                else:
+                    conn.execute('UPDATE leases SET prompt_tokens = ? WHERE id = ?',
+                                 (prompt_tokens, decision.lease_id))
+                    result = decision
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logger.warning('admission: state unavailable (%s); admitting %s', e, key)
+            return decision
+        return result
+
+    def release(self, lease_id: Optional[str]):
+        if lease_id is None:
+            return
+        try:
+            self._connection().execute('DELETE FROM leases WHERE id = ?', (lease_id,))
+        except sqlite3.Error as e:
+            # The lease expires on its own after lease_ttl
+            logger.warning('admission: could not release lease %s (%s)', lease_id, e)
+
+    def snapshot(self, top: int = 20) -> dict:
+        """Configured limits, busiest clients and rejection counts"""
+        now = time.time()
+        conn = self._connection()
+        clients = [
+            {'key': key, 'open_streams': streams, 'prompt_tokens': tokens}
+            for key, streams, tokens in conn.execute(
+                'SELECT key, COUNT(*), SUM(prompt_tokens) FROM leases WHERE expires >= ? '
+                'GROUP BY key ORDER BY COUNT(*) DESC LIMIT ?', (now, top))
+        ]
+        return {
+            'limits': {
+                'rate_per_second': self.limits.rate,
+                'burst': self.limits.burst,
+                'max_streams': self.limits.max_streams,
+                'max_prompt_tokens': self.limits.max_prompt_tokens,
+            },
+            'open_streams': conn.execute('SELECT COUNT(*) FROM leases WHERE expires >= ?', (now,)).fetchone()[0],
+            'tracked_clients': conn.execute('SELECT COUNT(*) FROM buckets').fetchone()[0],
+            'clients': clients,
+            'rejections': dict(conn.execute('SELECT reason, count FROM rejections').fetchall()),
+        }
+
+
+class _NoAdmission:
+    """Stand-in used when ADMISSION_ENABLED is off"""
+
+    def admit(self, key: str, prompt_tokens: int = 0) -> Decision:
+        return Decision(True)
+
+    def charge(self, key: str, decision: Decision, prompt_tokens: int) -> Decision:
+        return decision
+
+    def release(self, lease_id: Optional[str]):
+        pass
+
+    def snapshot(self, top: int = 20) -> dict:
+        return {'enabled': False}
+
+
+if getattr(settings, 'ADMISSION_ENABLED', True):
+    controller = AdmissionController(
+        getattr(settings, 'ADMISSION_STATE_PATH', settings.BASE_DIR / '.admission.sqlite3'),
+        Limits.from_settings(),
+    )
+else:
+    controller = _NoAdmission()
+
+
+def rejected_response(decision: Decision) -> JsonResponse:
+    """Fast 429 for a refused stream request"""
+    response = JsonResponse({'error': REJECTION_MESSAGES.get(decision.reason, 'Too many requests.'),
+                             'reason': decision.reason}, status=429)
+    response['Retry-After'] = str(decision.retry_after)
+    return response
+
@@ -0,0 +1,209 @@
+"""
+Fingerprinted, precompressed static assets served straight from ASGI.
+
+``manage.py build_assets`` copies every static file to
+``ASSETS_BUILD_DIR/static`` under a content-hashed name, writes ``.gz`` and
+``.br`` variants next to it, records the mapping in ``manifest.json`` and
+writes copies of the templates with ``{% static %}`` tags replaced by the
+hashed URLs. ``StaticAssetsApp`` wraps the Django ASGI application and
+answers ``STATIC_URL`` requests itself: hashed files are immutable and sent
+with a one-year cache lifetime in the best encoding the client accepts;
+anything else found by the staticfiles finders is served with revalidation
+so it works without a build (e.g. under ``manage.py serve`` in development).
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are produced without it
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Below this size compression does not pay for the extra header bytes
+MIN_COMPRESS_SIZE = 256
+
+STATIC_TAG_RE = re.compile(r"""\{%\s*static\s+(['"])(?P<path>[^'"]+)\1\s*%\}""")
+
+
+def build_dir() -> Path:
+    return Path(getattr(settings, 'ASSETS_BUILD_DIR', settings.BASE_DIR / 'build'))
+
+
+def static_prefix() -> str:
+    return '/' + settings.STATIC_URL.strip('/') + '/'
+
+
+def hashed_name(path: str, content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    stem, dot, suffix = path.rpartition('.')
+    if not dot or '/' in suffix:
+        return f'{path}.{digest}'
+    return f'{stem}.{digest}.{suffix}'
+
+
+def rewrite_static_tags(source: str, manifest: Dict[str, str]) -> str:
+    """Replace ``{% static 'x' %}`` with the hashed URL of ``x`` where known"""
+    prefix = static_prefix()
+
+    def replace(match):
+        hashed = manifest.get(match.group('path'))
+        return prefix + hashed if hashed else match.group(0)
+
+    return STATIC_TAG_RE.sub(replace, source)
+
+
+def compress_variants(content: bytes) -> Dict[str, bytes]:
+    """gzip/brotli encodings of ``content`` that are actually smaller"""
+    variants = {}
+    if len(content) < MIN_COMPRESS_SIZE:
+        return variants
+    gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+    if len(gzipped) < len(content):
+        variants['gzip'] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(content, quality=11)
+        if len(compressed) < len(content):
+            variants['br'] = compressed
+    return variants
+
+
+@dataclass(frozen=True)
+class Asset:
+    content_type: str
+    etag: str
+    cache_control: str
+    bodies: Dict[str, bytes]  # encoding ('identity', 'gzip', 'br') -> bytes
+
+
+def _content_type(path: str) -> str:
+    content_type, _ = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    """Best of br > gzip > identity that the client accepts"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+
+class AssetStore:
+    """Hashed assets from the build manifest plus on-demand unhashed files"""
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = root or build_dir()
+        self.hashed: Dict[str, Asset] = {}
+        self._unhashed: Dict[str, Asset] = {}
+        self._load_build()
+
+    def _load_build(self):
+        manifest_path = self.root / MANIFEST_NAME
+        if not manifest_path.is_file():
+            return
+        manifest = json.loads(manifest_path.read_text())
+        static_root = self.root / 'static'
+        for hashed in manifest['files'].values():
+            file_path = static_root / hashed
+            bodies = {'identity': file_path.read_bytes()}
+            for encoding, extension in (('gzip', '.gz'), ('br', '.br')):
+                variant = file_path.with_name(file_path.name + extension)
+                if variant.is_file():
+                    bodies[encoding] = variant.read_bytes()
+            self.hashed[hashed] = Asset(
+                content_type=_content_type(hashed),
+                etag='"%s"' % hashlib.sha256(bodies['identity']).hexdigest()[:16],
+                cache_control=IMMUTABLE,
+                bodies=bodies,
+            )
+
+    def get(self, path: str) -> Optional[Asset]:
+        asset = self.hashed.get(path)
+        if asset is not None:
+            return asset
+        if not settings.DEBUG and path in self._unhashed:
+            return self._unhashed[path]
+        if '..' in Path(path).parts:
+            return None
+        found = finders.find(path)
+        if not found:
+            return None
+        content = Path(found).read_bytes()
+        bodies = {'identity': content}
+        bodies.update(compress_variants(content) if not settings.DEBUG else {})
+        asset = Asset(
+            content_type=_content_type(path),
+            etag='"%s"' % hashlib.sha256(content).hexdigest()[:16],
+            cache_control=REVALIDATE,
+            bodies=bodies,
+        )
+        if not settings.DEBUG:
+            self._unhashed[path] = asset
+        return asset
+
+
+class StaticAssetsApp:
+    """ASGI wrapper that serves ``STATIC_URL`` without entering Django"""
+
+    def __init__(self, app, store: Optional[AssetStore] = None):
+        self.app = app
+        self.store = store or AssetStore()
+        self.prefix = static_prefix()
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD')
+                and scope['path'].startswith(self.prefix)):
+            asset = self.store.get(scope['path'][len(self.prefix):])
+            if asset is not None:
+                await self.serve(scope, send, asset)
+                return
+        await self.app(scope, receive, send)
+
+    async def serve(self, scope, send, asset: Asset):
+        request_headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                           for name, value in scope.get('headers', [])}
+        headers = [
+            (b'content-type', asset.content_type.encode()),
+            (b'cache-control', asset.cache_control.encode()),
+            (b'etag', asset.etag.encode()),
+            (b'vary', b'Accept-Encoding'),
+        ]
+        if_none_match = request_headers.get('if-none-match', '')
+        if asset.etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        encoding = choose_encoding(request_headers.get('accept-encoding', ''), asset.bodies)
+        body = asset.bodies[encoding]
+        if encoding != 'identity':
+            headers.append((b'content-encoding', encoding.encode()))
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
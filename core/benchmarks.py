@@ -0,0 +1,250 @@
+"""
+Microbenchmarks for the request hot path.
+
+Each stage is one piece of per-request work, run against synthetic
+documents of several sizes with a stubbed upstream (no network, no API
+key). ``measure`` reports ops/sec (best of five timed rounds) and the peak
+memory one operation allocates (tracemalloc). ``compare`` checks a run
+against stored baselines and lists the stages that got slower or
+allocate more than the allowed budget. Baselines are machine-specific:
+record them with ``manage.py bench --save-baseline`` on the machine (or CI
+runner) that checks them.
+"""
+import json
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .latency import RouteDecision, choose_route
+from .models import AnalysisConfiguration, APIConfiguration, PromptTemplate
+from .openai_service import OpenAIService, get_active_templates
+from .pipeline import iter_events, sse_frame, translation_text
+from .tokens import plan
+
+SIZES = {'1KB': 1024, '64KB': 64 * 1024, '1MB': 1024 * 1024, '5MB': 5 * 1024 * 1024}
+DELTA_CHARS = 20  # characters per streamed upstream delta
+ROUNDS = 5
+# Allocation regressions below this many KB are noise
+ALLOCATION_FLOOR_KB = 16
+
+WORDS = ('the reader followed a long argument about language and meaning while context shaped every '
+         'sentence she translated slowly from one edition into another with careful notes').split()
+
+
+def synthetic_document(size: int, seed: int = 7) -> str:
+    """Deterministic English-like prose of ``size`` characters, in paragraphs"""
+    rng = random.Random(seed)
+    parts: List[str] = []
+    length = 0
+    sentence_count = 0
+    while length < size:
+        words = rng.choices(WORDS, k=rng.randint(6, 24))
+        sentence = ' '.join(words).capitalize() + '.'
+        sentence_count += 1
+        separator = '\n\n' if sentence_count % 6 == 0 else ' '
+        parts.append(sentence + separator)
+        length += len(sentence) + len(separator)
+    return ''.join(parts)[:size]
+
+
+def _template(template_type: str, model: str, prompt: str) -> PromptTemplate:
+    # Unsaved objects: the stages must not depend on what the database holds
+    config = APIConfiguration(name='bench', api_key='sk-bench', base_url='http://bench.invalid/v1', model_name=model)
+    return PromptTemplate(name=f'bench {template_type}', template_type=template_type, prompt_text=prompt,
+                          api_config=config, reasoning_effort='low')
+
+
+TRANSLATION_PROMPT = 'Translate the following text into Chinese, keeping paragraphs:\n\n{all_input}'
+ANALYSIS_PROMPT = 'Text:\n{all_input}\n\nExplain "{input_select}" in this context.'
+
+
+def _deltas(text: str) -> List[str]:
+    return [text[i:i + DELTA_CHARS] for i in range(0, len(text), DELTA_CHARS)]
+
+
+class _StubStream:
+    """Stands in for the openai client: replays canned streaming events"""
+
+    def __init__(self, chat_chunks, responses_events):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: iter(chat_chunks)))
+        self.responses = SimpleNamespace(create=lambda **kwargs: iter(responses_events))
+
+
+def _stub_client(text: str) -> _StubStream:
+    deltas = _deltas(text)
+    chat_chunks = [
+        SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+        for delta in deltas
+    ]
+    chat_chunks.append(SimpleNamespace(choices=[], usage=SimpleNamespace(
+        prompt_tokens=100, completion_tokens=len(deltas), prompt_tokens_details=None,
+        completion_tokens_details=None)))
+    reasoning = [SimpleNamespace(type='response.reasoning_summary_text.delta', delta=delta)
+                 for delta in _deltas('Considering the passage and its register. ' * 4)]
+    responses_events = reasoning + [SimpleNamespace(type='response.reasoning_summary_text.done')]
+    responses_events += [SimpleNamespace(type='response.output_text.delta', delta=delta, output_index=1)
+                         for delta in deltas]
+    responses_events.append(SimpleNamespace(type='response.completed', response=SimpleNamespace(usage=SimpleNamespace(
+        input_tokens=100, output_tokens=len(deltas), input_tokens_details=None, output_tokens_details=None))))
+    return _StubStream(chat_chunks, responses_events)
+
+
+def _service(template: PromptTemplate, text: str) -> OpenAIService:
+    service = OpenAIService(template.api_config)
+    service.__dict__['client'] = _stub_client(text)  # bypasses the cached_property
+    return service
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    description: str
+    # size in characters (None for unsized stages) -> the operation to time
+    setup: Callable[[Optional[int]], Callable[[], object]]
+    sized: bool = True
+
+
+def _parse_body(size):
+    body = json.dumps({'text': synthetic_document(size)}).encode()
+    return lambda: translation_text(json.loads(body))
+
+
+def _active_templates(size):
+    return get_active_templates
+
+
+def _analysis_config(size):
+    return AnalysisConfiguration.get_current
+
+
+def _prepare_prompt(size):
+    template = _template('word_analysis', 'gpt-4o', ANALYSIS_PROMPT)
+    service = OpenAIService(template.api_config)
+    document = synthetic_document(size)
+    return lambda: service._prepare_prompt(template, all_input=document, input_select='context')
+
+
+def _preflight(size):
+    template = _template('translation', 'gpt-4o', TRANSLATION_PROMPT)
+    document = synthetic_document(size)
+
+    def op():
+        route = choose_route(template, prompt_tokens=len(document) // 4)
+        return plan(template, route, document)
+    return op
+
+
+def _sse_frame(size):
+    event = {'content': 'x' * DELTA_CHARS, 'type': 'content'}
+    return lambda: sse_frame(event)
+
+
+def _sse_stream(size):
+    chunks = _deltas(synthetic_document(size))
+    return lambda: sum(len(sse_frame(event)) for event in iter_events(chunks))
+
+
+def _stream_dispatch(model: str):
+    def setup(size):
+        template = _template('translation', model, TRANSLATION_PROMPT)
+        document = synthetic_document(size)
+        service = _service(template, document)
+        route = RouteDecision.from_template(template)
+        return lambda: sum(1 for _ in service._stream_routed(document, route, 'Bench', {}))
+    return setup
+
+
+STAGES = (
+    Stage('parse_body', 'json.loads of the request body and text extraction', _parse_body),
+    Stage('active_templates', 'get_active_templates (cached config snapshot)', _active_templates, sized=False),
+    Stage('analysis_config', 'AnalysisConfiguration.get_current (one query)', _analysis_config, sized=False),
+    Stage('prepare_prompt', 'placeholder substitution into the template', _prepare_prompt),
+    Stage('preflight', 'route choice and context-window plan (cached index)', _preflight),
+    Stage('sse_frame', 'encode one content event', _sse_frame, sized=False),
+    Stage('sse_stream', 'iter_events + sse_frame over every upstream delta', _sse_stream),
+    Stage('chat_dispatch', 'chat-completions chunk handling (stubbed upstream)', _stream_dispatch('gpt-4o')),
+    Stage('reasoning_dispatch', 'responses-API event dispatch (stubbed upstream)', _stream_dispatch('gpt-5')),
+)
+
+
+def cases(stage_names: Optional[Iterable[str]], size_labels: Iterable[str]) -> List[Tuple[str, Stage, Optional[int]]]:
+    """(key, stage, size) for every selected stage and size"""
+    selected = [stage for stage in STAGES if not stage_names or stage.name in stage_names]
+    result = []
+    for stage in selected:
+        if not stage.sized:
+            result.append((stage.name, stage, None))
+            continue
+        for label in size_labels:
+            result.append((f'{stage.name}[{label}]', stage, SIZES[label]))
+    return result
+
+
+def measure(op: Callable[[], object], min_time: float) -> Dict[str, float]:
+    """Best-of-rounds ops/sec and the peak KB allocated by one call"""
+    op()  # warm caches (segmentation index, snapshot, imports)
+    round_time = min_time / ROUNDS
+    best = 0.0
+    for _ in range(ROUNDS):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            op()
+            calls += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= round_time:
+                break
+        best = max(best, calls / elapsed)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return {'ops_per_sec': round(best, 2), 'peak_kb': round(max(0, peak - before) / 1024, 1)}
+
+
+def budgets(key: str) -> Tuple[float, float]:
+    """(allowed ops/sec drop, allowed allocation growth) as fractions, for one stage"""
+    default = getattr(settings, 'BENCH_REGRESSION_BUDGET', 0.25)
+    allocation = getattr(settings, 'BENCH_ALLOCATION_BUDGET', 0.25)
+    overrides = getattr(settings, 'BENCH_STAGE_BUDGETS', {})
+    stage = key.split('[', 1)[0]
+    override = overrides.get(key, overrides.get(stage))
+    if override is not None:
+        return override, override
+    return default, allocation
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            speed_budget: Optional[float] = None) -> List[str]:
+    """Regressions of ``results`` against ``baseline``, as readable lines"""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        allowed_drop, allowed_growth = budgets(key)
+        if speed_budget is not None:
+            allowed_drop = speed_budget
+        drop = 1 - result['ops_per_sec'] / base['ops_per_sec']
+        if drop > allowed_drop:
+            regressions.append(f'{key}: {result["ops_per_sec"]:.1f} ops/s vs baseline {base["ops_per_sec"]:.1f} '
+                               f'({-drop:+.0%}, budget {-allowed_drop:+.0%})')
+        if result['peak_kb'] > ALLOCATION_FLOOR_KB and base['peak_kb']:
+            growth = result['peak_kb'] / base['peak_kb'] - 1
+            if growth > allowed_growth:
+                regressions.append(f'{key}: {result["peak_kb"]:.1f} KB peak vs baseline {base["peak_kb"]:.1f} KB '
+                                   f'({growth:+.0%}, budget {allowed_growth:+.0%})')
+    return regressions
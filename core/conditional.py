@@ -0,0 +1,64 @@
+"""
+Conditional GET for responses that only change with the configuration.
+
+The configuration version stamp (see ``core.config_snapshot``) changes
+whenever an API configuration, prompt template or analysis setting is
+saved or deleted, so it is a validator for every response built from
+those models. ``config_conditional`` derives the ETag from the stamp and
+the request's path and query string, uses the stamp's mtime as
+Last-Modified, and lets Django answer matching requests with 304 before
+the view runs. Responses are marked ``private, no-cache`` so browsers
+always revalidate instead of showing stale settings.
+"""
+import hashlib
+import os
+from functools import wraps
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .config_snapshot import get_snapshot, version_modified
+
+_template_stamps = {}
+
+
+def template_stamp(*names: str) -> str:
+    """Changes when any of the given templates is edited or rebuilt"""
+    key = names
+    if key in _template_stamps and not settings.DEBUG:
+        return _template_stamps[key]
+    mtimes = []
+    for name in names:
+        origin = get_template(name).origin.name
+        mtimes.append(str(os.stat(origin).st_mtime_ns))
+    stamp = hashlib.blake2b(':'.join(mtimes).encode(), digest_size=4).hexdigest()
+    _template_stamps[key] = stamp
+    return stamp
+
+
+def config_conditional(view=None, *, templates=()):
+    """Decorate a GET view whose output depends only on the configuration (and ``templates``)"""
+
+    def etag(request, *args, **kwargs):
+        representation = f"{request.path}?{request.META.get('QUERY_STRING', '')}"
+        if templates:
+            representation += template_stamp(*templates)
+        digest = hashlib.blake2b(representation.encode(), digest_size=6).hexdigest()
+        return f'{get_snapshot().version}-{digest}'
+
+    def last_modified(request, *args, **kwargs):
+        # Template edits don't move the stamp mtime; the ETag covers them
+        return None if templates else version_modified()
+
+    def decorator(func):
+        @condition(etag_func=etag, last_modified_func=last_modified)
+        @wraps(func)
+        def wrapped(request, *args, **kwargs):
+            response = func(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapped
+
+    return decorator(view) if view is not None else decorator
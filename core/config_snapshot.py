@@ -0,0 +1,185 @@
+"""
+In-process snapshot of the configuration the request hot path needs.
+
+The active prompt templates (with their API configurations joined in) and
+the analysis thresholds are loaded in two queries and kept in an immutable
+snapshot until something changes. Changes are announced through a version
+stamp file: saving or deleting a configuration model rewrites the stamp
+(see ``core.signals``), and every process compares the stamp's ``stat``
+against the one its snapshot was built from before reusing it. That costs a
+single ``os.stat`` per request and keeps all workers consistent without a
+shared cache server.
+"""
+import copy
+import logging
+import os
+import threading
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Mapping, Optional, Tuple
+
+from django.conf import settings
+
+from .models import AnalysisConfiguration, PromptTemplate
+from .prompts import compiled, validate_prompt
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_TYPES = tuple(choice[0] for choice in PromptTemplate.TEMPLATE_TYPES)
+
+
+class TemplateCopies(Mapping):
+    """
+    Read-only mapping of template type to template that hands out a copy on
+    every lookup, so a caller changing a template (or its API configuration)
+    cannot alter the snapshot shared by other requests.
+    """
+
+    __slots__ = ('_templates',)
+
+    def __init__(self, templates: Mapping[str, PromptTemplate]):
+        self._templates = dict(templates)
+
+    def __getitem__(self, template_type: str) -> PromptTemplate:
+        template = self._templates[template_type]
+        clone = copy.copy(template)
+        # copy.copy copies the model state but shares the joined api_config
+        if PromptTemplate.api_config.is_cached(template):
+            clone.api_config = copy.copy(template.api_config)
+        return clone
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._templates)
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Active templates and analysis thresholds as of ``version``"""
+    version: str
+    templates: Mapping[str, PromptTemplate] = field(default_factory=lambda: TemplateCopies({}))
+    word_group_threshold: int = AnalysisConfiguration._meta.get_field('word_group_threshold').default
+    sentence_threshold: int = AnalysisConfiguration._meta.get_field('sentence_threshold').default
+    analysis_config_id: Optional[int] = None
+    complete: bool = True
+
+
+def _stamp_path() -> Path:
+    return Path(getattr(settings, 'CONFIG_VERSION_FILE', settings.BASE_DIR / '.config_version'))
+
+
+def _stamp_key(path: Path) -> Tuple[int, int, int]:
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return 0, 0, 0
+    return info.st_ino, info.st_mtime_ns, info.st_size
+
+
+def read_version() -> str:
+    """Current configuration version stamp (``'0'`` before the first change)"""
+    try:
+        return _stamp_path().read_text().strip() or '0'
+    except FileNotFoundError:
+        return '0'
+
+
+def version_modified() -> Optional[datetime]:
+    """When the configuration version last changed (``None`` before the first change)"""
+    try:
+        mtime = os.stat(_stamp_path()).st_mtime
+    except FileNotFoundError:
+        return None
+    return datetime.fromtimestamp(int(mtime), tz=timezone.utc)
+
+
+def bump_version() -> str:
+    """Publish a new configuration version to every process"""
+    path = _stamp_path()
+    version = uuid.uuid4().hex[:16]
+    temporary = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temporary.write_text(version)
+    os.replace(temporary, path)
+    invalidate()
+    return version
+
+
+def load_snapshot(version: str) -> ConfigSnapshot:
+    """Build a snapshot from the database (two queries)"""
+    templates = {}
+    active = PromptTemplate.objects.filter(
+        is_active=True,
+        template_type__in=TEMPLATE_TYPES,
+    ).select_related('api_config').order_by('id')
+    for template in active:
+        templates.setdefault(template.template_type, template)
+    for template in templates.values():
+        # Parse now so requests only render; saved templates were validated
+        # by the API, older ones may not have been
+        compiled(template)
+        for problem in validate_prompt(template.template_type, template.prompt_text):
+            logger.warning('template %r: %s', template.name, problem)
+
+    analysis_config = AnalysisConfiguration.objects.order_by('id').first()
+    if analysis_config is None:
+        return ConfigSnapshot(version=version, templates=TemplateCopies(templates))
+    return ConfigSnapshot(
+        version=version,
+        templates=TemplateCopies(templates),
+        word_group_threshold=analysis_config.word_group_threshold,
+        sentence_threshold=analysis_config.sentence_threshold,
+        analysis_config_id=analysis_config.id,
+    )
+
+
+class _SnapshotHolder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._stamp: Optional[Tuple[int, int, int]] = None
+
+    def get(self) -> ConfigSnapshot:
+        stamp = _stamp_key(_stamp_path())
+        snapshot = self._snapshot
+        if snapshot is not None and stamp == self._stamp:
+            return snapshot
+        with self._lock:
+            if self._snapshot is not None and stamp == self._stamp:
+                return self._snapshot
+            version = read_version()
+            try:
+                snapshot = load_snapshot(version)
+            except Exception:
+                # Database not ready (e.g. before migrate); don't cache.
+                return ConfigSnapshot(version=version, complete=False)
+            self._snapshot, self._stamp = snapshot, stamp
+            return snapshot
+
+    def peek(self) -> Optional[ConfigSnapshot]:
+        return self._snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = self._stamp = None
+
+
+_holder = _SnapshotHolder()
+
+
+def get_snapshot() -> ConfigSnapshot:
+    """Return the current configuration snapshot, rebuilding it if stale"""
+    return _holder.get()
+
+
+def peek_snapshot() -> Optional[ConfigSnapshot]:
+    """The cached snapshot, if any, without checking or loading"""
+    return _holder.peek()
+
+
+def invalidate():
+    """Drop this process's snapshot; the next request rebuilds it"""
+    _holder.clear()
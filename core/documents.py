@@ -0,0 +1,499 @@
+"""
+Streaming ingestion of uploaded documents (plain text, Markdown, HTML, EPUB).
+
+An upload is read in fixed-size chunks, decoded incrementally and, for
+HTML/EPUB, fed through ``html.parser`` as it arrives, so memory stays
+bounded no matter how large the file is. ``ParagraphWriter`` normalizes the
+text into paragraphs and appends them to ``<handle>.txt`` (UTF-8, paragraphs
+separated by a blank line) while writing each paragraph's byte offset and
+length to ``<handle>.idx`` as pairs of unsigned 64-bit integers. Reading a
+paragraph range later is two seeks, never a scan of the whole text.
+
+The stream endpoints accept ``{"document": handle, "start": i, "count": n}``
+in place of the raw text; ``document_text`` resolves that to the text of
+the paragraph range.
+
+The encoding comes from a BOM, else (HTML/XHTML) a ``<meta charset>`` or
+XML declaration in the first KB, else it is UTF-8 or the first of
+``DOCUMENT_FALLBACK_ENCODINGS`` that decodes the first chunk. Declared
+encodings replace undecodable bytes; a guessed one must decode the whole
+file or the upload is refused with 400.
+
+Uploads over ``DOCUMENT_MAX_UPLOAD_BYTES`` are refused with 413, by their
+Content-Length before the body is read where possible; so is an EPUB whose
+members would unpack to more than that.
+"""
+import codecs
+import os
+import posixpath
+import re
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+from array import array
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import BinaryIO, Iterator, List
+from urllib.parse import unquote
+
+from django.conf import settings
+
+from .models import Document
+
+READ_CHUNK_BYTES = 64 * 1024
+CHARSET_PRESCAN_BYTES = 1024  # as far as browsers look for <meta charset>
+INDEX_FLUSH_ENTRIES = 8192
+# Multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+FORMAT_EXTENSIONS = {
+    '.txt': 'text',
+    '.text': 'text',
+    '.md': 'markdown',
+    '.markdown': 'markdown',
+    '.html': 'html',
+    '.htm': 'html',
+    '.xhtml': 'html',
+    '.epub': 'epub',
+}
+CONTENT_TYPE_FORMATS = {
+    'text/plain': 'text',
+    'text/markdown': 'markdown',
+    'text/html': 'html',
+    'application/xhtml+xml': 'html',
+    'application/epub+zip': 'epub',
+}
+# Preferred places to cut a paragraph that is longer than the limit
+CUT_POINTS = ('\n', '. ', '。', '! ', '? ', '; ', ' ')
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+# <meta charset="x">, <meta http-equiv=... content="...; charset=x"> and <?xml ... encoding="x"?>
+_DECLARED_CHARSET_RE = re.compile(
+    rb'<meta[^>]*?charset\s*=\s*["\']?\s*([A-Za-z0-9._:-]+)|<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._:-]+)',
+    re.IGNORECASE,
+)
+
+
+class IngestError(Exception):
+    """An upload that cannot be turned into a document"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def storage_dir() -> Path:
+    return Path(getattr(settings, 'DOCUMENT_STORAGE_DIR', settings.BASE_DIR / 'documents'))
+
+
+def _paths(handle: str):
+    directory = storage_dir()
+    return directory / f'{handle}.txt', directory / f'{handle}.idx'
+
+
+def max_upload_bytes() -> int:
+    return getattr(settings, 'DOCUMENT_MAX_UPLOAD_BYTES', 100 * 1024 * 1024)
+
+
+def _too_large(max_bytes: int, what: str = '') -> IngestError:
+    return IngestError(f'File too large ({what}limit {max_bytes // (1024 * 1024)} MB)', status=413)
+
+
+def detect_format(name: str, content_type: str = '') -> str:
+    """Document format from the file extension, else the declared content type"""
+    extension = os.path.splitext(name or '')[1].lower()
+    if extension in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[extension]
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in CONTENT_TYPE_FORMATS:
+        return CONTENT_TYPE_FORMATS[content_type]
+    raise IngestError('Unsupported file type. Upload .txt, .md, .html or .epub files.', status=415)
+
+
+class ParagraphWriter:
+    """Normalizes text fed in arbitrary pieces and appends it paragraph by paragraph"""
+
+    def __init__(self, text_file: BinaryIO, index_file: BinaryIO, max_paragraph_chars: int,
+                 keep_indent: bool = False):
+        self.text_file = text_file
+        self.index_file = index_file
+        self.max_paragraph_chars = max_paragraph_chars
+        self.keep_indent = keep_indent
+        self._partial = ''  # text after the last newline
+        self._pieces = []  # the paragraph being collected
+        self._length = 0
+        self._line_ended = False
+        self._offsets = array('Q')
+        self.offset = 0
+        self.paragraphs = 0
+        self.chars = 0
+
+    def feed(self, text: str):
+        text = self._partial + text
+        # A CRLF may be split across pieces: keep a trailing CR for the next one
+        hold = text.endswith('\r')
+        if hold:
+            text = text[:-1]
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        self._partial = lines.pop() + ('\r' if hold else '')
+        for line in lines:
+            self._line(line)
+        if len(self._partial) > self.max_paragraph_chars:
+            # No newline in sight (one-line file): don't let the buffer grow
+            cut = self._partial.rfind(' ') + 1 or len(self._partial)
+            head = self._partial[:cut]
+            self._add(head if self._pieces else head.lstrip(), end_of_line=False)
+            self._partial = self._partial[cut:]
+
+    def _line(self, line: str):
+        line = line.rstrip() if self.keep_indent else line.strip()
+        if not line:
+            self._end_paragraph()
+        else:
+            self._add(line, end_of_line=True)
+
+    def _add(self, text: str, end_of_line: bool):
+        if self._pieces and self._line_ended:
+            self._pieces.append('\n')
+            self._length += 1
+        self._pieces.append(text)
+        self._length += len(text)
+        self._line_ended = end_of_line
+        while self._length > self.max_paragraph_chars:
+            self._split()
+
+    def _split(self):
+        text = ''.join(self._pieces)
+        limit = self.max_paragraph_chars
+        cut = -1
+        for point in CUT_POINTS:
+            position = text.rfind(point, limit // 2, limit)
+            if position != -1:
+                cut = position + len(point)
+                break
+        if cut == -1:
+            cut = limit
+        self._emit(text[:cut].strip())
+        rest = text[cut:].lstrip()
+        self._pieces = [rest] if rest else []
+        self._length = len(rest)
+
+    def _end_paragraph(self):
+        if self._pieces:
+            self._emit(''.join(self._pieces))
+        self._pieces = []
+        self._length = 0
+        self._line_ended = False
+
+    def _emit(self, text: str):
+        text = text.rstrip()
+        if not text:
+            return
+        data = text.encode('utf-8')
+        if self.paragraphs:
+            self.text_file.write(b'\n\n')
+            self.offset += 2
+        self._offsets.append(self.offset)
+        self._offsets.append(len(data))
+        self.text_file.write(data)
+        self.offset += len(data)
+        self.chars += len(text)
+        self.paragraphs += 1
+        if len(self._offsets) >= INDEX_FLUSH_ENTRIES * 2:
+            self._flush_index()
+
+    def _flush_index(self):
+        self._offsets.tofile(self.index_file)
+        self._offsets = array('Q')
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial.rstrip('\r'))
+            self._partial = ''
+        self._end_paragraph()
+        self._flush_index()
+
+
+class HTMLTextExtractor(HTMLParser):
+    """Incremental HTML-to-text: block elements become paragraph breaks"""
+
+    BLOCK_TAGS = {
+        'p', 'div', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'blockquote', 'pre', 'tr', 'table',
+        'section', 'article', 'aside', 'header', 'footer', 'nav', 'figure', 'figcaption', 'hr',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    }
+    SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'template', 'svg', 'title'}
+
+    def __init__(self, sink):
+        super().__init__(convert_charrefs=True)
+        self.sink = sink
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            self._skip = 0  # recover from an unclosed <head>
+        elif tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'br':
+            self.sink('\n')
+        elif tag in self.BLOCK_TAGS:
+            self.sink('\n\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'br':
+            self.sink('\n')
+        elif tag in self.BLOCK_TAGS:
+            self.sink('\n\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.sink('\n\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.sink(re.sub(r'\s+', ' ', data))
+
+
+def _declared_charset(head: bytes):
+    """Python codec named by the HTML/XML charset declaration in ``head``, or None"""
+    match = _DECLARED_CHARSET_RE.search(head[:CHARSET_PRESCAN_BYTES])
+    if match is None:
+        return None
+    try:
+        name = codecs.lookup((match.group(1) or match.group(2)).decode('ascii')).name
+    except LookupError:
+        return None
+    # As browsers do: a byte-level <meta> cannot really mean UTF-16, and
+    # Latin-1/ASCII labels mean windows-1252
+    if name.startswith(('utf-16', 'utf-32')):
+        return 'utf-8'
+    if name in ('latin-1', 'iso8859-1', 'ascii'):
+        return 'cp1252'
+    return name
+
+
+def _start_decoding(head: bytes, markup: bool):
+    """(decoder, text of ``head``, encoding) for the first chunk of a file"""
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        declared = 'utf-16'
+    elif head.startswith(codecs.BOM_UTF8):
+        declared = 'utf-8-sig'
+    else:
+        declared = _declared_charset(head) if markup else None
+    if declared:
+        decoder = codecs.getincrementaldecoder(declared)(errors='replace')
+        return decoder, decoder.decode(head), declared
+
+    for encoding in ('utf-8', *getattr(settings, 'DOCUMENT_FALLBACK_ENCODINGS', ())):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            return decoder, decoder.decode(head), encoding
+        except UnicodeDecodeError:
+            continue
+    raise IngestError('Could not detect the text encoding. Save the file as UTF-8 and upload it again.')
+
+
+def _decoded(chunks: Iterator[bytes], markup: bool = False) -> Iterator[str]:
+    """
+    Incrementally decode a file in the encoding found by ``_start_decoding``
+    (``markup``: also honour HTML/XML charset declarations)
+    """
+    decoder = encoding = None
+    position = 0
+    try:
+        for chunk in chunks:
+            if decoder is None:
+                decoder, text, encoding = _start_decoding(chunk, markup)
+            else:
+                text = decoder.decode(chunk)
+            position += len(chunk)
+            if text:
+                yield text
+        if decoder is not None:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+    except UnicodeDecodeError as e:
+        # Only guessed encodings decode strictly
+        raise IngestError(f'The file is not valid {encoding} (near byte {position + e.start}). '
+                          'Save it as UTF-8 and upload it again.')
+
+
+def _read_chunks(fileobj) -> Iterator[bytes]:
+    while True:
+        chunk = fileobj.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _feed_html(chunks: Iterator[bytes], sink):
+    parser = HTMLTextExtractor(sink)
+    for text in _decoded(chunks, markup=True):
+        parser.feed(text)
+    parser.close()
+
+
+class _EpubMembers:
+    """
+    Opens archive members while keeping a running total of their declared
+    uncompressed sizes, so a zip bomb is refused before it is inflated.
+    ``zipfile`` never returns more than a member's declared ``file_size``.
+    """
+
+    def __init__(self, archive: zipfile.ZipFile, max_bytes: int):
+        self.archive = archive
+        self.max_bytes = max_bytes
+        self.total = 0
+
+    def open(self, name: str):
+        info = self.archive.getinfo(name)  # KeyError when missing
+        self.total += info.file_size
+        if self.total > self.max_bytes:
+            raise _too_large(self.max_bytes, 'unpacked ')
+        return self.archive.open(info)
+
+    def read(self, name: str) -> bytes:
+        with self.open(name) as member:
+            return member.read()
+
+
+def _epub_items(members: _EpubMembers) -> Iterator[str]:
+    """Archive names of the EPUB's content documents in reading (spine) order"""
+    try:
+        container = ET.fromstring(members.read('META-INF/container.xml'))
+        rootfile = container.find(f'.//{CONTAINER_NS}rootfile').get('full-path')
+        package = ET.fromstring(members.read(rootfile))
+    except (KeyError, AttributeError, ET.ParseError):
+        raise IngestError('Not a valid EPUB: missing or broken package document')
+
+    base = posixpath.dirname(rootfile)
+    manifest = {item.get('id'): item.get('href') for item in package.iter(f'{OPF_NS}item')}
+    for itemref in package.iter(f'{OPF_NS}itemref'):
+        href = manifest.get(itemref.get('idref'))
+        if href:
+            yield posixpath.normpath(posixpath.join(base, unquote(href)))
+
+
+def _extract(fmt: str, upload, writer: ParagraphWriter, max_bytes: int):
+    if fmt == 'epub':
+        try:
+            archive = zipfile.ZipFile(upload)
+        except zipfile.BadZipFile:
+            raise IngestError('Not a valid EPUB: the file is not a zip archive')
+        with archive:
+            members = _EpubMembers(archive, max_bytes)
+            for name in _epub_items(members):
+                try:
+                    member = members.open(name)
+                except KeyError:
+                    continue  # spine entry missing from the archive
+                with member:
+                    _feed_html(_read_chunks(member), writer.feed)
+                writer.feed('\n\n')
+    elif fmt == 'html':
+        _feed_html(upload.chunks(READ_CHUNK_BYTES), writer.feed)
+    else:
+        for text in _decoded(upload.chunks(READ_CHUNK_BYTES)):
+            writer.feed(text)
+
+
+def check_content_length(content_length) -> None:
+    """Refuse an upload by its request's Content-Length, before the body is read"""
+    try:
+        length = int(content_length or 0)
+    except ValueError:
+        return
+    max_bytes = max_upload_bytes()
+    if length > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise _too_large(max_bytes)
+
+
+def ingest(upload) -> Document:
+    """Parse an uploaded file into stored paragraphs and return its ``Document``"""
+    max_bytes = max_upload_bytes()
+    if upload.size > max_bytes:
+        raise _too_large(max_bytes)
+    fmt = detect_format(upload.name, getattr(upload, 'content_type', ''))
+
+    handle = uuid.uuid4().hex
+    text_path, index_path = _paths(handle)
+    text_path.parent.mkdir(parents=True, exist_ok=True)
+    partial_text, partial_index = text_path.with_suffix('.txt.part'), index_path.with_suffix('.idx.part')
+    try:
+        with open(partial_text, 'wb') as text_file, open(partial_index, 'wb') as index_file:
+            writer = ParagraphWriter(
+                text_file, index_file,
+                max_paragraph_chars=getattr(settings, 'DOCUMENT_MAX_PARAGRAPH_CHARS', 4000),
+                keep_indent=fmt == 'markdown',
+            )
+            _extract(fmt, upload, writer, max_bytes)
+            writer.close()
+        if not writer.paragraphs:
+            raise IngestError('No text found in the file')
+        os.replace(partial_text, text_path)
+        os.replace(partial_index, index_path)
+    finally:
+        partial_text.unlink(missing_ok=True)
+        partial_index.unlink(missing_ok=True)
+
+    try:
+        return Document.objects.create(
+            handle=handle,
+            name=os.path.basename(upload.name or 'document')[:255],
+            format=fmt,
+            size_bytes=upload.size,
+            text_bytes=writer.offset,
+            char_count=writer.chars,
+            paragraph_count=writer.paragraphs,
+        )
+    except Exception:
+        # No row refers to the files: don't leave them behind
+        text_path.unlink(missing_ok=True)
+        index_path.unlink(missing_ok=True)
+        raise
+
+
+def read_paragraphs(document: Document, start: int, count: int) -> List[str]:
+    """Paragraphs ``start`` .. ``start + count`` of a document (clamped to its end)"""
+    start = max(0, start)
+    count = max(0, min(count, document.paragraph_count - start))
+    if not count:
+        return []
+    text_path, index_path = _paths(document.handle)
+    offsets = array('Q')
+    with open(index_path, 'rb') as index_file:
+        index_file.seek(start * 2 * offsets.itemsize)
+        offsets.frombytes(index_file.read(count * 2 * offsets.itemsize))
+    first = offsets[0]
+    end = offsets[-2] + offsets[-1]
+    with open(text_path, 'rb') as text_file:
+        text_file.seek(first)
+        data = text_file.read(end - first)
+    return [data[offset - first:offset - first + length].decode('utf-8')
+            for offset, length in zip(offsets[::2], offsets[1::2])]
+
+
+def document_text(data: dict) -> str:
+    """The text of ``{"document", "start", "count"}`` in a stream request"""
+    max_count = getattr(settings, 'DOCUMENT_MAX_PARAGRAPHS_PER_REQUEST', 200)
+    try:
+        document = Document.objects.get(handle=str(data['document']))
+        start = int(data.get('start', 0))
+        count = int(data.get('count', max_count))
+    except Document.DoesNotExist:
+        raise IngestError('Unknown document', status=404)
+    except (TypeError, ValueError):
+        raise IngestError('start and count must be integers')
+    if count > max_count:
+        raise IngestError(f'count must be at most {max_count} paragraphs')
+    return '\n\n'.join(read_paragraphs(document, start, count))
+
+
+def delete(document: Document):
+    """Remove a document's row and its stored files"""
+    for path in _paths(document.handle):
+        path.unlink(missing_ok=True)
+    document.delete()
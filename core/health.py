@@ -0,0 +1,54 @@
+import time
+
+from django.db import connection
+from django.http import JsonResponse
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET
+
+from .config_snapshot import get_snapshot
+from .streaming import streams
+from . import warmup
+
+
+@never_cache
+@require_GET
+def healthz(request):
+    """Liveness: the worker is up and answering (no DB, no templates)"""
+    return JsonResponse({'status': 'ok'})
+
+
+@never_cache
+@require_GET
+def readyz(request):
+    """Readiness: database reachable and configuration snapshot loaded"""
+    checks = {}
+    ready = True
+
+    started = time.perf_counter()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        checks['database'] = {'ok': True, 'latency_ms': round((time.perf_counter() - started) * 1000, 2)}
+    except Exception as e:
+        checks['database'] = {'ok': False, 'error': str(e)}
+        ready = False
+
+    snapshot = get_snapshot()
+    checks['config'] = {
+        'ok': snapshot.complete,
+        'version': snapshot.version,
+        'active_templates': sorted(snapshot.templates),
+    }
+    ready = ready and snapshot.complete
+
+    warm = warmup.state()
+    checks['warmup'] = warm
+    if warm['status'] == 'running':
+        ready = False
+
+    if streams.draining:
+        checks['draining'] = True
+        ready = False
+
+    return JsonResponse({'status': 'ready' if ready else 'unavailable', 'checks': checks},
+                        status=200 if ready else 503)
@@ -0,0 +1,225 @@
+"""
+Adaptive latency tiers.
+
+Every upstream call is routed through ``choose_route`` which picks the
+reasoning effort, verbosity, output token cap and (optionally) a faster
+fallback model for the request. The choice is driven by the per-template
+latency SLOs in ``settings.LATENCY_SLOS``, the size of the selection and
+document, live TTFT measurements and the number of in-flight upstream calls
+in this process. Every decision is logged to the ``core.latency`` logger.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+EFFORT_LEVELS = ('minimal', 'low', 'medium', 'high')
+VERBOSITY_LEVELS = ('low', 'medium', 'high')
+
+DEFAULT_LATENCY_SLOS = {
+    'translation': {'ttft_ms': 4000, 'verbosity': 'medium', 'max_output_tokens': None},
+    'word_analysis': {'ttft_ms': 1500, 'verbosity': 'low', 'max_output_tokens': 800, 'max_effort': 'low'},
+    'sentence_analysis': {'ttft_ms': 3000, 'verbosity': 'medium', 'max_output_tokens': 1500},
+}
+
+# Reasoning tokens count against max_output_tokens on the responses API, so
+# the visible-output cap is widened by a budget that grows with effort.
+REASONING_ALLOWANCE = {'minimal': 0, 'low': 2048, 'medium': 8192, 'high': 24576}
+
+# TTFT grows with prompt size (prefill). Observations are normalised to a
+# per-"unit" latency where one unit is the fixed overhead plus this many
+# prompt tokens, so predictions scale to the document at hand.
+PREFILL_TOKENS_PER_UNIT = 4000
+EWMA_ALPHA = 0.3
+# Measurements older than this are ignored, so a model that was degraded
+# away from gets retried once it has had time to recover.
+SAMPLE_TTL_SECONDS = 120
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """How a single upstream call should be made"""
+    model: str
+    reasoning_effort: str
+    verbosity: str
+    max_output_tokens: Optional[int] = None
+    store: bool = False
+    tier: str = 'default'
+    reasons: tuple = field(default_factory=tuple)
+
+    @classmethod
+    def from_template(cls, template) -> 'RouteDecision':
+        """The template's own settings, without any adaptation"""
+        return cls(
+            model=template.api_config.model_name,
+            reasoning_effort=template.reasoning_effort or 'minimal',
+            verbosity='medium',
+            store=getattr(settings, 'RESPONSES_STORE', False),
+            tier=template.template_type,
+        )
+
+
+class LatencyTracker:
+    """Per-model EWMA of observed TTFT and a count of in-flight calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._unit_ttft: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+        self._observed_at: Dict[str, float] = {}
+        self._inflight: Dict[str, int] = {}
+
+    @staticmethod
+    def _units(prompt_tokens: int) -> float:
+        return 1 + prompt_tokens / PREFILL_TOKENS_PER_UNIT
+
+    def observe(self, model: str, ttft_ms: float, prompt_tokens: int = 0):
+        unit = ttft_ms / self._units(prompt_tokens)
+        with self._lock:
+            previous = self._unit_ttft.get(model)
+            self._unit_ttft[model] = unit if previous is None else previous + EWMA_ALPHA * (unit - previous)
+            self._samples[model] = self._samples.get(model, 0) + 1
+            self._observed_at[model] = time.monotonic()
+
+    def predict(self, model: str, prompt_tokens: int = 0) -> Optional[float]:
+        with self._lock:
+            unit = self._unit_ttft.get(model)
+            observed_at = self._observed_at.get(model, 0)
+        if unit is None or time.monotonic() - observed_at > SAMPLE_TTL_SECONDS:
+            return None
+        return unit * self._units(prompt_tokens)
+
+    def begin(self, model: str):
+        with self._lock:
+            self._inflight[model] = self._inflight.get(model, 0) + 1
+
+    def end(self, model: str):
+        with self._lock:
+            self._inflight[model] = max(0, self._inflight.get(model, 0) - 1)
+
+    def inflight(self, model: Optional[str] = None) -> int:
+        with self._lock:
+            if model is None:
+                return sum(self._inflight.values())
+            return self._inflight.get(model, 0)
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                model: {
+                    'ttft_ms_per_unit': round(unit, 1),
+                    'samples': self._samples.get(model, 0),
+                    'inflight': self._inflight.get(model, 0),
+                }
+                for model, unit in self._unit_ttft.items()
+            }
+
+
+tracker = LatencyTracker()
+
+
+def is_reasoning_model(model_name: str) -> bool:
+    """Check if the model is a reasoning model that requires responses API"""
+    reasoning_prefixes = ('o1', 'o3', 'o4', 'gpt-5')
+    return any(model_name.startswith(prefix) for prefix in reasoning_prefixes)
+
+
+def get_slo(template) -> dict:
+    """SLO settings for a template: per-name override, then per-type, then defaults"""
+    slos = getattr(settings, 'LATENCY_SLOS', {})
+    tier = dict(DEFAULT_LATENCY_SLOS.get(template.template_type, {}))
+    tier.update(slos.get(template.template_type, {}))
+    tier.update(slos.get(template.name, {}))
+    return tier
+
+
+def _step_down(level: str, levels: tuple, steps: int) -> str:
+    position = levels.index(level) if level in levels else 0
+    return levels[max(0, position - steps)]
+
+
+def _cap(level: str, ceiling: Optional[str], levels: tuple) -> str:
+    if ceiling is None or level not in levels or ceiling not in levels:
+        return level
+    return levels[min(levels.index(level), levels.index(ceiling))]
+
+
+def choose_route(template, prompt_tokens: int = 0, selection_words: Optional[int] = None,
+                 sentence_threshold: Optional[int] = None) -> RouteDecision:
+    """
+    Pick effort, verbosity, output cap and model for a request.
+
+    ``prompt_tokens`` is the approximate size of the rendered prompt (the
+    document dominates it), ``selection_words`` the size of the analysed
+    selection. Pressure builds when the predicted TTFT exceeds the SLO or
+    too many calls are already in flight; each unit of pressure lowers the
+    effort by one level, and at two or more the fallback model is used.
+    """
+    base = RouteDecision.from_template(template)
+    tier = get_slo(template)
+    slo_ms = tier.get('ttft_ms')
+    reasons: List[str] = []
+
+    effort = _cap(base.reasoning_effort, tier.get('max_effort'), EFFORT_LEVELS)
+    if effort != base.reasoning_effort:
+        reasons.append(f'tier caps effort at {effort}')
+    verbosity = tier.get('verbosity', base.verbosity)
+
+    # Clauses shorter than a full sentence do not need a long explanation.
+    if (template.template_type == 'sentence_analysis' and selection_words is not None
+            and sentence_threshold is not None and selection_words < sentence_threshold):
+        verbosity = 'low'
+        reasons.append(f'short selection ({selection_words} words)')
+
+    predicted = tracker.predict(base.model, prompt_tokens)
+    inflight = tracker.inflight()
+    pressure = 0
+    if slo_ms and predicted is not None and predicted > slo_ms:
+        pressure += 2 if predicted > 2 * slo_ms else 1
+        reasons.append(f'predicted ttft {predicted:.0f}ms > slo {slo_ms}ms')
+    load_threshold = getattr(settings, 'LATENCY_LOAD_THRESHOLD', 8)
+    if inflight >= load_threshold:
+        pressure += 1
+        reasons.append(f'{inflight} calls in flight')
+
+    if pressure:
+        effort = _step_down(effort, EFFORT_LEVELS, pressure)
+        verbosity = _step_down(verbosity, VERBOSITY_LEVELS, 1)
+
+    model = base.model
+    fallback = getattr(settings, 'LATENCY_FALLBACK_MODELS', {}).get(base.model)
+    if pressure >= 2 and fallback:
+        model = fallback
+        reasons.append(f'fallback model {fallback}')
+
+    max_output_tokens = tier.get('max_output_tokens')
+    if max_output_tokens and is_reasoning_model(model):
+        max_output_tokens += REASONING_ALLOWANCE.get(effort, 0)
+
+    decision = RouteDecision(
+        model=model,
+        reasoning_effort=effort,
+        verbosity=verbosity,
+        max_output_tokens=max_output_tokens,
+        store=base.store,
+        tier=template.template_type,
+        reasons=tuple(reasons),
+    )
+    logger.info('route', extra={
+        'template': template.name,
+        'tier': decision.tier,
+        'prompt_tokens': prompt_tokens,
+        'selection_words': selection_words,
+        'slo_ms': slo_ms,
+        'predicted_ttft_ms': None if predicted is None else round(predicted),
+        'inflight': inflight,
+        'pressure': pressure,
+        'decision': {k: v for k, v in asdict(decision).items() if k not in ('tier', 'reasons')},
+        'reasons': list(reasons),
+    })
+    return decision
@@ -0,0 +1,299 @@
+"""
+Structured, non-blocking logging.
+
+Records are formatted as one JSON object per line carrying the request id
+of the request they were logged in. ``QueuedStreamHandler`` only copies
+the record into a bounded queue in the calling thread; a background
+listener formats and writes it, so a slow or contended stdout never stalls
+a streaming response. When the queue is full, records are dropped and
+counted instead of blocking. The listener is started per process on first
+use, so ``serve`` workers forked after setup get their own; they call
+``flush`` before exiting.
+
+``RequestIdMiddleware`` takes the id from ``X-Request-ID`` (or makes one),
+echoes it on the response and keeps it bound while a streaming body is
+produced. Per-chunk debug events go through ``chunk_sampled`` so only the
+first chunk and every ``LOG_CHUNK_SAMPLE_EVERY``-th one are logged.
+Logger levels start from ``LOG_LEVELS`` and can be changed at runtime via
+``/api/logging/``. Changes are written to ``LOG_LEVELS_FILE``; every process
+compares the file's ``stat`` with the one it last applied at the start of
+each request and re-applies it when it moved, so all ``serve`` workers
+follow the change (the same scheme as ``core.config_snapshot``).
+"""
+import atexit
+import copy
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.http import Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET')
+# LogRecord attributes; everything else on a record came from ``extra``
+_RESERVED = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+_request_id: ContextVar[str] = ContextVar('contextlens_request_id', default='-')
+_handlers = []
+
+
+def request_id() -> str:
+    """Id of the request being handled, ``-`` outside a request"""
+    return _request_id.get()
+
+
+def chunk_sampled(index: int) -> bool:
+    """Whether the ``index``-th chunk (1-based) of a stream gets a debug record"""
+    every = getattr(settings, 'LOG_CHUNK_SAMPLE_EVERY', 50)
+    return index == 1 or (every > 0 and index % every == 0)
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request id (runs in the caller's thread, before queuing)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; ``extra`` fields become top-level keys"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class QueuedStreamHandler(QueueHandler):
+    """Hand records to a background thread that writes them to ``stream``"""
+
+    def __init__(self, stream=None, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        _handlers.append(self)
+
+    def _ensure_listener(self):
+        # Workers are forked from a preloaded parent: its listener thread
+        # (and whatever state the queue was in) does not carry over
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self.queue = queue.Queue(self.queue.maxsize)
+                self.listener = QueueListener(self.queue, self.target)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def setFormatter(self, fmt):
+        # Formatting happens in the listener thread, on the target handler
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Freeze the message now: args may be mutated after the call returns
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self in _handlers:
+            _handlers.remove(self)
+            if self._pid == os.getpid():
+                self.listener.stop()  # writes out what is still queued
+        super().close()
+
+
+@atexit.register
+def flush():
+    """Write out queued records and stop the listeners (also for exits that skip atexit)"""
+    for handler in list(_handlers):
+        handler.close()
+
+
+def _levels_path() -> Path:
+    return Path(getattr(settings, 'LOG_LEVELS_FILE', settings.BASE_DIR / '.log_levels'))
+
+
+class SharedLevels:
+    """Logger level overrides shared by every process through ``LOG_LEVELS_FILE``"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int, int]] = None
+
+    def apply(self):
+        """Re-apply the overrides if another process changed them (one ``os.stat``)"""
+        path = _levels_path()
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return
+        stamp = (info.st_ino, info.st_mtime_ns, info.st_size)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            for name, level in self._read(path).items():
+                logging.getLogger(name).setLevel(level)
+            self._stamp = stamp
+
+    def publish(self, levels: dict):
+        """Merge ``levels`` into the overrides and apply them here; other processes follow"""
+        path = _levels_path()
+        with self._lock:
+            merged = {**self._read(path), **levels}
+            temporary = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            temporary.write_text(json.dumps(merged, sort_keys=True))
+            os.replace(temporary, path)
+        self.apply()
+
+    @staticmethod
+    def _read(path: Path) -> dict:
+        try:
+            levels = json.loads(path.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.getLogger(__name__).warning('ignoring unreadable %s: %s', path, e)
+            return {}
+        return {name: level for name, level in levels.items() if level in LEVELS}
+
+
+shared_levels = SharedLevels()
+
+
+class RequestIdMiddleware:
+    """Bind a request id for the request, including its streamed body"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        shared_levels.apply()
+        offered = request.headers.get('X-Request-ID', '')
+        rid = offered if REQUEST_ID_RE.match(offered) else uuid.uuid4().hex[:16]
+        token = _request_id.set(rid)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_id.reset(token)
+        response['X-Request-ID'] = rid
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _bound_async(response.streaming_content, rid)
+            else:
+                response.streaming_content = _bound_sync(response.streaming_content, rid)
+        return response
+
+
+def _bound_sync(content, rid: str):
+    iterator = iter(content)
+    while True:
+        token = _request_id.set(rid)
+        try:
+            chunk = next(iterator, None)
+        finally:
+            _request_id.reset(token)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def _bound_async(content, rid: str):
+    iterator = aiter(content)
+    while True:
+        # Set per pull so worker threads started for it see the id
+        token = _request_id.set(rid)
+        try:
+            chunk = await anext(iterator, None)
+        finally:
+            _request_id.reset(token)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _authorized(request) -> bool:
+    token = getattr(settings, 'LOG_ADMIN_TOKEN', '')
+    if token:
+        offered = request.headers.get('X-Log-Token', '')
+        return bool(offered) and hmac.compare_digest(token.encode(), offered.encode())
+    return settings.DEBUG
+
+
+def _levels() -> dict:
+    names = {'core', *getattr(settings, 'LOG_LEVELS', {})}
+    names.update(name for name in logging.root.manager.loggerDict if name.startswith('core.'))
+    return {name: logging.getLevelName(logging.getLogger(name).level) for name in sorted(names)}
+
+
+@csrf_exempt
+def logging_levels(request):
+    """GET the configured logger levels; POST {"levels": {"core.views": "DEBUG"}} to change them"""
+    if request.method not in ('GET', 'POST'):
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    if not _authorized(request):
+        if not getattr(settings, 'LOG_ADMIN_TOKEN', ''):
+            raise Http404('Logging admin is disabled')
+        return JsonResponse({'error': 'Missing or wrong X-Log-Token'}, status=403)
+
+    if request.method == 'POST':
+        try:
+            levels = json.loads(request.body).get('levels')
+        except (ValueError, AttributeError):
+            levels = None
+        if not isinstance(levels, dict):
+            return JsonResponse({'error': 'Expected {"levels": {"<logger>": "<LEVEL>"}}'}, status=400)
+        invalid = {name: level for name, level in levels.items() if str(level).upper() not in LEVELS}
+        if invalid:
+            return JsonResponse({'error': f'Unknown levels: {invalid}', 'levels': LEVELS}, status=400)
+        levels = {name: str(level).upper() for name, level in levels.items()}
+        # Through the shared file, so every worker process picks the change up
+        shared_levels.publish(levels)
+        logging.getLogger(__name__).info('log levels changed', extra={'levels': levels})
+
+    return JsonResponse({
+        'levels': _levels(),
+        'dropped': sum(handler.dropped for handler in _handlers),
+    })
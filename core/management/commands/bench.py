@@ -0,0 +1,70 @@
+import json
+import logging
+import platform
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import SIZES, STAGES, cases, compare, measure
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the request hot path and fail on regressions against stored baselines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stage', action='append', choices=[stage.name for stage in STAGES],
+                            help='Only run this stage (repeatable)')
+        parser.add_argument('--size', action='append', choices=list(SIZES),
+                            help='Only use this document size (repeatable)')
+        parser.add_argument('--min-time', type=float, default=0.5, help='Seconds of timing per stage and size')
+        parser.add_argument('--baseline', default=None,
+                            help='Baseline file (default: settings.BENCH_BASELINE_FILE)')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store this run as the baseline instead of checking against it')
+        parser.add_argument('--budget', type=float, default=None,
+                            help='Allowed ops/sec drop as a fraction, overriding the settings')
+        parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+
+    def handle(self, *args, **options):
+        path = Path(options['baseline'] or getattr(settings, 'BENCH_BASELINE_FILE',
+                                                   settings.BASE_DIR / 'bench_baseline.json'))
+        selected = cases(options['stage'], options['size'] or list(SIZES))
+
+        # Route decisions are logged at INFO; keep them out of the measurements
+        core_logger = logging.getLogger('core')
+        level = core_logger.level
+        core_logger.setLevel(logging.WARNING)
+        results = {}
+        try:
+            for key, stage, size in selected:
+                results[key] = measure(stage.setup(size), options['min_time'])
+                if not options['json']:
+                    self.stdout.write(f"{key:<28} {results[key]['ops_per_sec']:12.1f} ops/s "
+                                      f"{results[key]['peak_kb']:10.1f} KB peak")
+        finally:
+            core_logger.setLevel(level)
+
+        if options['save_baseline']:
+            stored = json.loads(path.read_text()) if path.exists() else {}
+            stored.setdefault('results', {}).update(results)
+            stored['recorded'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+            stored['machine'] = f'{platform.node()} {platform.machine()} Python {platform.python_version()}'
+            path.write_text(json.dumps(stored, indent=1, sort_keys=True) + '\n')
+            self.stdout.write(f'Baseline for {len(results)} cases saved to {path}')
+            return
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        if not path.exists():
+            self.stdout.write(f'No baseline at {path}; run with --save-baseline to record one.')
+            return
+        baseline = json.loads(path.read_text())
+        regressions = compare(results, baseline.get('results', {}), options['budget'])
+        if regressions:
+            raise CommandError('Regressions against the baseline of {}:\n  {}'.format(
+                baseline.get('recorded', '?'), '\n  '.join(regressions)))
+        checked = sum(1 for key in results if key in baseline.get('results', {}))
+        self.stdout.write(self.style.SUCCESS(
+            f"{checked} cases within budget of the baseline recorded {baseline.get('recorded', '?')}"))
@@ -0,0 +1,95 @@
+import statistics
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+
+from core.config_snapshot import load_snapshot
+from core.models import UserSession
+
+
+class Command(BaseCommand):
+    help = 'Benchmark database throughput with concurrent hot-path readers and writers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8, help='Concurrent reader threads')
+        parser.add_argument('--writers', type=int, default=2, help='Concurrent writer threads')
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run')
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES['default']
+        self.stdout.write(
+            f"Database: {database['NAME']} (profile: {settings.CONTEXTLENS_ENV}, "
+            f"CONN_MAX_AGE={database.get('CONN_MAX_AGE', 0)})"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+        self.stdout.write(f'journal_mode={journal_mode}')
+
+        run_id = uuid.uuid4().hex[:8]
+        deadline = time.perf_counter() + options['duration']
+        results = {'read': [], 'write': []}
+        errors = {'read': 0, 'write': 0}
+        lock = threading.Lock()
+
+        def reader():
+            latencies = []
+            failed = 0
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    # Same two queries the config snapshot issues per rebuild
+                    load_snapshot('bench')
+                except OperationalError:
+                    failed += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+            connection.close()
+            with lock:
+                results['read'].extend(latencies)
+                errors['read'] += failed
+
+        def writer(number):
+            latencies = []
+            failed = 0
+            sequence = 0
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    UserSession.objects.create(session_id=f'bench-{run_id}-{number}-{sequence}')
+                except OperationalError:
+                    failed += 1
+                    continue
+                sequence += 1
+                latencies.append(time.perf_counter() - started)
+            connection.close()
+            with lock:
+                results['write'].extend(latencies)
+                errors['write'] += failed
+
+        threads = [threading.Thread(target=reader) for _ in range(options['readers'])]
+        threads += [threading.Thread(target=writer, args=(n,)) for n in range(options['writers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        UserSession.objects.filter(session_id__startswith=f'bench-{run_id}-').delete()
+
+        for kind in ('read', 'write'):
+            latencies = sorted(results[kind])
+            if not latencies:
+                self.stdout.write(f'{kind:>5}: no completed operations ({errors[kind]} errors)')
+                continue
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            self.stdout.write(
+                f'{kind:>5}: {len(latencies) / elapsed:10.1f} ops/s  '
+                f'p50 {statistics.median(latencies) * 1000:7.2f} ms  '
+                f'p99 {p99 * 1000:7.2f} ms  errors {errors[kind]}'
+            )
@@ -0,0 +1,92 @@
+import logging
+import os
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core.log import JsonFormatter, QueuedStreamHandler, RequestIdFilter
+from core.pipeline import iter_events, sse_frame
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-chunk cost of logging in the streaming loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunks', type=int, default=20000, help='Chunks per stream')
+        parser.add_argument('--rounds', type=int, default=5, help='Streams per scenario (median is reported)')
+        parser.add_argument('--output', default=os.devnull, help='Where log records are written')
+
+    def handle(self, *args, **options):
+        chunks = ['streamed text, five words '] * options['chunks']
+        output = open(options['output'], 'a', encoding='utf-8')
+        logger = logging.getLogger('core')
+
+        @contextmanager
+        def logging_to(handler, level, sample_every=None):
+            saved = logger.handlers[:], logger.level
+            logger.handlers = [handler] if handler else []
+            logger.setLevel(level)
+            try:
+                if sample_every is None:
+                    yield
+                else:
+                    with override_settings(LOG_CHUNK_SAMPLE_EVERY=sample_every):
+                        yield
+            finally:
+                logger.handlers, level = saved
+                logger.setLevel(level)
+
+        def stream():
+            for event in iter_events(iter(chunks)):
+                sse_frame(event)
+
+        def print_stream():
+            # What the views used to do: one synchronous print per chunk
+            for event in iter_events(iter(chunks)):
+                print(f"Django view sending {event['type']}: {repr(event.get('content', ''))}", file=output)
+                sse_frame(event)
+
+        def queued():
+            handler = QueuedStreamHandler(output)
+            handler.addFilter(RequestIdFilter())
+            handler.setFormatter(JsonFormatter())
+            return handler
+
+        def blocking():
+            handler = logging.StreamHandler(output)
+            handler.addFilter(RequestIdFilter())
+            handler.setFormatter(JsonFormatter())
+            return handler
+
+        scenarios = [
+            ('INFO (default)', None, logging.INFO, None, stream),
+            ('print per chunk (old)', None, logging.INFO, None, print_stream),
+            ('DEBUG, queued, sampled', queued, logging.DEBUG, None, stream),
+            ('DEBUG, queued, every chunk', queued, logging.DEBUG, 1, stream),
+            ('DEBUG, blocking, every chunk', blocking, logging.DEBUG, 1, stream),
+        ]
+        self.stdout.write(f"{options['chunks']} chunks x {options['rounds']} rounds, records to {options['output']}")
+        baseline = None
+        for name, make_handler, level, sample_every, run in scenarios:
+            timings = []
+            dropped = 0
+            for _ in range(options['rounds']):
+                handler = make_handler() if make_handler else None
+                with logging_to(handler, level, sample_every):
+                    started = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - started)
+                if handler is not None:
+                    dropped += getattr(handler, 'dropped', 0)
+                    handler.close()
+            per_chunk_us = statistics.median(timings) / options['chunks'] * 1e6
+            baseline = baseline or per_chunk_us
+            line = (f'{name:<30} {per_chunk_us:7.2f} us/chunk  '
+                    f'overhead {per_chunk_us - baseline:+7.2f} us ({per_chunk_us / baseline:5.2f}x)')
+            if dropped:
+                line += f'  dropped {dropped}'
+            self.stdout.write(line)
+        output.close()
@@ -0,0 +1,145 @@
+import os
+import signal
+import time
+
+import uvicorn
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import log, usage
+from core.streaming import streams
+
+
+def default_workers() -> int:
+    """One worker per CPU available to this process"""
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+class Command(BaseCommand):
+    help = 'Serve ContextLens.asgi with multiple uvicorn workers and graceful stream draining'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--workers', type=int, default=default_workers(),
+                            help='Worker processes (default: CPU count)')
+        parser.add_argument('--backlog', type=int, default=2048, help='Listen socket backlog')
+        parser.add_argument('--keep-alive', type=int, default=15,
+                            help='Seconds to keep idle HTTP connections open')
+        parser.add_argument('--drain-timeout', type=int, default=30,
+                            help='Seconds in-flight streams get to finish after SIGTERM')
+        parser.add_argument('--log-level', default='info')
+
+    def handle(self, *args, **options):
+        # Preload the application once in the parent so forked workers share
+        # the imported code and settings instead of each importing it again.
+        from ContextLens.asgi import application
+
+        config = uvicorn.Config(
+            application,
+            host=options['host'],
+            port=options['port'],
+            backlog=options['backlog'],
+            timeout_keep_alive=options['keep_alive'],
+            timeout_graceful_shutdown=options['drain_timeout'],
+            log_level=options['log_level'],
+            lifespan='auto',
+            proxy_headers=True,
+        )
+        sock = config.bind_socket()
+        # Don't carry a parent DB connection across fork()
+        connections.close_all()
+
+        workers = options['workers']
+        if workers <= 1 or not hasattr(os, 'fork'):
+            self.stdout.write(f"Serving on http://{options['host']}:{options['port']} (1 worker)")
+            DrainingServer(config).run(sockets=[sock])
+            return
+
+        self.stdout.write(f"Serving on http://{options['host']}:{options['port']} ({workers} workers)")
+        Supervisor(config, sock, workers, options['drain_timeout'], self.stdout).run()
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn.Server that marks the worker as draining on shutdown signals"""
+
+    def handle_exit(self, sig, frame):
+        # Stop handing out new streams right away; uvicorn then closes the
+        # listener and waits for open responses up to
+        # timeout_graceful_shutdown before cancelling them.
+        streams.start_draining()
+        super().handle_exit(sig, frame)
+
+
+class Supervisor:
+    """Pre-fork process manager: keeps N workers alive, drains them on SIGTERM"""
+
+    def __init__(self, config, sock, workers, drain_timeout, stdout):
+        self.config = config
+        self.sock = sock
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.stdout = stdout
+        self.children = set()
+        self.stopping_since = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                DrainingServer(self.config).run(sockets=[self.sock])
+            finally:
+                # os._exit skips atexit
+                usage.writer.flush()
+                log.flush()
+                os._exit(0)
+        self.children.add(pid)
+
+    def stop(self, signum, frame):
+        if self.stopping_since is None:
+            self.stdout.write(f'Received signal {signum}, draining workers '
+                              f'(up to {self.drain_timeout}s)...')
+            self.stopping_since = time.monotonic()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if self.stopping_since is None:
+                self.stdout.write(f'Worker {pid} exited with status {status}, restarting')
+                self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+
+        # Grace beyond the drain deadline for lifespan shutdown and exit
+        hard_deadline = self.drain_timeout + 5
+        while self.children:
+            self.reap()
+            if self.stopping_since is not None and time.monotonic() - self.stopping_since > hard_deadline:
+                for pid in self.children:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            time.sleep(0.2)
+        self.sock.close()
+        self.stdout.write('All workers stopped')
@@ -138,6 +138,31 @@ Provide only the Chinese translation. Be precise, natural, and culturally approp
         if created:
             self.stdout.write(self.style.SUCCESS('Created advanced GPT-5 translation template'))
 
+        # Structured word analysis: JSON fields, dictionary part cached per word
+        structured_analysis, created = PromptTemplate.objects.get_or_create(
+            name="Structured Word Analysis (GPT-5)",
+            template_type="word_analysis",
+            defaults={
+                'prompt_text': """分析用户选中的单词或短语 {input_select}，用中文填写每个字段：
+
+- headword：词典原形
+- ipa：国际音标
+- senses：2-3个最常见的词性和含义
+- sentence：该词在全文中所在的原句
+- sentence_translation：该句的中文翻译
+- contextual_meaning：该词在这句话中的具体意思
+
+全文文本: {all_input}""",
+                'api_config': gpt5_config,
+                'reasoning_effort': 'low',
+                'output_format': 'structured',
+                'is_active': False
+            }
+        )
+
+        if created:
+            self.stdout.write(self.style.SUCCESS('Created structured word analysis template'))
+
         self.stdout.write(
             self.style.SUCCESS(
                 '\nDefault setup complete! '
@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so nothing is already imported or connected.
+PROBE = r'''
+import asyncio, json, os, sys, time
+t0 = time.perf_counter()
+timings = {}
+
+def mark(name, since):
+    now = time.perf_counter()
+    timings[name] = round((now - since) * 1000, 2)
+    return now
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ContextLens.settings')
+import django
+django.setup()
+t = mark('django_setup', t0)
+
+from ContextLens.asgi import application
+t = mark('asgi_app', t)
+
+async def lifespan_startup():
+    # Worker warm-up (core.warmup) runs here when CONTEXTLENS_WARMUP=1
+    started = asyncio.Event()
+    async def receive():
+        if started.is_set():
+            await asyncio.Future()
+        return {'type': 'lifespan.startup'}
+    async def send(message):
+        started.set()
+    task = asyncio.ensure_future(application({'type': 'lifespan', 'asgi': {'version': '3.0'}}, receive, send))
+    await started.wait()
+    task.cancel()
+
+asyncio.run(lifespan_startup())
+t = mark('warmup', t)
+
+from django.urls import get_resolver
+get_resolver().resolve('/')
+t = mark('url_resolver', t)
+
+first_byte_at = None
+
+async def request(path, method='GET', body=b'', first_chunk=False):
+    sent = []
+    body_sent = False
+    chunk_arrived = asyncio.Event()
+    async def receive():
+        nonlocal body_sent
+        if body_sent:
+            await asyncio.Future()  # no disconnect until the response is done
+        body_sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+        global first_byte_at
+        sent.append(message)
+        if message.get('body') and not chunk_arrived.is_set():
+            first_byte_at = time.perf_counter()
+            chunk_arrived.set()
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('localhost', 8000),
+        'headers': [(b'host', b'localhost'), (b'content-type', b'application/json')],
+    }
+    if not first_chunk:
+        await application(scope, receive, send)
+        return sent[0]['status']
+    # Time to first streamed byte (TTFT as the reader sees it), then hang up
+    task = asyncio.ensure_future(application(scope, receive, send))
+    waiter = asyncio.ensure_future(chunk_arrived.wait())
+    await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+    task.cancel()
+    waiter.cancel()
+    return sent[0]['status'] if sent else None
+
+status = asyncio.run(request('/healthz'))
+t = mark('first_healthz', t)
+ready_status = asyncio.run(request('/readyz'))
+t = mark('first_readyz', t)
+stream_status = asyncio.run(request('/api/stream-translate/', 'POST', b'{"text": "Hello."}', first_chunk=True))
+# Measured at the first byte: shutting the loop down waits for the stream's worker thread
+timings['first_stream'] = round(((first_byte_at or time.perf_counter()) - t) * 1000, 2)
+t = time.perf_counter()
+
+timings['total'] = round((time.perf_counter() - t0) * 1000, 2)
+print(json.dumps({
+    'timings': timings,
+    'healthz_status': status,
+    'readyz_status': ready_status,
+    'stream_status': stream_status,
+    'openai_imported': 'openai' in sys.modules,
+    'modules': len(sys.modules),
+}))
+'''
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class Command(BaseCommand):
+    help = 'Measure worker cold-start time (interpreter to first served request)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help='Fresh interpreters to average over')
+        parser.add_argument('--top', type=int, default=10, help='Slowest top-level imports to list')
+        parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+        parser.add_argument('--compare-warmup', action='store_true',
+                            help='Run with warm-up off and on and compare the first stream request')
+
+    def run_probe(self, warmup=None):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'ContextLens.settings'))
+        if warmup is not None:
+            env['CONTEXTLENS_WARMUP'] = '1' if warmup else '0'
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f'Startup probe failed:\n{result.stderr[-2000:]}')
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+
+        # Cumulative time of top-level imports (no indentation in -X importtime)
+        imports = {}
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_RE.match(line)
+            if match and match.group(3) == ' ':
+                imports[match.group(4)] = int(match.group(2)) / 1000
+        report['imports'] = imports
+        return report
+
+    @staticmethod
+    def medians(runs) -> dict:
+        return {phase: statistics.median(run['timings'][phase] for run in runs) for phase in runs[0]['timings']}
+
+    def compare_warmup(self, options):
+        cold = [self.run_probe(warmup=False) for _ in range(options['repeat'])]
+        warm = [self.run_probe(warmup=True) for _ in range(options['repeat'])]
+        cold_ms, warm_ms = self.medians(cold), self.medians(warm)
+        if options['json']:
+            self.stdout.write(json.dumps({'cold_median_ms': cold_ms, 'warm_median_ms': warm_ms,
+                                          'cold_runs': cold, 'warm_runs': warm}, indent=2))
+            return
+        self.stdout.write(f"Warm-up off vs on (median of {options['repeat']} fresh interpreters each):")
+        self.stdout.write(f"  {'phase':<14} {'off':>9}    {'on':>9}")
+        for phase in cold_ms:
+            self.stdout.write(f'  {phase:<14} {cold_ms[phase]:9.1f} ms {warm_ms[phase]:9.1f} ms')
+        saved = cold_ms['first_stream'] - warm_ms['first_stream']
+        self.stdout.write(f"First stream request TTFT: {cold_ms['first_stream']:.1f} ms -> "
+                          f"{warm_ms['first_stream']:.1f} ms ({saved:+.1f} ms saved, "
+                          f"warm-up took {warm_ms['warmup']:.1f} ms before the worker accepted requests)")
+
+    def handle(self, *args, **options):
+        if options['compare_warmup']:
+            self.compare_warmup(options)
+            return
+        runs = [self.run_probe() for _ in range(options['repeat'])]
+
+        phases = list(runs[0]['timings'])
+        summary = self.medians(runs)
+        imports = {}
+        for run in runs:
+            for module, ms in run['imports'].items():
+                imports.setdefault(module, []).append(ms)
+        slowest = sorted(((statistics.median(v), k) for k, v in imports.items()), reverse=True)[:options['top']]
+
+        if options['json']:
+            self.stdout.write(json.dumps({'median_ms': summary, 'runs': runs}, indent=2))
+            return
+
+        self.stdout.write(f"Worker cold start (median of {len(runs)} fresh interpreters):")
+        for phase in phases:
+            self.stdout.write(f'  {phase:<14} {summary[phase]:9.1f} ms')
+        self.stdout.write(f"  healthz/readyz/stream status: {runs[0]['healthz_status']}/{runs[0]['readyz_status']}/"
+                          f"{runs[0]['stream_status']}, "
+                          f"modules loaded: {runs[0]['modules']}, "
+                          f"openai imported: {runs[0]['openai_imported']}")
+        self.stdout.write('Slowest top-level imports:')
+        for ms, module in slowest:
+            self.stdout.write(f'  {module:<40} {ms:9.1f} ms')
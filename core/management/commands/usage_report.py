@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.usage import ROLLUP_GROUPS, rollup
+
+COLUMNS = (
+    ('calls', 7), ('errors', 7), ('prompt_tokens', 14), ('cached_tokens', 14),
+    ('completion_tokens', 18), ('reasoning_tokens', 17), ('avg_ttft_ms', 12), ('avg_duration_ms', 16),
+)
+
+
+class Command(BaseCommand):
+    help = 'Summarise the usage ledger by hour, template or model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=sorted(ROLLUP_GROUPS), default='hour', help='Grouping')
+        parser.add_argument('--hours', type=float, default=24, help='Window to report on')
+        parser.add_argument('--json', action='store_true', help='Print raw JSON rows')
+
+    def handle(self, *args, **options):
+        try:
+            rows = rollup(options['by'], options['hours'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+        if not rows:
+            self.stdout.write(f"No upstream calls in the last {options['hours']:g}h")
+            return
+
+        group = options['by']
+        width = max(len(group), *(len(str(row[group])) for row in rows))
+        self.stdout.write(f'{group:<{width}} ' + ' '.join(f'{name:>{size}}' for name, size in COLUMNS))
+        for row in rows:
+            values = ' '.join(
+                f"{'-' if row[name] is None else row[name]:>{size}}" for name, size in COLUMNS
+            )
+            self.stdout.write(f'{str(row[group]):<{width}} {values}')
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisConfiguration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word_group_threshold', models.IntegerField(default=4, help_text='Number of words or fewer that constitute a word group (vs sentence)')),
+                ('sentence_threshold', models.IntegerField(default=20, help_text='Number of words or more that constitute a sentence for analysis purposes')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Analysis Configuration',
+                'verbose_name_plural': 'Analysis Configurations',
+            },
+        ),
+        migrations.CreateModel(
+            name='APIConfiguration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('api_key', models.CharField(max_length=500)),
+                ('base_url', models.URLField(default='https://api.openai.com/v1')),
+                ('model_name', models.CharField(default='gpt-4', max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PromptTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('template_type', models.CharField(choices=[('translation', 'Full Text Translation'), ('word_analysis', 'Word/Phrase Analysis'), ('sentence_analysis', 'Sentence Analysis')], max_length=20)),
+                ('prompt_text', models.TextField()),
+                ('reasoning_effort', models.CharField(choices=[('minimal', 'Minimal'), ('low', 'Low'), ('medium', 'Medium'), ('high', 'High')], default='low', max_length=10)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('api_config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.apiconfiguration')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=100, unique=True)),
+                ('current_text', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('analysis_prompt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='analysis_sessions', to='core.prompttemplate')),
+                ('translation_prompt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='translation_sessions', to='core.prompttemplate')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='prompttemplate',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('template_type',), name='unique_active_template_per_type'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='prompttemplate',
+            index=models.Index(fields=['template_type', 'is_active'], name='template_type_active_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('template_type', models.CharField(max_length=20)),
+                ('model', models.CharField(max_length=100)),
+                ('reasoning_effort', models.CharField(blank=True, max_length=10)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('reasoning_tokens', models.PositiveIntegerField(default=0)),
+                ('ttft_ms', models.FloatField(blank=True, null=True)),
+                ('duration_ms', models.FloatField()),
+                ('outcome', models.CharField(choices=[('ok', 'Completed'), ('error', 'Error'), ('cancelled', 'Cancelled')], default='ok', max_length=10)),
+                ('api_config', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.apiconfiguration')),
+                ('template', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.prompttemplate')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='usage_created_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_usage_records'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('handle', models.CharField(max_length=32, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('format', models.CharField(choices=[('text', 'Plain Text'), ('markdown', 'Markdown'), ('html', 'HTML'), ('epub', 'EPUB')], max_length=10)),
+                ('size_bytes', models.BigIntegerField(help_text='Size of the uploaded file')),
+                ('text_bytes', models.BigIntegerField(help_text='Size of the stored UTF-8 text')),
+                ('char_count', models.BigIntegerField()),
+                ('paragraph_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
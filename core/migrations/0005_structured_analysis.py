@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_documents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LexiconEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('headword', models.CharField(max_length=200)),
+                ('model', models.CharField(max_length=100)),
+                ('fields', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='output_format',
+            field=models.CharField(choices=[('markdown', 'Markdown'), ('structured', 'Structured (JSON schema)')], default='markdown', help_text='Structured output applies to word analysis templates only', max_length=10),
+        ),
+    ]
@@ -29,6 +29,12 @@ class PromptTemplate(models.Model):
         choices=[('minimal', 'Minimal'), ('low', 'Low'), ('medium', 'Medium'), ('high', 'High')],
         default='low'
     )
+    output_format = models.CharField(
+        max_length=10,
+        choices=[('markdown', 'Markdown'), ('structured', 'Structured (JSON schema)')],
+        default='markdown',
+        help_text="Structured output applies to word analysis templates only"
+    )
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -41,6 +47,10 @@ class PromptTemplate(models.Model):
                 name='unique_active_template_per_type'
             )
         ]
+        indexes = [
+            # Config snapshot / settings page: filter by type and active flag
+            models.Index(fields=['template_type', 'is_active'], name='template_type_active_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.get_template_type_display()})"
@@ -96,3 +106,69 @@ class AnalysisConfiguration(models.Model):
         if not config:
             config = cls.objects.create()
         return config
+
+
+class UsageRecord(models.Model):
+    """One upstream API call: tokens, latency and how it ended"""
+    OUTCOMES = [
+        ('ok', 'Completed'),
+        ('error', 'Error'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    created_at = models.DateTimeField()
+    template = models.ForeignKey(PromptTemplate, on_delete=models.SET_NULL, null=True, blank=True)
+    template_type = models.CharField(max_length=20)
+    api_config = models.ForeignKey(APIConfiguration, on_delete=models.SET_NULL, null=True, blank=True)
+    model = models.CharField(max_length=100)
+    reasoning_effort = models.CharField(max_length=10, blank=True)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    reasoning_tokens = models.PositiveIntegerField(default=0)
+    ttft_ms = models.FloatField(null=True, blank=True)
+    duration_ms = models.FloatField()
+    outcome = models.CharField(max_length=10, choices=OUTCOMES, default='ok')
+
+    class Meta:
+        indexes = [
+            # Rollups always filter on a time window
+            models.Index(fields=['created_at'], name='usage_created_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model} {self.template_type} ({self.outcome})"
+
+
+class Document(models.Model):
+    """An uploaded file, stored as normalized text plus a paragraph offset index"""
+    FORMATS = [
+        ('text', 'Plain Text'),
+        ('markdown', 'Markdown'),
+        ('html', 'HTML'),
+        ('epub', 'EPUB'),
+    ]
+
+    handle = models.CharField(max_length=32, unique=True)
+    name = models.CharField(max_length=255)
+    format = models.CharField(max_length=10, choices=FORMATS)
+    size_bytes = models.BigIntegerField(help_text="Size of the uploaded file")
+    text_bytes = models.BigIntegerField(help_text="Size of the stored UTF-8 text")
+    char_count = models.BigIntegerField()
+    paragraph_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.paragraph_count} paragraphs)"
+
+
+class LexiconEntry(models.Model):
+    """Context-independent fields of a structured word analysis (pronunciation, senses)"""
+    key = models.CharField(max_length=32, unique=True)
+    headword = models.CharField(max_length=200)
+    model = models.CharField(max_length=100)
+    fields = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.headword} ({self.model})"
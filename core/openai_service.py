@@ -1,40 +1,124 @@
-from typing import Dict, Generator
+import logging
+import threading
+import time
+from typing import Dict, Generator, Optional
 
-from openai import OpenAI, AsyncOpenAI
+from django.utils.functional import cached_property
 
+from .config_snapshot import get_snapshot
+from .latency import RouteDecision, is_reasoning_model, tracker
+from .profiling import phase, record as record_phase
+from .prompts import compiled
 from .models import APIConfiguration, PromptTemplate
+from .scheduler import dispatcher, priority_for
+from .segmentation import get_index
+from .structured import CONTEXT_ONLY_NOTE, FieldScanner, field_marker, response_schema, store_lexical
+from .usage import record as record_usage, usage_from_chat, usage_from_responses
+
+logger = logging.getLogger(__name__)
+
+DEMO_API_KEY = 'your-api-key-here'
+MAX_SHARED_CLIENTS = 32
+# Chunk sent when the output stopped at the route's token limit (see ``pipeline.iter_events``)
+TRUNCATED = '__TRUNCATED__'
+
+_clients = {}
+_clients_lock = threading.Lock()
+# (base_url, model) pairs whose endpoint has no responses API
+_no_responses_api = set()
+# base_urls whose chat completions endpoint rejects ``stream_options``
+_no_stream_usage = set()
+
+
+def has_api_key(config: APIConfiguration) -> bool:
+    """False for configurations that run in demo mode"""
+    return bool(config.api_key) and config.api_key != DEMO_API_KEY
+
+
+def shared_client(config: APIConfiguration):
+    """
+    The sync client for an endpoint and key, shared by every request so its
+    connection pool (DNS, TCP and TLS setup) is paid for once per worker.
+    """
+    key = (config.base_url, config.api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                from openai import OpenAI
+                if len(_clients) >= MAX_SHARED_CLIENTS:
+                    # Keys and URLs that were edited away; in-flight users keep their reference
+                    _clients.pop(next(iter(_clients)))
+                client = _clients[key] = OpenAI(api_key=config.api_key, base_url=config.base_url)
+    return client
+
+
+def close_shared_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def responses_api_supported(config: APIConfiguration, model: str) -> bool:
+    return (config.base_url, model) not in _no_responses_api
+
+
+def mark_responses_api_unsupported(config: APIConfiguration, model: str):
+    """Send later reasoning-model calls for this endpoint straight to chat completions"""
+    _no_responses_api.add((config.base_url, model))
+
+
+def stream_usage_supported(config: APIConfiguration) -> bool:
+    return config.base_url not in _no_stream_usage
 
 
 class OpenAIService:
     def __init__(self, api_config: APIConfiguration):
         self.config = api_config
-        # Use synchronous client for Django sync views
-        self.client = OpenAI(
-            api_key=api_config.api_key,
-            base_url=api_config.base_url
-        )
-        # Keep async client for future use
-        self.async_client = AsyncOpenAI(
-            api_key=api_config.api_key,
-            base_url=api_config.base_url
+
+    # The openai SDK is imported and clients are built on first use, so
+    # importing this module (and booting a worker) stays cheap and demo-mode
+    # requests never construct a client at all.
+    @cached_property
+    def client(self):
+        """Synchronous client for Django sync views (shared per endpoint, see ``shared_client``)"""
+        with phase('client_setup'):
+            return shared_client(self.config)
+
+    @cached_property
+    def async_client(self):
+        """Async client, kept for future use"""
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(
+            api_key=self.config.api_key,
+            base_url=self.config.base_url
         )
 
     def _is_reasoning_model(self, model_name: str) -> bool:
         """Check if the model is a reasoning model that requires responses API"""
-        reasoning_prefixes = ('o1', 'o3', 'o4', 'gpt-5')
-        return any(model_name.startswith(prefix) for prefix in reasoning_prefixes)
+        return is_reasoning_model(model_name)
 
     def _prepare_prompt(self, template: PromptTemplate, all_input: str = "", input_select: str = "") -> str:
         """Prepare prompt by substituting placeholders"""
-        prompt = template.prompt_text
-        prompt = prompt.replace('{all_input}', all_input)
-        prompt = prompt.replace('{input_select}', input_select)
-        return prompt
+        return compiled(template).render(all_input=all_input, input_select=input_select)
 
-    def get_translation_sync(self, template: PromptTemplate, text: str) -> str:
-        """Get full text translation synchronously"""
-        prompt = self._prepare_prompt(template, all_input=text)
+    def _complete_sync(self, template: PromptTemplate, prompt: str) -> str:
+        """Single non-streaming chat completion behind the dispatcher"""
+        try:
+            with dispatcher.slot(priority_for(template.template_type)) as waited_ms:
+                record_phase('upstream_queue', waited_ms / 1000)
+                with phase('upstream'):
+                    return self._complete_measured(template, prompt)
+        except Exception as e:
+            return f"Error: {str(e)}"
 
+    def _complete_measured(self, template: PromptTemplate, prompt: str) -> str:
+        started = time.perf_counter()
+        usage = {}
+        outcome = 'error'
         try:
             response = self.client.chat.completions.create(
                 model=template.api_config.model_name,
@@ -43,30 +127,229 @@ class OpenAIService:
                     "content": prompt
                 }]
             )
+            usage = usage_from_chat(response.usage)
+            outcome = 'ok'
             return response.choices[0].message.content
-        except Exception as e:
-            return f"Error: {str(e)}"
+        finally:
+            record_usage(template, template.api_config.model_name, template.reasoning_effort, usage,
+                         ttft_ms=None, duration_ms=(time.perf_counter() - started) * 1000, outcome=outcome)
+
+    def get_translation_sync(self, template: PromptTemplate, text: str) -> str:
+        """Get full text translation synchronously"""
+        prompt = self._prepare_prompt(template, all_input=text)
+        return self._complete_sync(template, prompt)
 
     def get_word_analysis_sync(self, template: PromptTemplate, all_text: str, selected_text: str) -> str:
         """Get word/phrase analysis synchronously"""
         prompt = self._prepare_prompt(template, all_input=all_text, input_select=selected_text)
+        return self._complete_sync(template, prompt)
+
+    def _stream_upstream(self, prompt: str, route: RouteDecision, label: str, prompt_tokens: int = 0,
+                         template: Optional[PromptTemplate] = None, priority: Optional[str] = None,
+                         json_schema: Optional[dict] = None) -> Generator[str, None, None]:
+        """Stream a prompt from the upstream API as routed, recording TTFT and usage"""
+        # Queue for an upstream slot first; TTFT is measured from the grant
+        priority = priority or priority_for(route.tier)
+        with dispatcher.slot(priority) as waited_ms:
+            record_phase('upstream_queue', waited_ms / 1000)
+            yield from self._stream_measured(prompt, route, label, prompt_tokens, template, json_schema)
+
+    def _stream_measured(self, prompt: str, route: RouteDecision, label: str, prompt_tokens: int,
+                         template: Optional[PromptTemplate],
+                         json_schema: Optional[dict] = None) -> Generator[str, None, None]:
+        started = time.perf_counter()
+        first_chunk_at = None
+        usage = {}
+        outcome = 'error'
+        tracker.begin(route.model)
+        try:
+            for chunk in self._stream_routed(prompt, route, label, usage, json_schema):
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                    tracker.observe(route.model, (first_chunk_at - started) * 1000, prompt_tokens)
+                    record_phase('upstream_ttft', first_chunk_at - started)
+                yield chunk
+            outcome = 'ok'
+        except GeneratorExit:
+            outcome = 'cancelled'
+            raise
+        finally:
+            tracker.end(route.model)
+            record_phase('upstream', time.perf_counter() - started)
+            if template is not None:
+                record_usage(
+                    template, route.model, route.reasoning_effort, usage,
+                    ttft_ms=(first_chunk_at - started) * 1000 if first_chunk_at is not None else None,
+                    duration_ms=(time.perf_counter() - started) * 1000,
+                    outcome=outcome,
+                )
 
+    def _stream_routed(self, prompt: str, route: RouteDecision, label: str, usage: dict,
+                       json_schema: Optional[dict] = None) -> Generator[str, None, None]:
+        """
+        Yield output chunks; token counts reported by the API are stored in
+        ``usage``. With ``json_schema`` the output is constrained to it.
+        """
+        # Check if this is a reasoning model (o1, o3, o4, gpt-5)
+        is_reasoning_model = self._is_reasoning_model(route.model)
+
+        if is_reasoning_model and responses_api_supported(self.config, route.model):
+            # For reasoning models, use responses API
+            yielded = False
+            try:
+                logger.debug('%s via responses API', label, extra={'model': route.model})
+                options = {}
+                if route.max_output_tokens:
+                    options['max_output_tokens'] = route.max_output_tokens
+                stream = self.client.responses.create(
+                    model=route.model,
+                    input=[{
+                        "role": "developer",
+                        "content": [{
+                            "type": "input_text",
+                            "text": prompt
+                        }]
+                    }],
+                    text={
+                        "format": {"type": "json_schema", **json_schema} if json_schema else {"type": "text"},
+                        "verbosity": route.verbosity
+                    },
+                    reasoning={
+                        "effort": route.reasoning_effort,
+                        "summary": "auto"
+                    },
+                    tools=[],
+                    store=route.store,
+                    stream=True,
+                    **options
+                )
+
+                for chunk in self._responses_chunks(stream, route, label, usage):
+                    yielded = True
+                    yield chunk
+
+            except Exception as responses_error:
+                if yielded:
+                    # Part of the answer is already out; a chat completion
+                    # would repeat it, so surface the error instead
+                    raise
+                logger.warning('%s: responses API failed (%s), falling back to chat completions',
+                               label, responses_error, extra={'model': route.model})
+                if getattr(responses_error, 'status_code', None) in (404, 405):
+                    mark_responses_api_unsupported(self.config, route.model)
+                # Fallback to chat completions
+                yield from self._complete_via_chat(prompt, route, usage, json_schema)
+
+        elif is_reasoning_model:
+            # Endpoint known to lack the responses API: skip the failing attempt
+            yield from self._complete_via_chat(prompt, route, usage, json_schema)
+
+        else:
+            # For regular models, use standard streaming
+            options = {}
+            if route.max_output_tokens:
+                options['max_tokens'] = route.max_output_tokens
+            if json_schema:
+                options['response_format'] = {"type": "json_schema", "json_schema": json_schema}
+            stream = self._create_chat_stream(prompt, route, options)
+
+            finish_reason = None
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage.update(usage_from_chat(chunk.usage))
+                if chunk.choices:
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    if chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            if finish_reason == 'length':
+                logger.warning('%s stopped at the output token limit', label,
+                               extra={'model': route.model, 'max_output_tokens': route.max_output_tokens})
+                yield TRUNCATED
+
+    def _responses_chunks(self, stream, route: RouteDecision, label: str,
+                          usage: dict) -> Generator[str, None, None]:
+        """Map responses API stream events to output chunks"""
+        for event in stream:
+            # Handle reasoning summary text delta events
+            if hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.delta':
+                if hasattr(event, 'delta') and event.delta:
+                    # Send each delta as thinking content
+                    yield f"__THINKING__:{event.delta}"
+
+            # Handle reasoning summary done events
+            elif hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.done':
+                logger.debug('%s thinking done', label)
+                yield "__THINKING_DONE__"
+
+            # Final event carries the token usage
+            elif hasattr(event, 'type') and event.type == 'response.completed':
+                usage.update(usage_from_responses(getattr(event.response, 'usage', None)))
+
+            # Stopped early; with reason max_output_tokens the route's cap was hit
+            elif hasattr(event, 'type') and event.type == 'response.incomplete':
+                usage.update(usage_from_responses(getattr(event.response, 'usage', None)))
+                details = getattr(event.response, 'incomplete_details', None)
+                if getattr(details, 'reason', None) == 'max_output_tokens':
+                    logger.warning('%s stopped at the output token limit', label,
+                                   extra={'model': route.model, 'max_output_tokens': route.max_output_tokens})
+                    yield TRUNCATED
+
+            # Handle regular output text delta events
+            elif hasattr(event, 'type') and event.type == 'response.output_text.delta':
+                if hasattr(event, 'delta') and hasattr(event, 'output_index'):
+                    if event.output_index == 1:  # Final output content only
+                        yield event.delta
+            elif hasattr(event, 'delta') and event.delta:
+                # Fallback for events without output_index (likely final output)
+                yield event.delta
+
+    def _create_chat_stream(self, prompt: str, route: RouteDecision, options: dict):
+        """Open a chat completions stream, asking for usage where the endpoint allows it"""
+        messages = [{"role": "user", "content": prompt}]
+        if not stream_usage_supported(self.config):
+            return self.client.chat.completions.create(model=route.model, messages=messages, stream=True,
+                                                       **options)
         try:
-            response = self.client.chat.completions.create(
-                model=template.api_config.model_name,
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
-            )
-            return response.choices[0].message.content
+            # The last chunk (with empty choices) then reports token usage
+            return self.client.chat.completions.create(model=route.model, messages=messages, stream=True,
+                                                       stream_options={"include_usage": True}, **options)
         except Exception as e:
-            return f"Error: {str(e)}"
-
-    def stream_translation_sync(self, template: PromptTemplate, text: str) -> Generator[str, None, None]:
+            # Many OpenAI-compatible servers answer 400 to the unknown parameter
+            if getattr(e, 'status_code', None) != 400:
+                raise
+            stream = self.client.chat.completions.create(model=route.model, messages=messages, stream=True,
+                                                         **options)
+            logger.warning('%s rejects stream_options (%s); streaming without usage', self.config.base_url, e)
+            _no_stream_usage.add(self.config.base_url)
+            return stream
+
+    def _complete_via_chat(self, prompt: str, route: RouteDecision, usage: dict,
+                           json_schema: Optional[dict] = None) -> Generator[str, None, None]:
+        """Non-streaming chat completion for reasoning models, re-chunked"""
+        options = {}
+        if json_schema:
+            options['response_format'] = {"type": "json_schema", "json_schema": json_schema}
+        response = self.client.chat.completions.create(
+            model=route.model,
+            messages=[{"role": "user", "content": prompt}],
+            **options
+        )
+        usage.update(usage_from_chat(response.usage))
+        content = response.choices[0].message.content
+        # Simulate streaming
+        chunk_size = 10
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+        if response.choices[0].finish_reason == 'length':
+            yield TRUNCATED
+
+    def stream_translation_sync(self, template: PromptTemplate, text: str,
+                                route: Optional[RouteDecision] = None,
+                                priority: Optional[str] = None) -> Generator[str, None, None]:
         """Stream translation response synchronously"""
-        print(
-            f"🚀 Translation Request - Model: {template.api_config.model_name}, Reasoning Effort: {template.reasoning_effort}")
+        route = route or RouteDecision.from_template(template)
+        logger.info('translation request', extra={
+            'model': route.model, 'reasoning_effort': route.reasoning_effort, 'chars': len(text)})
         prompt = self._prepare_prompt(template, all_input=text)
 
         try:
@@ -74,110 +357,28 @@ class OpenAIService:
             if not self.config.api_key or self.config.api_key == 'your-api-key-here':
                 # Demo mode - simulate streaming response
                 demo_response = f"[Demo模式] 输入文本的中文翻译：\\n\\n{text}\\n\\n请在设置中配置您的OpenAI API密钥以获得真实翻译。"
-                import time
                 for i in range(0, len(demo_response), 5):
                     chunk = demo_response[i:i + 5]
                     yield chunk
                     time.sleep(0.05)  # Simulate network delay
                 return
 
-            # Check if this is a reasoning model (o1, o3, o4, gpt-5)
-            is_reasoning_model = self._is_reasoning_model(template.api_config.model_name)
-
-            if is_reasoning_model:
-                # For reasoning models, use responses API
-                try:
-                    print(f"Using reasoning model: {template.api_config.model_name}")
-                    stream = self.client.responses.create(
-                        model=template.api_config.model_name,
-                        input=[{
-                            "role": "developer",
-                            "content": [{
-                                "type": "input_text",
-                                "text": prompt
-                            }]
-                        }],
-                        text={
-                            "format": {"type": "text"},
-                            "verbosity": "medium"
-                        },
-                        reasoning={
-                            "effort": template.reasoning_effort or "minimal",
-                            "summary": "auto"
-                        },
-                        tools=[],
-                        store=True,
-                        stream=True
-                    )
-
-                    thinking_content = ""
-                    last_reasoning_line = ""
-                    
-                    for event in stream:
-                        # print(f"Translation Event: {type(event).__name__} - {getattr(event, 'type', 'unknown')}")
-                        
-                        # Handle reasoning summary text delta events
-                        if hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.delta':
-                            if hasattr(event, 'delta') and event.delta:
-                                thinking_content += event.delta
-                                # print(f"Translation Thinking delta: {repr(event.delta)}")
-                                # Send each delta as thinking content
-                                yield f"__THINKING__:{event.delta}"
-                        
-                        # Handle reasoning summary done events
-                        elif hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.done':
-                            print("Translation Thinking done, sending reset signal")
-                            yield "__THINKING_DONE__"
-                                
-                        # Handle regular output text delta events  
-                        elif hasattr(event, 'type') and event.type == 'response.output_text.delta':
-                            if hasattr(event, 'delta') and hasattr(event, 'output_index'):
-                                # print(f"Translation Output delta - index: {event.output_index}, delta: {repr(event.delta)}")
-                                if event.output_index == 1:  # Final output content only
-                                    yield event.delta
-                        elif hasattr(event, 'delta') and event.delta:
-                            # print(f"Translation Fallback delta: {repr(event.delta)}")
-                            # Fallback for events without output_index (likely final output)
-                            yield event.delta
-
-                except Exception as responses_error:
-                    print(f"Responses API failed: {responses_error}")
-                    # Fallback to chat completions
-                    response = self.client.chat.completions.create(
-                        model=template.api_config.model_name,
-                        messages=[{"role": "user", "content": prompt}]
-                    )
-                    content = response.choices[0].message.content
-                    # Simulate streaming
-                    chunk_size = 10
-                    for i in range(0, len(content), chunk_size):
-                        yield content[i:i + chunk_size]
-
-            else:
-                # For regular models, use standard streaming
-                stream = self.client.chat.completions.create(
-                    model=template.api_config.model_name,
-                    messages=[{
-                        "role": "user",
-                        "content": prompt
-                    }],
-                    stream=True
-                )
-
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
+            yield from self._stream_upstream(prompt, route, 'Translation', get_index(text).approx_tokens(),
+                                             template, priority)
 
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             yield error_msg
 
-    def stream_word_analysis_sync(self, template: PromptTemplate, all_text: str, selected_text: str, is_sentence: bool = False) -> Generator[
-        str, None, None]:
+    def stream_word_analysis_sync(self, template: PromptTemplate, all_text: str, selected_text: str, is_sentence: bool = False,
+                                  route: Optional[RouteDecision] = None,
+                                  priority: Optional[str] = None) -> Generator[str, None, None]:
         """Stream word/phrase analysis response synchronously"""
+        route = route or RouteDecision.from_template(template)
         analysis_type = "Sentence" if is_sentence else "Word/Phrase"
-        print(
-            f"🔍 {analysis_type} Analysis Request - Model: {template.api_config.model_name}, Reasoning Effort: {template.reasoning_effort}, Selected: '{selected_text}'")
+        logger.info('analysis request', extra={
+            'kind': analysis_type, 'model': route.model, 'reasoning_effort': route.reasoning_effort,
+            'selected': selected_text[:200]})
         prompt = self._prepare_prompt(template, all_input=all_text, input_select=selected_text)
 
         try:
@@ -214,98 +415,66 @@ class OpenAIService:
 6. **语境含义**: 在当前文章中，该词表示...
 
 请在设置中配置您的OpenAI API密钥以获得详细的词汇分析。"""
-                import time
                 for i in range(0, len(demo_response), 8):
                     chunk = demo_response[i:i + 8]
                     yield chunk
                     time.sleep(0.03)
                 return
 
-            # Check if this is a reasoning model (o1, o3, o4, gpt-5)
-            is_reasoning_model = self._is_reasoning_model(template.api_config.model_name)
+            yield from self._stream_upstream(prompt, route, 'Analysis', get_index(all_text).approx_tokens(),
+                                             template, priority)
 
-            if is_reasoning_model:
-                # For reasoning models, use responses API
-                try:
-                    print(f"Using reasoning model for analysis: {template.api_config.model_name}")
-                    stream = self.client.responses.create(
-                        model=template.api_config.model_name,
-                        input=[{
-                            "role": "developer",
-                            "content": [{
-                                "type": "input_text",
-                                "text": prompt
-                            }]
-                        }],
-                        text={
-                            "format": {"type": "text"},
-                            "verbosity": "medium"
-                        },
-                        reasoning={
-                            "effort": template.reasoning_effort or "minimal",
-                            "summary": "auto"
-                        },
-                        tools=[],
-                        store=True,
-                        stream=True
-                    )
-
-                    thinking_content = ""
-                    last_reasoning_line = ""
-                    
-                    for event in stream:
-                        # print(f"Analysis Event: {type(event).__name__} - {getattr(event, 'type', 'unknown')}")
-                        
-                        # Handle reasoning summary text delta events
-                        if hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.delta':
-                            if hasattr(event, 'delta') and event.delta:
-                                thinking_content += event.delta
-                                # print(f"Analysis Thinking delta: {repr(event.delta)}")
-                                # Send each delta as thinking content
-                                yield f"__THINKING__:{event.delta}"
-                        
-                        # Handle reasoning summary done events
-                        elif hasattr(event, 'type') and event.type == 'response.reasoning_summary_text.done':
-                            print("Analysis Thinking done, sending reset signal")
-                            yield "__THINKING_DONE__"
-                                
-                        # Handle regular output text delta events
-                        elif hasattr(event, 'type') and event.type == 'response.output_text.delta':
-                            if hasattr(event, 'delta') and hasattr(event, 'output_index'):
-                                # print(f"Analysis Output delta - index: {event.output_index}, delta: {repr(event.delta)}")
-                                if event.output_index == 1:  # Final output content only
-                                    yield event.delta
-                        elif hasattr(event, 'delta') and event.delta:
-                            # print(f"Analysis Fallback delta: {repr(event.delta)}")
-                            # Fallback for events without output_index (likely final output)
-                            yield event.delta
-
-                except Exception as responses_error:
-                    print(f"Responses API failed: {responses_error}")
-                    # Fallback to chat completions
-                    response = self.client.chat.completions.create(
-                        model=template.api_config.model_name,
-                        messages=[{"role": "user", "content": prompt}]
-                    )
-                    content = response.choices[0].message.content
-                    chunk_size = 10
-                    for i in range(0, len(content), chunk_size):
-                        yield content[i:i + chunk_size]
+        except Exception as e:
+            error_msg = f"Error: {str(e)}"
+            yield error_msg
 
-            else:
-                # For regular models, use standard streaming
-                stream = self.client.chat.completions.create(
-                    model=template.api_config.model_name,
-                    messages=[{
-                        "role": "user",
-                        "content": prompt
-                    }],
-                    stream=True
-                )
+    def stream_structured_analysis_sync(self, template: PromptTemplate, all_text: str, selected_text: str,
+                                        lexical: Optional[dict] = None, route: Optional[RouteDecision] = None,
+                                        priority: Optional[str] = None) -> Generator[str, None, None]:
+        """Stream a word analysis as JSON fields; known dictionary fields (``lexical``) are not regenerated"""
+        route = route or RouteDecision.from_template(template)
+        logger.info('structured analysis request', extra={
+            'model': route.model, 'reasoning_effort': route.reasoning_effort,
+            'selected': selected_text[:200], 'lexicon_hit': lexical is not None})
+        if lexical:
+            for name, value in lexical.items():
+                yield field_marker(name, value, cached=True)
+        prompt = self._prepare_prompt(template, all_input=all_text, input_select=selected_text)
+        if lexical:
+            prompt += CONTEXT_ONLY_NOTE
 
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        yield chunk.choices[0].delta.content
+        try:
+            # Check if this is a test/demo mode (API key not properly set)
+            if not self.config.api_key or self.config.api_key == 'your-api-key-here':
+                demo_fields = {
+                    'headword': selected_text,
+                    'ipa': '请配置API密钥获取准确发音',
+                    'senses': [{'pos': 'n.', 'meaning': '示例定义1'}, {'pos': 'v.', 'meaning': '示例定义2'}],
+                    'sentence': 'Example sentence from the text.',
+                    'sentence_translation': '[Demo模式] 文中例句的中文翻译',
+                    'contextual_meaning': f'在当前文章中，"{selected_text}" 表示...',
+                }
+                for name, value in demo_fields.items():
+                    if lexical and name in lexical:
+                        continue
+                    time.sleep(0.1)
+                    yield field_marker(name, value)
+                return
+
+            scanner = FieldScanner()
+            fields = {}
+            truncated = False
+            for chunk in self._stream_upstream(prompt, route, 'Analysis', get_index(all_text).approx_tokens(),
+                                               template, priority, json_schema=response_schema(lexical is None)):
+                if chunk.startswith('__THINKING__:') or chunk in ('__THINKING_DONE__', TRUNCATED):
+                    truncated = truncated or chunk == TRUNCATED
+                    yield chunk
+                    continue
+                for name, value in scanner.feed(chunk):
+                    fields[name] = value
+                    yield field_marker(name, value)
+            if lexical is None and not truncated:
+                store_lexical(template, route.model, selected_text, fields)
 
         except Exception as e:
             error_msg = f"Error: {str(e)}"
@@ -405,33 +574,7 @@ class OpenAIService:
 
 def get_active_templates() -> Dict[str, PromptTemplate]:
     """Get currently active templates for translation, word analysis, and sentence analysis"""
-    templates = {}
-    try:
-        translation_template = PromptTemplate.objects.filter(
-            template_type='translation',
-            is_active=True
-        ).first()
-        if translation_template:
-            templates['translation'] = translation_template
-
-        analysis_template = PromptTemplate.objects.filter(
-            template_type='word_analysis',
-            is_active=True
-        ).first()
-        if analysis_template:
-            templates['word_analysis'] = analysis_template
-            
-        sentence_template = PromptTemplate.objects.filter(
-            template_type='sentence_analysis',
-            is_active=True
-        ).first()
-        if sentence_template:
-            templates['sentence_analysis'] = sentence_template
-
-    except Exception:
-        pass
-
-    return templates
+    return dict(get_snapshot().templates)
 
 
 def create_openai_service(template: PromptTemplate) -> OpenAIService:
@@ -0,0 +1,275 @@
+"""
+Transport-independent stream pipeline.
+
+``prepare_translation`` / ``prepare_analysis`` validate a request, pick the
+active template and latency route, and return a ``PreparedStream`` whose
+``chunks()`` generator talks to the upstream service. ``iter_events`` turns
+those raw chunks into the event dicts every transport sends (``thinking``,
+``thinking_done``, ``content``, ``field``, ``truncated``, ``semantic_cache``,
+``error``, ``done``, and the paragraph events of viewport-ordered
+translations). The SSE views and the
+WebSocket endpoint both use these, so they behave identically.
+
+Before anything is sent upstream the rendered prompt is counted against the
+model's context window (``core.tokens.plan``): oversized translations are
+sent in chunks, oversized analyses with a narrowed context, and prompts that
+cannot fit are rejected with 413. Sentence analyses may instead be
+replayed from the semantic cache (``core.semantic_cache``).
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import semantic_cache
+from .config_snapshot import get_snapshot
+from .documents import IngestError, document_text
+from .latency import RouteDecision, choose_route
+from .log import chunk_sampled
+from .models import PromptTemplate
+from .openai_service import TRUNCATED, create_openai_service
+from .profiling import active as active_profile, phase
+from .segmentation import get_index, selection_word_count
+from .structured import FIELD_PREFIX, cached_lexical
+from .tokens import CHUNKED, WINDOWED, ContextOverflow, plan
+from .viewport import (PARAGRAPH_PREFIX, PARAGRAPHS, ParagraphSchedule, split_paragraphs, translate_paragraphs,
+                       visible_range)
+
+THINKING_PREFIX = '__THINKING__:'
+THINKING_DONE = '__THINKING_DONE__'
+NO_RESPONSE_MESSAGE = 'No response received from API. Check your API key and model settings.'
+TRUNCATED_MESSAGE = 'The model stopped at its output token limit; the result is incomplete.'
+
+logger = logging.getLogger(__name__)
+
+
+class StreamRequestError(Exception):
+    """A stream request that cannot be served; maps to an HTTP error status"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@dataclass
+class PreparedStream:
+    template: PromptTemplate
+    route: RouteDecision
+    chunks: Callable[[], Iterator[str]]
+    prompt_tokens: int = 0
+    meta: Dict[str, object] = field(default_factory=dict)
+    # Viewport-ordered translations: takes scroll updates while streaming
+    schedule: Optional[ParagraphSchedule] = None
+
+
+def _document_text(data: dict) -> str:
+    try:
+        return document_text(data)
+    except IngestError as e:
+        raise StreamRequestError(e.message, e.status)
+
+
+def translation_text(data: dict) -> str:
+    """Inline ``text``, or with ``document`` the text of a stored paragraph range"""
+    if data.get('document'):
+        return _document_text(data)
+    return data.get('text', '')
+
+
+def analysis_texts(data: dict) -> Tuple[str, str]:
+    """(all_text, selected_text); ``all_text`` may come from a stored paragraph range"""
+    all_text = _document_text(data) if data.get('document') else data.get('all_text', '')
+    return all_text, data.get('selected_text', '')
+
+
+def _plan(template, route, all_input: str, input_select: str = '', selection_span=None):
+    try:
+        return plan(template, route, all_input, input_select, selection_span)
+    except ContextOverflow as e:
+        raise StreamRequestError(str(e), status=413)
+
+
+def _chunked_translation(service, template: PromptTemplate, text: str, spans, route,
+                         priority: Optional[str] = None) -> Iterator[str]:
+    """Translate ``text`` piece by piece, keeping the breaks between pieces"""
+    pieces: List[str] = [text[start:end] for start, end in spans]
+    for number, piece in enumerate(pieces):
+        if number:
+            gap = pieces[number - 1][len(pieces[number - 1].rstrip()):]
+            yield '\n\n' if '\n' in gap else ' '
+        for chunk in service.stream_translation_sync(template, piece.strip(), route=route, priority=priority):
+            yield chunk
+            if chunk.startswith('Error:'):
+                return
+
+
+def _paragraph_translator(service, template: PromptTemplate, route):
+    """``translate(paragraph, priority)`` for ``translate_paragraphs``"""
+    def translate(paragraph: str, priority: str) -> Iterator[str]:
+        paragraph_plan = _plan(template, route, paragraph)
+        if paragraph_plan.strategy == CHUNKED:
+            yield from _chunked_translation(service, template, paragraph, paragraph_plan.spans, route, priority)
+        else:
+            yield from service.stream_translation_sync(template, paragraph, route=route, priority=priority)
+    return translate
+
+
+def prepare_translation(text: str, hint: Optional[dict] = None) -> PreparedStream:
+    """
+    Resolve the template and route for a full-text translation.
+
+    With ``hint`` ``{"order": "viewport", "visible": [first, last]}`` the
+    paragraphs are translated in viewport order (see ``core.viewport``).
+    """
+    if not text.strip():
+        raise StreamRequestError('No text provided')
+
+    with phase('config'):
+        templates = get_snapshot().templates
+    if 'translation' not in templates:
+        raise StreamRequestError('No active translation template found. Please configure API settings first.')
+
+    template = templates['translation']
+    route = choose_route(template, prompt_tokens=get_index(text).approx_tokens())
+    with phase('preflight'):
+        prompt_plan = _plan(template, route, text)
+
+    # Note: API key check is now handled in the service layer to allow demo mode
+    with phase('service_setup'):
+        service = create_openai_service(template)
+    paragraphs = split_paragraphs(text) if hint and hint.get('order') == 'viewport' else []
+    if len(paragraphs) > 1:
+        schedule = ParagraphSchedule(len(paragraphs), visible_range(hint, len(paragraphs)) or (0, 0))
+        translate = _paragraph_translator(service, template, route)
+        estimate = prompt_plan.estimate
+        return PreparedStream(
+            template=template,
+            route=route,
+            chunks=lambda: translate_paragraphs(paragraphs, schedule, translate),
+            # Every paragraph is sent with its own copy of the template
+            prompt_tokens=estimate.input_tokens + len(paragraphs) * estimate.template_tokens,
+            meta={**prompt_plan.meta, 'strategy': PARAGRAPHS, 'chunks': len(paragraphs),
+                  'visible': list(schedule.visible)},
+            schedule=schedule,
+        )
+    if prompt_plan.strategy == CHUNKED:
+        chunks = lambda: _chunked_translation(service, template, text, prompt_plan.spans, route)
+    else:
+        chunks = lambda: service.stream_translation_sync(template, text, route=route)
+    return PreparedStream(
+        template=template,
+        route=route,
+        chunks=chunks,
+        prompt_tokens=min(prompt_plan.estimate.prompt_tokens, prompt_plan.budget),
+        meta=prompt_plan.meta,
+    )
+
+
+def prepare_analysis(all_text: str, selected_text: str) -> PreparedStream:
+    """Classify the selection and resolve the template and route for its analysis"""
+    if not all_text.strip() or not selected_text.strip():
+        raise StreamRequestError('No text or selection provided')
+
+    with phase('config'):
+        snapshot = get_snapshot()
+    templates = snapshot.templates
+    # 使用配置的阈值判断是句子还是词汇/短语（基于选中文本分词，支持中日文）
+    selected_words = selection_word_count(selected_text)
+    is_sentence = selected_words > snapshot.word_group_threshold
+
+    if is_sentence:
+        # 句子分析
+        if 'sentence_analysis' not in templates:
+            raise StreamRequestError(
+                'No active sentence analysis template found. Please configure API settings first.')
+        template = templates['sentence_analysis']
+    else:
+        # 单词/短语分析
+        if 'word_analysis' not in templates:
+            raise StreamRequestError(
+                'No active word analysis template found. Please configure API settings first.')
+        template = templates['word_analysis']
+
+    index = get_index(all_text)
+    route = choose_route(
+        template,
+        prompt_tokens=index.approx_tokens(),
+        selection_words=selected_words,
+        sentence_threshold=snapshot.sentence_threshold,
+    )
+    with phase('preflight'):
+        prompt_plan = _plan(template, route, all_text, selected_text, index.locate(all_text, selected_text))
+    if prompt_plan.strategy == WINDOWED:
+        start, end = prompt_plan.spans[0]
+        all_text = all_text[start:end]
+
+    meta = {'analysis_type': template.template_type, 'config_version': snapshot.version, **prompt_plan.meta}
+
+    # Note: API key check is now handled in the service layer to allow demo mode
+    with phase('service_setup'):
+        service = create_openai_service(template)
+    if template.template_type == 'word_analysis' and template.output_format == 'structured':
+        with phase('lexicon'):
+            lexical = cached_lexical(template, route.model, selected_text)
+        meta.update(output_format='structured', lexicon_hit=lexical is not None)
+        chunks = lambda: service.stream_structured_analysis_sync(template, all_text, selected_text, lexical,
+                                                                 route=route)
+    else:
+        chunks = lambda: service.stream_word_analysis_sync(template, all_text, selected_text, is_sentence,
+                                                           route=route)
+    if semantic_cache.usable(template):
+        # Looked up once the stream is admitted: it costs an embeddings call
+        fresh = chunks
+        chunks = lambda: semantic_cache.cached_chunks(template, selected_text, fresh)
+    return PreparedStream(
+        template=template,
+        route=route,
+        chunks=chunks,
+        prompt_tokens=min(prompt_plan.estimate.prompt_tokens, prompt_plan.budget),
+        meta=meta,
+    )
+
+
+def iter_events(chunks: Iterable[str]) -> Iterator[dict]:
+    """Map raw service chunks to stream events, always ending with ``done``"""
+    try:
+        chunk_count = 0
+        for chunk in chunks:
+            if chunk.startswith(semantic_cache.CACHE_PREFIX):
+                yield {'type': 'semantic_cache', **json.loads(chunk[len(semantic_cache.CACHE_PREFIX):])}
+                continue
+            chunk_count += 1
+            if logger.isEnabledFor(logging.DEBUG) and chunk_sampled(chunk_count):
+                logger.debug('stream chunk', extra={'chunk': chunk_count, 'chars': len(chunk)})
+            # Check if this is thinking content
+            if chunk.startswith(THINKING_PREFIX):
+                yield {'content': chunk[len(THINKING_PREFIX):], 'type': 'thinking'}
+            elif chunk == THINKING_DONE:
+                yield {'type': 'thinking_done'}
+            elif chunk == TRUNCATED:
+                yield {'content': TRUNCATED_MESSAGE, 'type': 'truncated'}
+            elif chunk.startswith(FIELD_PREFIX):
+                yield {'type': 'field', **json.loads(chunk[len(FIELD_PREFIX):])}
+            elif chunk.startswith(PARAGRAPH_PREFIX):
+                yield json.loads(chunk[len(PARAGRAPH_PREFIX):])
+            else:
+                yield {'content': chunk, 'type': 'content'}
+
+        logger.debug('stream done', extra={'chunks': chunk_count})
+        if chunk_count == 0:
+            yield {'content': NO_RESPONSE_MESSAGE, 'type': 'error'}
+
+        yield {'type': 'done'}
+    except Exception as e:
+        logger.warning('stream failed: %s', e, exc_info=True)
+        yield {'content': f'Stream error: {str(e)}', 'type': 'error'}
+        yield {'type': 'done'}
+
+
+def sse_frame(event: dict) -> str:
+    """Encode one event as a server-sent-events frame"""
+    if active_profile() is None:
+        return f"data: {json.dumps(event)}\n\n"
+    with phase('encode'):
+        return f"data: {json.dumps(event)}\n\n"
@@ -0,0 +1,391 @@
+"""
+On-demand request profiling.
+
+``ProfilingMiddleware`` is only installed when ``PROFILING_ENABLED`` is on;
+otherwise Django drops it at startup and the ``phase``/``record`` hooks in
+the pipeline reduce to one context-variable lookup. A request is profiled
+when it carries ``X-Profile-Token`` matching ``PROFILING_TOKEN`` or when it
+is picked by ``PROFILING_SAMPLE_RATE``. ``X-Profile-Mode`` selects extra
+capture on top of the phase timings:
+
+* ``timing`` (default) – per-phase breakdown only
+* ``cprofile`` – also a cProfile of the view (and of a WSGI stream body)
+* ``tracemalloc`` – also the top allocation sites at the end of the request
+
+Phases: ``db`` (every ORM query), ``config``, ``service_setup``,
+``client_setup``, ``upstream_queue``, ``upstream_ttft``, ``upstream``,
+``encode`` (SSE framing) and ``write`` (time the server spent sending
+between chunks). Each profile is a JSON file in ``PROFILING_DIR`` (plus a
+``.prof`` file for cProfile); only the newest ``PROFILING_MAX_PROFILES``
+are kept. ``/api/profiles/`` lists them for token holders.
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import FileResponse, Http404, JsonResponse
+from django.views.decorators.http import require_GET
+
+MODES = ('timing', 'cprofile', 'tracemalloc')
+PROFILE_ID_RE = re.compile(r'^[0-9]{8}T[0-9]{12}-[0-9a-f]{8}$')
+SLOW_QUERIES = 10
+TRACEMALLOC_TOP = 30
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar[Optional['Profile']] = ContextVar('contextlens_profile', default=None)
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def active() -> Optional['Profile']:
+    """The profile of the current request, if it is being profiled"""
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str):
+    """Time the block into ``name`` when the current request is profiled"""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def record(name: str, seconds: float):
+    """Add an externally measured duration to the current profile"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+class Profile:
+    """Timings collected for one request, from the view through the last chunk"""
+
+    def __init__(self, request, mode: str):
+        now = datetime.now(timezone.utc)
+        # Microseconds keep name order equal to age order for the ring
+        self.id = f"{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+        self.created = now.isoformat()
+        self.method = request.method
+        self.path = request.path
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.queries = []
+        self.chunks = 0
+        self.bytes = 0
+        self.view_ms = None
+        self.status = None
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else None
+        self.allocations = None
+        self._lock = threading.Lock()
+        self._finished = False
+        if mode == 'tracemalloc':
+            _start_tracemalloc()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] += seconds
+            self.counts[name] += 1
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.add('db', elapsed)
+            with self._lock:
+                self.queries.append((elapsed, sql))
+                self.queries.sort(key=lambda query: query[0], reverse=True)
+                del self.queries[SLOW_QUERIES:]
+
+    @contextmanager
+    def capture(self):
+        """Attribute DB queries (and cProfile samples) in this thread to the profile"""
+        token = _current.set(self)
+        profiling = False
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+                profiling = True
+            except ValueError:
+                pass  # another profiler is already active in this thread
+        try:
+            with connection.execute_wrapper(self.query_wrapper):
+                yield
+        finally:
+            if profiling:
+                self.profiler.disable()
+            _current.reset(token)
+
+    def wrap_stream(self, content, is_async: bool):
+        """Re-emit a streaming body, timing the server's writes and finishing at the end"""
+        if is_async:
+            return self._wrap_async(content)
+        return self._wrap_sync(content)
+
+    def _wrap_sync(self, content):
+        iterator = iter(content)
+        try:
+            while True:
+                with self.capture():
+                    chunk = next(iterator, None)
+                if chunk is None:
+                    break
+                self.chunks += 1
+                self.bytes += len(chunk)
+                yielded = time.perf_counter()
+                yield chunk
+                self.add('write', time.perf_counter() - yielded)
+        finally:
+            self.finish()
+
+    async def _wrap_async(self, content):
+        iterator = aiter(content)
+        try:
+            while True:
+                # Set per pull so worker threads started for it see the profile
+                token = _current.set(self)
+                try:
+                    chunk = await anext(iterator, None)
+                finally:
+                    _current.reset(token)
+                if chunk is None:
+                    break
+                self.chunks += 1
+                self.bytes += len(chunk)
+                yielded = time.perf_counter()
+                yield chunk
+                self.add('write', time.perf_counter() - yielded)
+        finally:
+            self.finish()
+
+    def finish(self, status: Optional[int] = None):
+        """Stop capturing and save the profile; later calls do nothing"""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if status is not None:
+            self.status = status
+        if self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            _stop_tracemalloc()
+            self.allocations = [
+                {'where': str(stat.traceback), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]
+            ]
+        store.save(self)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            phases = {
+                name: {'ms': round(seconds * 1000, 2), 'count': self.counts[name]}
+                for name, seconds in sorted(self.phases.items(), key=lambda item: -item[1])
+            }
+            slow_queries = [{'ms': round(elapsed * 1000, 2), 'sql': sql[:500]} for elapsed, sql in self.queries]
+        return {
+            'id': self.id,
+            'created': self.created,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'mode': self.mode,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'view_ms': self.view_ms,
+            'chunks': self.chunks,
+            'bytes': self.bytes,
+            'phases': phases,
+            'slow_queries': slow_queries,
+            'allocations': self.allocations,
+            'has_cprofile': self.profiler is not None,
+        }
+
+
+class ProfileStore:
+    """Newest-N ring of profile files in one directory"""
+
+    def __init__(self, directory, max_profiles: int):
+        self.directory = Path(directory)
+        self.max_profiles = max_profiles
+
+    def path(self, profile_id: str, suffix: str = '.json') -> Path:
+        if not PROFILE_ID_RE.match(profile_id):
+            raise Http404('Unknown profile')
+        return self.directory / f'{profile_id}{suffix}'
+
+    def save(self, profile: Profile):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if profile.profiler is not None:
+                profile.profiler.dump_stats(self.path(profile.id, '.prof'))
+            target = self.path(profile.id)
+            partial = target.with_suffix('.tmp')
+            partial.write_text(json.dumps(profile.as_dict(), indent=1))
+            os.replace(partial, target)
+            self.prune()
+        except OSError as e:
+            logger.warning('could not save profile %s: %s', profile.id, e)
+
+    def prune(self):
+        # Ids start with the UTC timestamp, so name order is age order
+        names = sorted(path.stem for path in self.directory.glob('*.json'))
+        for stale in names[:max(0, len(names) - self.max_profiles)]:
+            for suffix in ('.json', '.prof'):
+                (self.directory / f'{stale}{suffix}').unlink(missing_ok=True)
+
+    def list(self) -> list:
+        profiles = []
+        for path in sorted(self.directory.glob('*.json'), reverse=True):
+            try:
+                data = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue  # pruned or half-written meanwhile
+            profiles.append({key: data.get(key) for key in
+                             ('id', 'created', 'method', 'path', 'status', 'mode', 'total_ms', 'has_cprofile')})
+        return profiles
+
+
+store = ProfileStore(
+    getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles'),
+    getattr(settings, 'PROFILING_MAX_PROFILES', 100),
+)
+
+
+def _token_matches(request) -> bool:
+    token = getattr(settings, 'PROFILING_TOKEN', '')
+    offered = request.headers.get('X-Profile-Token', '')
+    return bool(token and offered) and hmac.compare_digest(token.encode(), offered.encode())
+
+
+class ProfilingMiddleware:
+    """Profile requests that ask for it with the token, plus a random sample"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+
+    def _mode(self, request) -> Optional[str]:
+        if _token_matches(request):
+            mode = request.headers.get('X-Profile-Mode', 'timing')
+            return mode if mode in MODES else 'timing'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'timing'
+        return None
+
+    def __call__(self, request):
+        mode = self._mode(request)
+        if mode is None or request.path.startswith('/api/profiles/'):
+            return self.get_response(request)
+
+        profile = Profile(request, mode)
+        try:
+            with profile.capture():
+                response = self.get_response(request)
+        except BaseException:
+            profile.finish(500)
+            raise
+        profile.view_ms = round((time.perf_counter() - profile.started) * 1000, 2)
+        profile.status = response.status_code
+        response['X-Profile-Id'] = profile.id
+        if response.streaming:
+            response.streaming_content = profile.wrap_stream(response.streaming_content, response.is_async)
+            # The body may never be pulled (client gone first): closing the
+            # response still finishes the profile and releases tracemalloc
+            if hasattr(response, 'on_close'):
+                response.on_close(profile.finish)
+            else:
+                response._resource_closers.append(profile.finish)
+        else:
+            profile.finish()
+        return response
+
+
+def _authorized(request) -> bool:
+    if getattr(settings, 'PROFILING_TOKEN', ''):
+        return _token_matches(request)
+    return settings.DEBUG
+
+
+def _guard(request):
+    if not getattr(settings, 'PROFILING_ENABLED', False):
+        raise Http404('Profiling is disabled')
+    if not _authorized(request):
+        return JsonResponse({'error': 'Missing or wrong X-Profile-Token'}, status=403)
+    return None
+
+
+@require_GET
+def profile_index(request):
+    """Stored profiles, newest first"""
+    denied = _guard(request)
+    if denied:
+        return denied
+    return JsonResponse({'profiles': store.list() if store.directory.exists() else []})
+
+
+@require_GET
+def profile_detail(request, profile_id):
+    """One profile's phase breakdown, slow queries and allocations"""
+    denied = _guard(request)
+    if denied:
+        return denied
+    path = store.path(profile_id)
+    if not path.exists():
+        raise Http404('Unknown profile')
+    return JsonResponse(json.loads(path.read_text()))
+
+
+@require_GET
+def profile_download(request, profile_id):
+    """The cProfile stats file (``python -m pstats`` / snakeviz)"""
+    denied = _guard(request)
+    if denied:
+        return denied
+    path = store.path(profile_id, '.prof')
+    if not path.exists():
+        raise Http404('Profile has no cProfile data')
+    return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
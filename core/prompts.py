@@ -0,0 +1,82 @@
+"""
+Compiled prompt templates.
+
+A template's ``prompt_text`` is split once into literal segments and
+placeholder slots (``compile_prompt``, cached per text) and rendered with a
+single ``''.join``: substituted text is never scanned again, so rendering
+is one copy of the inputs however large they are, and a ``{input_select}``
+that happens to appear in the user's document stays as written.
+
+``PLACEHOLDERS`` lists each placeholder with the template types that can
+fill it; a new one only needs an entry here and a value passed to
+``render``. ``validate_prompt`` checks a template against its type when it
+is saved, and the config snapshot compiles the active templates as it loads.
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+ANALYSIS_TYPES = ('word_analysis', 'sentence_analysis')
+
+# name -> template types that provide a value for it
+PLACEHOLDERS: Dict[str, Tuple[str, ...]] = {
+    'all_input': ('translation',) + ANALYSIS_TYPES,
+    'input_select': ANALYSIS_TYPES,
+}
+# template type -> placeholders it cannot do without
+REQUIRED: Dict[str, Tuple[str, ...]] = {
+    'translation': ('all_input',),
+    'word_analysis': ('input_select',),
+    'sentence_analysis': ('input_select',),
+}
+
+_PLACEHOLDER_RE = re.compile(r'\{(' + '|'.join(map(re.escape, PLACEHOLDERS)) + r')\}')
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    # Literals and placeholder names alternate: parts[0] is a literal and
+    # every odd index holds the placeholder whose value goes there
+    parts: Tuple[str, ...]
+
+    @property
+    def skeleton(self) -> str:
+        """The template with every placeholder removed"""
+        return ''.join(self.parts[::2])
+
+    def count(self, name: str) -> int:
+        return self.parts[1::2].count(name)
+
+    @property
+    def placeholders(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(self.parts[1::2]))
+
+    def render(self, **values: str) -> str:
+        pieces: List[str] = list(self.parts)
+        for i in range(1, len(pieces), 2):
+            pieces[i] = values.get(pieces[i], '')
+        return ''.join(pieces)
+
+
+@lru_cache(maxsize=128)
+def compile_prompt(prompt_text: str) -> CompiledPrompt:
+    """Split ``prompt_text`` into literal and placeholder parts"""
+    return CompiledPrompt(tuple(_PLACEHOLDER_RE.split(prompt_text)))
+
+
+def compiled(template) -> CompiledPrompt:
+    return compile_prompt(template.prompt_text)
+
+
+def validate_prompt(template_type: str, prompt_text: str) -> List[str]:
+    """Problems with using ``prompt_text`` for ``template_type`` (empty when it is fine)"""
+    prompt = compile_prompt(prompt_text)
+    problems = []
+    for name in REQUIRED.get(template_type, ()):
+        if not prompt.count(name):
+            problems.append(f'{template_type} templates must contain {{{name}}}')
+    for name in prompt.placeholders:
+        if template_type not in PLACEHOLDERS[name]:
+            problems.append(f'{{{name}}} has no value in {template_type} templates')
+    return problems
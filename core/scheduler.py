@@ -0,0 +1,182 @@
+"""
+Priority dispatcher in front of the upstream API.
+
+Every upstream call takes a slot from ``dispatcher`` first. Calls belong to
+one of three priority classes:
+
+* ``interactive_analysis`` – word/sentence lookups a reader is waiting on
+* ``interactive_translation`` – full-text translations started by a reader
+* ``bulk`` – background or batch work
+
+When more calls are waiting than there are free slots, the next slot goes
+to the waiting class with the lowest virtual time, and a class's virtual
+time advances by ``1 / weight`` per granted slot (weighted fair queuing), so
+lookups get most slots without starving the rest. ``interactive_reserve``
+slots are only handed to the reserved classes, so a burst of bulk work can
+never occupy the last free slots. Limits are per worker process.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from django.conf import settings
+
+INTERACTIVE_ANALYSIS = 'interactive_analysis'
+INTERACTIVE_TRANSLATION = 'interactive_translation'
+BULK = 'bulk'
+PRIORITY_CLASSES = (INTERACTIVE_ANALYSIS, INTERACTIVE_TRANSLATION, BULK)
+
+DEFAULT_WEIGHTS = {INTERACTIVE_ANALYSIS: 8, INTERACTIVE_TRANSLATION: 3, BULK: 1}
+DEFAULT_MAX_WAIT_SECONDS = {INTERACTIVE_ANALYSIS: 15, INTERACTIVE_TRANSLATION: 60, BULK: 300}
+WAIT_SAMPLES = 512
+
+TEMPLATE_TYPE_CLASSES = {
+    'translation': INTERACTIVE_TRANSLATION,
+    'word_analysis': INTERACTIVE_ANALYSIS,
+    'sentence_analysis': INTERACTIVE_ANALYSIS,
+}
+
+
+def priority_for(template_type: str) -> str:
+    """Default priority class of a template type"""
+    return TEMPLATE_TYPE_CLASSES.get(template_type, BULK)
+
+
+class SchedulerTimeout(Exception):
+    """No upstream slot became free within the class's maximum wait"""
+
+
+def _percentile(samples, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 2)
+
+
+class _ClassState:
+    def __init__(self, name: str, weight: float, reserved: bool, max_wait: float):
+        self.name = name
+        self.weight = weight
+        self.reserved = reserved
+        self.max_wait = max_wait
+        self.waiters = deque()
+        self.running = 0
+        self.vtime = 0.0
+        self.granted = 0
+        self.timeouts = 0
+        self.waits_ms = deque(maxlen=WAIT_SAMPLES)
+
+
+class Dispatcher:
+    """Weighted fair queuing over a fixed number of upstream slots"""
+
+    def __init__(self, max_concurrency: int, interactive_reserve: int, weights: Dict[str, float],
+                 max_wait: Dict[str, float], reserved_classes=(INTERACTIVE_ANALYSIS,)):
+        self.max_concurrency = max_concurrency
+        self.interactive_reserve = min(interactive_reserve, max_concurrency - 1)
+        self._cond = threading.Condition()
+        self._vclock = 0.0
+        self._states = {
+            name: _ClassState(name, float(weights.get(name, 1)), name in reserved_classes,
+                              float(max_wait.get(name, DEFAULT_MAX_WAIT_SECONDS[BULK])))
+            for name in PRIORITY_CLASSES
+        }
+
+    def _running(self) -> int:
+        return sum(state.running for state in self._states.values())
+
+    def _next_ticket(self):
+        free = self.max_concurrency - self._running()
+        if free <= 0:
+            return None
+        candidates = [
+            state for state in self._states.values()
+            if state.waiters and (state.reserved or free > self.interactive_reserve)
+        ]
+        if not candidates:
+            return None
+        # Ties go to the higher-priority class (declaration order)
+        best = min(candidates, key=lambda state: (state.vtime, PRIORITY_CLASSES.index(state.name)))
+        return best.waiters[0]
+
+    def acquire(self, priority: str, timeout: Optional[float] = None) -> float:
+        """Block until a slot is granted; returns the wait in milliseconds"""
+        state = self._states[priority]
+        timeout = state.max_wait if timeout is None else timeout
+        ticket = object()
+        started = time.perf_counter()
+        with self._cond:
+            if not state.waiters and state.running == 0:
+                # A class returning from idle starts at the current virtual
+                # time instead of spending credit it built up while idle.
+                state.vtime = max(state.vtime, self._vclock)
+            state.waiters.append(ticket)
+            deadline = started + timeout
+            while self._next_ticket() is not ticket:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    state.waiters.remove(ticket)
+                    state.timeouts += 1
+                    self._cond.notify_all()
+                    raise SchedulerTimeout(
+                        f'Upstream is busy: no slot for {priority} within {timeout:g}s, please retry.')
+                self._cond.wait(remaining)
+
+            state.waiters.popleft()
+            state.running += 1
+            state.granted += 1
+            self._vclock = state.vtime
+            state.vtime += 1 / state.weight
+            waited_ms = (time.perf_counter() - started) * 1000
+            state.waits_ms.append(waited_ms)
+            # Another slot may still be free for the next waiter in line
+            self._cond.notify_all()
+        return waited_ms
+
+    def release(self, priority: str):
+        with self._cond:
+            self._states[priority].running -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: str, timeout: Optional[float] = None):
+        """Hold a slot for the block; yields the wait in milliseconds"""
+        waited_ms = self.acquire(priority, timeout)
+        try:
+            yield waited_ms
+        finally:
+            self.release(priority)
+
+    def snapshot(self) -> dict:
+        """Queue depth, running calls and wait times per class"""
+        with self._cond:
+            classes = {
+                state.name: {
+                    'weight': state.weight,
+                    'reserved': state.reserved,
+                    'queued': len(state.waiters),
+                    'running': state.running,
+                    'granted': state.granted,
+                    'timeouts': state.timeouts,
+                    'wait_ms_p50': _percentile(state.waits_ms, 0.5),
+                    'wait_ms_p95': _percentile(state.waits_ms, 0.95),
+                    'wait_ms_max': round(max(state.waits_ms), 2) if state.waits_ms else None,
+                }
+                for state in self._states.values()
+            }
+            return {
+                'max_concurrency': self.max_concurrency,
+                'interactive_reserve': self.interactive_reserve,
+                'running': self._running(),
+                'classes': classes,
+            }
+
+
+dispatcher = Dispatcher(
+    max_concurrency=getattr(settings, 'SCHEDULER_MAX_CONCURRENCY', 16),
+    interactive_reserve=getattr(settings, 'SCHEDULER_INTERACTIVE_RESERVE', 4),
+    weights={**DEFAULT_WEIGHTS, **getattr(settings, 'SCHEDULER_WEIGHTS', {})},
+    max_wait={**DEFAULT_MAX_WAIT_SECONDS, **getattr(settings, 'SCHEDULER_MAX_WAIT_SECONDS', {})},
+)
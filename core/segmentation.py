@@ -0,0 +1,265 @@
+"""
+Sentence/token segmentation index.
+
+A document is scanned once into compact ``array``-backed offset tables (token
+spans, sentence starts, paragraph starts and a prefix sum of approximate LLM
+tokens). Every later question -- how many tokens does a span cost, which
+sentences surround a selection, where can the document be cut into chunks -- is
+answered with binary searches over those tables instead of re-splitting the
+text. Indexes are cached by content hash so the same document is only
+scanned once no matter how many lookups are made against it.
+"""
+import hashlib
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Iterator, List, Optional, Tuple
+
+# Han ideographs, kana and CJK compatibility ideographs are written without
+# spaces, so every character is its own token. Hangul is space-delimited and
+# is treated like any other alphabetic script.
+CJK_RANGES = (
+    '\u3040-\u30ff'
+    '\u3400-\u4dbf'
+    '\u4e00-\u9fff'
+    '\uf900-\ufaff'
+    '\U00020000-\U0002fa1f'
+)
+
+TOKEN_RE = re.compile(
+    rf"[{CJK_RANGES}]|[^\W_{CJK_RANGES}]+(?:['’\-][^\W_{CJK_RANGES}]+)*"
+)
+# A sentence ends at terminal punctuation (optionally followed by closing
+# quotes/brackets). Latin terminators need trailing whitespace so that
+# "e.g" or "3.14" do not split; CJK terminators never do.
+SENTENCE_END_RE = re.compile(
+    r"(?:[.!?…]+[\"'”’)\]]*(?=\s|$)|[。！？]+[」』”’）]*)\s*|\n\s*\n\s*"
+)
+PARAGRAPH_RE = re.compile(r"\n\s*\n\s*")
+PUNCTUATION_RE = re.compile(r"[^\w\s]|_")
+
+INDEX_CACHE_SIZE = 32
+
+
+def content_digest(text: str) -> str:
+    """Stable content hash used as the index cache key"""
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+
+class SegmentIndex:
+    """Offset tables for a single document"""
+
+    __slots__ = (
+        'digest', 'length', 'token_starts', 'token_ends', 'token_prefix',
+        'punctuation', 'sentence_starts', 'paragraph_starts',
+    )
+
+    def __init__(self, text: str, digest: Optional[str] = None):
+        self.digest = digest or content_digest(text)
+        self.length = len(text)
+
+        spans = [match.span() for match in TOKEN_RE.finditer(text)]
+        self.token_starts = array('I', [start for start, _ in spans])
+        self.token_ends = array('I', [end for _, end in spans])
+        # token_prefix[i] is the approximate LLM token count of tokens before
+        # token i: one per CJK character / short word, ~4 chars each beyond.
+        self.token_prefix = array('I', accumulate(((end - start + 3) >> 2 for start, end in spans), initial=0))
+        # Punctuation costs roughly one LLM token per character.
+        self.punctuation = array('I', [match.start() for match in PUNCTUATION_RE.finditer(text)])
+        self.sentence_starts = self._boundaries(SENTENCE_END_RE, text)
+        self.paragraph_starts = self._boundaries(PARAGRAPH_RE, text)
+
+    @staticmethod
+    def _boundaries(pattern: re.Pattern, text: str) -> array:
+        starts = array('I', [0])
+        length = len(text)
+        for match in pattern.finditer(text):
+            end = match.end()
+            if starts[-1] < end < length:
+                starts.append(end)
+        return starts
+
+    # Token queries
+
+    @property
+    def token_count(self) -> int:
+        return len(self.token_starts)
+
+    def token_range(self, start: int, end: int) -> Tuple[int, int]:
+        """Indices [first, last) of tokens overlapping the character span"""
+        first = bisect_right(self.token_ends, start)
+        last = bisect_left(self.token_starts, end)
+        return first, max(first, last)
+
+    def word_count(self, start: int = 0, end: Optional[int] = None) -> int:
+        """Number of word tokens in the span (CJK characters count individually)"""
+        first, last = self.token_range(start, self.length if end is None else end)
+        return last - first
+
+    def approx_tokens(self, start: int = 0, end: Optional[int] = None) -> int:
+        """Approximate LLM token count of the character span"""
+        end = self.length if end is None else end
+        first, last = self.token_range(start, end)
+        punctuation = bisect_left(self.punctuation, end) - bisect_left(self.punctuation, start)
+        return self.token_prefix[last] - self.token_prefix[first] + punctuation
+
+    # Sentence queries
+
+    @property
+    def sentence_count(self) -> int:
+        return len(self.sentence_starts)
+
+    def sentence_bounds(self, number: int) -> Tuple[int, int]:
+        """Character span of the n-th sentence"""
+        start = self.sentence_starts[number]
+        end = self.sentence_starts[number + 1] if number + 1 < len(self.sentence_starts) else self.length
+        return start, end
+
+    def sentence_at(self, offset: int) -> int:
+        """Number of the sentence containing the character offset"""
+        return max(0, bisect_right(self.sentence_starts, offset) - 1)
+
+    def context_window(self, start: int, end: int, max_tokens: int) -> Tuple[int, int]:
+        """
+        Grow the selection outward by whole sentences until ``max_tokens``
+        (approximate) would be exceeded. The sentences containing the
+        selection are always included.
+        """
+        first = self.sentence_at(start)
+        last = self.sentence_at(max(start, end - 1))
+        window_start = self.sentence_bounds(first)[0]
+        window_end = self.sentence_bounds(last)[1]
+        used = self.approx_tokens(window_start, window_end)
+
+        before, after = first - 1, last + 1
+        while before >= 0 or after < self.sentence_count:
+            grew = False
+            for number in (before, after):
+                if not 0 <= number < self.sentence_count:
+                    continue
+                sentence_start, sentence_end = self.sentence_bounds(number)
+                cost = self.approx_tokens(sentence_start, sentence_end)
+                if used + cost > max_tokens:
+                    continue
+                used += cost
+                grew = True
+                if number == before:
+                    window_start, before = sentence_start, before - 1
+                else:
+                    window_end, after = sentence_end, after + 1
+            if not grew:
+                break
+        return window_start, window_end
+
+    # Chunking
+
+    def chunks(self, max_tokens: int) -> List[Tuple[int, int]]:
+        """
+        Split the document into spans of at most ``max_tokens`` approximate
+        tokens, cutting at sentence boundaries where possible and at token
+        boundaries for sentences that are too long on their own.
+        """
+        spans: List[Tuple[int, int]] = []
+        chunk_start = 0
+        chunk_tokens = 0
+        for number in range(self.sentence_count):
+            sentence_start, sentence_end = self.sentence_bounds(number)
+            cost = self.approx_tokens(sentence_start, sentence_end)
+            if chunk_tokens and chunk_tokens + cost > max_tokens:
+                spans.append((chunk_start, sentence_start))
+                chunk_start, chunk_tokens = sentence_start, 0
+            if cost > max_tokens:
+                for piece_start, piece_end in self._split_span(sentence_start, sentence_end, max_tokens):
+                    if piece_end == sentence_end:
+                        chunk_start = piece_start
+                        chunk_tokens = self.approx_tokens(piece_start, piece_end)
+                    else:
+                        spans.append((piece_start, piece_end))
+                continue
+            chunk_tokens += cost
+        if chunk_start < self.length:
+            spans.append((chunk_start, self.length))
+        return spans
+
+    def _split_span(self, start: int, end: int, max_tokens: int) -> Iterator[Tuple[int, int]]:
+        first, last = self.token_range(start, end)
+        piece_start = start
+        piece_first = first
+        for token in range(first, last):
+            # A piece runs up to the next token, so the punctuation after this
+            # token is charged to it as well
+            piece_end = self.token_starts[token + 1] if token + 1 < last else end
+            if token > piece_first and self.approx_tokens(piece_start, piece_end) > max_tokens:
+                cut = self.token_starts[token]
+                yield piece_start, cut
+                piece_start, piece_first = cut, token
+        yield piece_start, end
+
+    # Selections
+
+    def locate(self, text: str, selected_text: str, hint: int = 0) -> Optional[Tuple[int, int]]:
+        """Character span of ``selected_text`` inside the indexed ``text``"""
+        if not selected_text:
+            return None
+        offset = text.find(selected_text, hint)
+        if offset < 0 and hint:
+            offset = text.find(selected_text)
+        if offset < 0:
+            return None
+        return offset, offset + len(selected_text)
+
+
+class _IndexCache:
+    """Small thread-safe LRU of ``SegmentIndex`` keyed by content digest"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: 'OrderedDict[str, SegmentIndex]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> SegmentIndex:
+        digest = content_digest(text)
+        with self._lock:
+            index = self._entries.get(digest)
+            if index is not None:
+                self._entries.move_to_end(digest)
+                return index
+        index = SegmentIndex(text, digest)
+        with self._lock:
+            self._entries[digest] = index
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = _IndexCache(INDEX_CACHE_SIZE)
+
+
+def get_index(text: str) -> SegmentIndex:
+    """Return the (cached) segmentation index for a document"""
+    return _cache.get(text)
+
+
+def count_words(text: str) -> int:
+    """Word count of a short, standalone string (not cached)"""
+    return sum(1 for _ in TOKEN_RE.finditer(text))
+
+
+def selection_word_count(selected_text: str) -> int:
+    """
+    Word count of a selection. Only the selection's own tokens matter, so the
+    document is neither hashed nor searched for it.
+    """
+    return count_words(selected_text)
+
+
+def is_sentence_selection(selected_text: str, word_group_threshold: int) -> bool:
+    """Whether a selection should get sentence (rather than word/phrase) analysis"""
+    return selection_word_count(selected_text) > word_group_threshold
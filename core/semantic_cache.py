@@ -0,0 +1,348 @@
+"""
+Semantic cache for sentence analyses.
+
+Sentence selections rarely repeat byte-for-byte, but near-duplicates
+(different punctuation, casing, a changed name) are common. With
+``SEMANTIC_CACHE_ENABLED`` each sentence selection is embedded through the
+OpenAI-compatible embeddings endpoint (the template's own API configuration
+unless ``SEMANTIC_CACHE_EMBEDDING_BASE_URL`` points elsewhere, e.g. at a
+local stub) and looked up in an in-memory index of earlier analyses made
+with the same template version. A neighbour at or above
+``SEMANTIC_CACHE_THRESHOLD`` cosine similarity is replayed instead of
+calling the model. Selections that normalize to the same text are found
+without an embedding call.
+
+Vectors live in one NumPy matrix per template version. Search is exact (one
+matrix-vector product) or, with ``SEMANTIC_CACHE_SEARCH='approximate'``,
+uses random-hyperplane LSH buckets to pick candidates that are then scored
+exactly; small indexes are always searched exactly. NumPy is optional: the
+cache switches itself off without it. Memory, query latency and hit
+similarity are reported by ``/api/semantic-cache/``.
+
+The lookup (an embeddings call) runs inside the stream, ``cached_chunks``,
+so only requests that passed admission pay for it. Its outcome is the
+stream's first chunk, sent to clients as a ``semantic_cache`` event.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from .models import APIConfiguration
+from .openai_service import TRUNCATED, has_api_key, shared_client
+from .profiling import phase
+
+try:
+    import numpy as np
+except ImportError:  # optional: no semantic cache without it
+    np = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = '__SEMANTIC_CACHE__:'
+EXACT_SEARCH_BELOW = 2048  # rows; under this a full scan beats bucket lookups
+LSH_TABLES = 8
+LSH_BITS = 10
+REPLAY_CHARS = 200
+LATENCY_SAMPLES = 512
+
+# Stream chunks that are not part of the analysis text
+CONTROL_PREFIXES = ('__THINKING__:', CACHE_PREFIX)
+CONTROL_CHUNKS = ('__THINKING_DONE__',)
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def enabled() -> bool:
+    return getattr(settings, 'SEMANTIC_CACHE_ENABLED', False) and np is not None
+
+
+def usable(template) -> bool:
+    """Enabled, and there is an embeddings endpoint to call (not in demo mode)"""
+    if not enabled() or template.template_type != 'sentence_analysis':
+        return False
+    return bool(getattr(settings, 'SEMANTIC_CACHE_EMBEDDING_BASE_URL', '')) or has_api_key(template.api_config)
+
+
+def normalize(text: str) -> str:
+    """Case-, punctuation- and whitespace-insensitive form of a selection"""
+    return _SPACE_RE.sub(' ', _PUNCTUATION_RE.sub(' ', text.lower())).strip()
+
+
+def template_version(template) -> str:
+    """Changes whenever anything that shapes the analysis changes"""
+    material = '\0'.join((str(template.pk), template.prompt_text, template.api_config.model_name,
+                          template.reasoning_effort or '', template.output_format))
+    return hashlib.blake2b(material.encode(), digest_size=8).hexdigest()
+
+
+@dataclass
+class CachedAnalysis:
+    text: str
+    analysis: str
+    created: float
+
+
+class VectorIndex:
+    """Unit vectors in a growable float32 matrix; the oldest rows are overwritten when full"""
+
+    def __init__(self, dimensions: int, max_entries: int, seed: int = 0):
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.vectors = np.zeros((min(64, max_entries), dimensions), dtype=np.float32)
+        self.entries: List[Optional[CachedAnalysis]] = []
+        self.count = 0  # rows in use
+        self.next_row = 0
+        self.planes = np.random.default_rng(seed).standard_normal(
+            (LSH_TABLES, LSH_BITS, dimensions)).astype(np.float32)
+        self.codes = np.zeros((self.vectors.shape[0], LSH_TABLES), dtype=np.uint16)
+        self._weights = (1 << np.arange(LSH_BITS)).astype(np.uint16)
+
+    def _hash(self, vectors) -> 'np.ndarray':
+        # (rows, tables): sign pattern of the projections onto each table's hyperplanes
+        bits = np.einsum('tbd,nd->ntb', self.planes, vectors) > 0
+        return (bits * self._weights).sum(axis=2).astype(np.uint16)
+
+    def add(self, vector, entry: CachedAnalysis) -> int:
+        row = self.next_row
+        if row >= self.vectors.shape[0]:
+            size = min(self.max_entries, self.vectors.shape[0] * 2)
+            self.vectors = np.resize(self.vectors, (size, self.dimensions))
+            self.codes = np.resize(self.codes, (size, LSH_TABLES))
+        self.vectors[row] = vector
+        self.codes[row] = self._hash(vector[None, :])[0]
+        if row < len(self.entries):
+            self.entries[row] = entry
+        else:
+            self.entries.append(entry)
+        self.count = max(self.count, row + 1)
+        self.next_row = (row + 1) % self.max_entries
+        return row
+
+    def search(self, vector, approximate: bool = False) -> Tuple[Optional[int], float]:
+        """(row, cosine similarity) of the nearest entry"""
+        if not self.count:
+            return None, 0.0
+        if approximate and self.count >= EXACT_SEARCH_BELOW:
+            code = self._hash(vector[None, :])[0]
+            rows = np.flatnonzero((self.codes[:self.count] == code).any(axis=1))
+            if not len(rows):
+                return None, 0.0
+            scores = self.vectors[rows] @ vector
+            best = int(np.argmax(scores))
+            return int(rows[best]), float(scores[best])
+        scores = self.vectors[:self.count] @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.codes.nbytes
+
+
+class SemanticCache:
+    """Per-template-version vector indexes plus hit/miss statistics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._current: Dict[int, str] = {}  # template pk -> its latest version
+        self._by_text: Dict[Tuple[str, str], CachedAnalysis] = {}
+        self.hits = 0
+        self.text_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.stored = 0
+        self._query_ms = deque(maxlen=LATENCY_SAMPLES)
+        self._embed_ms = deque(maxlen=LATENCY_SAMPLES)
+        self._hit_similarity = deque(maxlen=LATENCY_SAMPLES)
+        self._miss_similarity = deque(maxlen=LATENCY_SAMPLES)
+
+    def _embedding_config(self, template) -> APIConfiguration:
+        base_url = getattr(settings, 'SEMANTIC_CACHE_EMBEDDING_BASE_URL', '')
+        if not base_url:
+            return template.api_config
+        return APIConfiguration(name='embeddings', base_url=base_url,
+                                api_key=getattr(settings, 'SEMANTIC_CACHE_EMBEDDING_API_KEY', '') or 'unused')
+
+    def embed(self, template, text: str):
+        started = time.perf_counter()
+        client = shared_client(self._embedding_config(template)).with_options(
+            timeout=getattr(settings, 'SEMANTIC_CACHE_EMBEDDING_TIMEOUT', 3.0), max_retries=0)
+        response = client.embeddings.create(
+            model=getattr(settings, 'SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small'),
+            input=text,
+        )
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        self._embed_ms.append((time.perf_counter() - started) * 1000)
+        return vector / norm if norm else vector
+
+    def lookup(self, template, text: str) -> 'Lookup':
+        """Find a cached analysis of ``text``; the result also carries what is needed to store one"""
+        version = template_version(template)
+        key = (version, normalize(text))
+        with self._lock:
+            self._retire(template.pk, version)
+            entry = self._by_text.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.text_hits += 1
+                self._hit_similarity.append(1.0)
+                return Lookup(self, template.pk, version, text, None, entry, 1.0)
+
+        try:
+            vector = self.embed(template, text)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning('semantic cache: embedding failed (%s); analysing without the cache', e)
+            return Lookup(self, template.pk, version, text, None, None, 0.0)
+
+        started = time.perf_counter()
+        threshold = getattr(settings, 'SEMANTIC_CACHE_THRESHOLD', 0.95)
+        approximate = getattr(settings, 'SEMANTIC_CACHE_SEARCH', 'exact') == 'approximate'
+        with self._lock:
+            index = self._indexes.get(version)
+            if index is not None and index.dimensions != len(vector):
+                index = None  # embedding model changed; the next store starts over
+            row, similarity = index.search(vector, approximate) if index is not None else (None, 0.0)
+            entry = index.entries[row] if row is not None and similarity >= threshold else None
+            self._query_ms.append((time.perf_counter() - started) * 1000)
+            if entry is not None:
+                self.hits += 1
+                self._hit_similarity.append(similarity)
+            else:
+                self.misses += 1
+                if row is not None:
+                    self._miss_similarity.append(similarity)
+        return Lookup(self, template.pk, version, text, vector, entry, similarity)
+
+    def _retire(self, template_id: int, version: str):
+        """Drop the entries of the template's previous version once a new one is looked up"""
+        previous = self._current.get(template_id)
+        if previous == version:
+            return
+        self._current[template_id] = version
+        if previous is not None:
+            self._indexes.pop(previous, None)
+            for key in [key for key in self._by_text if key[0] == previous]:
+                del self._by_text[key]
+
+    def store(self, template_id: int, version: str, text: str, vector, analysis: str):
+        entry = CachedAnalysis(text=text, analysis=analysis, created=time.time())
+        max_entries = getattr(settings, 'SEMANTIC_CACHE_MAX_ENTRIES', 20000)
+        with self._lock:
+            if self._current.get(template_id) != version:
+                return  # the template changed while this analysis streamed
+            index = self._indexes.get(version)
+            if index is None or index.dimensions != len(vector):
+                index = self._indexes[version] = VectorIndex(len(vector), max_entries)
+            evicted = index.entries[index.next_row] if index.next_row < len(index.entries) else None
+            if evicted is not None:
+                self._by_text.pop((version, normalize(evicted.text)), None)
+            index.add(vector, entry)
+            self._by_text[(version, normalize(text))] = entry
+            self.stored += 1
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._by_text.clear()
+            self._current.clear()
+
+    def snapshot(self) -> dict:
+        """Size, memory, latency and hit-quality figures"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': enabled(),
+                'numpy': np is not None,
+                'search': getattr(settings, 'SEMANTIC_CACHE_SEARCH', 'exact'),
+                'threshold': getattr(settings, 'SEMANTIC_CACHE_THRESHOLD', 0.95),
+                'entries': sum(index.count for index in self._indexes.values()),
+                'template_versions': len(self._indexes),
+                'index_bytes': sum(index.nbytes for index in self._indexes.values()),
+                'lookups': lookups,
+                'hits': self.hits,
+                'text_hits': self.text_hits,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'stored': self.stored,
+                'embedding_errors': self.errors,
+                'embed_ms_p50': _percentile(self._embed_ms, 0.5),
+                'embed_ms_p95': _percentile(self._embed_ms, 0.95),
+                'query_ms_p50': _percentile(self._query_ms, 0.5),
+                'query_ms_p95': _percentile(self._query_ms, 0.95),
+                # Similarity of served neighbours, and of the best neighbour
+                # that fell short: both near the threshold means it is tight
+                'hit_similarity_min': round(min(self._hit_similarity), 4) if self._hit_similarity else None,
+                'hit_similarity_p50': _percentile(self._hit_similarity, 0.5, digits=4),
+                'miss_similarity_p95': _percentile(self._miss_similarity, 0.95, digits=4),
+            }
+
+
+def _percentile(samples, fraction: float, digits: int = 2) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], digits)
+
+
+@dataclass
+class Lookup:
+    cache: SemanticCache
+    template_id: int
+    version: str
+    text: str
+    vector: object
+    entry: Optional[CachedAnalysis]
+    similarity: float
+
+    @property
+    def hit(self) -> bool:
+        return self.entry is not None
+
+    def replay(self) -> Iterator[str]:
+        """The cached analysis as stream chunks"""
+        analysis = self.entry.analysis
+        for start in range(0, len(analysis), REPLAY_CHARS):
+            yield analysis[start:start + REPLAY_CHARS]
+
+    def recording(self, chunks: Iterator[str]) -> Iterator[str]:
+        """Pass a fresh analysis through and cache it once it completes cleanly"""
+        parts = []
+        failed = False
+        for chunk in chunks:
+            if chunk.startswith('Error:') or chunk == TRUNCATED:
+                failed = True  # an incomplete analysis would be replayed as if it were whole
+            elif not chunk.startswith(CONTROL_PREFIXES) and chunk not in CONTROL_CHUNKS:
+                parts.append(chunk)
+            yield chunk
+        analysis = ''.join(parts)
+        if self.vector is not None and analysis.strip() and not failed:
+            self.cache.store(self.template_id, self.version, self.text, self.vector, analysis)
+
+
+cache = SemanticCache()
+
+
+def cached_chunks(template, text: str, fresh: Callable[[], Iterator[str]]) -> Iterator[str]:
+    """
+    The analysis of ``text`` replayed from the cache, else ``fresh()``
+    recorded into it; the first chunk reports which
+    """
+    with phase('semantic_cache'):
+        lookup = cache.lookup(template, text)
+    outcome = {'result': 'hit' if lookup.hit else 'miss'}
+    if lookup.hit:
+        outcome['similarity'] = round(lookup.similarity, 4)
+    yield CACHE_PREFIX + json.dumps(outcome)
+    yield from lookup.replay() if lookup.hit else lookup.recording(fresh())
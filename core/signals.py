@@ -0,0 +1,18 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .config_snapshot import bump_version
+from .models import APIConfiguration, PromptTemplate, AnalysisConfiguration
+
+CONFIG_MODELS = (APIConfiguration, PromptTemplate, AnalysisConfiguration)
+
+
+def config_changed(**kwargs):
+    """Publish a new config version once the change is committed"""
+    transaction.on_commit(bump_version)
+
+
+for model in CONFIG_MODELS:
+    receiver(post_save, sender=model, dispatch_uid=f'config_changed_save_{model.__name__}')(config_changed)
+    receiver(post_delete, sender=model, dispatch_uid=f'config_changed_delete_{model.__name__}')(config_changed)
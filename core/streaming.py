@@ -0,0 +1,270 @@
+"""
+Helpers for the SSE stream endpoints: server-sent-event responses that
+really stream under both WSGI and ASGI, and the bookkeeping that lets a
+worker drain in-flight streams before it exits.
+
+Under ASGI, Django buffers a synchronous ``StreamingHttpResponse`` iterator
+into a list before sending it, which would turn every stream into one
+response at the end. ``sse_response`` therefore hands ASGI requests an
+async iterator that pulls each chunk from the sync generator in a worker
+thread, and keeps plain sync iteration for WSGI / runserver.
+
+With ``SSE_COMPRESSION`` on, streams expected to be large (a translation of
+at least ``SSE_COMPRESSION_MIN_BYTES``) are gzip/brotli compressed for
+clients that accept it. The compressor is flushed so frames still arrive as
+they are produced: under ASGI, frames that arrive within
+``SSE_COMPRESSION_FLUSH_MS`` of each other share one flush and a timer
+flushes whatever is pending; under WSGI every frame is flushed. Raw and
+wire bytes and the compression CPU time are logged per stream.
+
+Per-stream resources (admission leases, profiles) are released through
+``SSEResponse.on_close`` rather than a generator's ``finally``, which never
+runs when the response is dropped before its body is first pulled.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+import zlib
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .assets import brotli, choose_encoding
+from .profiling import record as record_phase
+
+DRAIN_RETRY_AFTER_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class StreamRegistry:
+    """Counts open streams and whether this worker is draining"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = 0
+        self._draining = threading.Event()
+
+    def begin(self):
+        with self._lock:
+            self._open += 1
+
+    def end(self):
+        with self._lock:
+            self._open -= 1
+
+    @property
+    def open_streams(self) -> int:
+        with self._lock:
+            return self._open
+
+    @property
+    def draining(self) -> bool:
+        return self._draining.is_set()
+
+    def start_draining(self):
+        self._draining.set()
+
+
+streams = StreamRegistry()
+
+
+def draining_response() -> JsonResponse:
+    """Fast rejection for new streams while the worker shuts down"""
+    response = JsonResponse({'error': 'Server is restarting, please retry shortly.'}, status=503)
+    response['Retry-After'] = str(DRAIN_RETRY_AFTER_SECONDS)
+    return response
+
+
+def tracked(iterator: Iterable[str]) -> Iterator[str]:
+    streams.begin()
+    try:
+        yield from iterator
+    finally:
+        streams.end()
+
+
+_END = object()
+
+
+def _next_chunk(iterator: Iterator[str]):
+    return next(iterator, _END)
+
+
+async def aiter_chunks(iterator: Iterator[str]) -> AsyncIterator[str]:
+    """Pull a sync generator from a worker thread, one chunk at a time"""
+    pull = sync_to_async(_next_chunk, thread_sensitive=False)
+    try:
+        while True:
+            chunk = await pull(iterator)
+            if chunk is _END:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # Still executing in the worker thread (client went away
+                # mid-chunk); the generator finishes on its own.
+                pass
+
+
+class StreamCompressor:
+    """Incremental gzip/brotli encoder with sync flushes, counting bytes and CPU time"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        level = getattr(settings, 'SSE_COMPRESSION_LEVEL', 5)
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=level)
+            self._process, self._flush = self._compressor.process, self._compressor.flush
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+            self._process = self._compressor.compress
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.pending = 0  # raw bytes taken in since the last flush
+        self.seconds = 0.0
+
+    def _timed(self, operation, *args) -> bytes:
+        started = time.perf_counter()
+        data = operation(*args)
+        self.seconds += time.perf_counter() - started
+        self.wire_bytes += len(data)
+        return data
+
+    def compress(self, chunk) -> bytes:
+        data = chunk.encode() if isinstance(chunk, str) else chunk
+        self.raw_bytes += len(data)
+        self.pending += len(data)
+        return self._timed(self._process, data)
+
+    def flush(self) -> bytes:
+        self.pending = 0
+        return self._timed(self._flush)
+
+    def finish(self) -> bytes:
+        self.pending = 0
+        return self._timed(self._compressor.finish if self.encoding == 'br' else self._compressor.flush)
+
+    def report(self):
+        """Record the stream's savings and cost (also for streams cut short)"""
+        record_phase('compress', self.seconds)
+        logger.info('sse compression', extra={
+            'encoding': self.encoding,
+            'raw_bytes': self.raw_bytes,
+            'wire_bytes': self.wire_bytes,
+            'saved': round(1 - self.wire_bytes / self.raw_bytes, 3) if self.raw_bytes else 0,
+            'cpu_ms': round(self.seconds * 1000, 2),
+        })
+
+
+def compress_sync(chunks: Iterable[str], compressor: StreamCompressor) -> Iterator[bytes]:
+    """Compress a WSGI stream, flushing after every frame (no timer to coalesce with)"""
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        compressor.report()
+
+
+async def compress_async(chunks: AsyncIterator[str], compressor: StreamCompressor) -> AsyncIterator[bytes]:
+    """Compress an ASGI stream, sharing one flush between frames that arrive close together"""
+    interval = getattr(settings, 'SSE_COMPRESSION_FLUSH_MS', 25) / 1000
+    max_pending = getattr(settings, 'SSE_COMPRESSION_FLUSH_BYTES', 16384)
+    pull: Optional[asyncio.Task] = None
+    held = b''  # compressor output not yet sent (only headers between flushes)
+    flush_by = None
+    try:
+        while True:
+            if pull is None:
+                pull = asyncio.ensure_future(anext(chunks, _END))
+            if flush_by is not None:
+                done, _ = await asyncio.wait({pull}, timeout=max(0.0, flush_by - time.monotonic()))
+                if not done:
+                    yield held + compressor.flush()
+                    held, flush_by = b'', None
+                    continue
+            chunk = await pull
+            pull = None
+            if chunk is _END:
+                break
+            held += compressor.compress(chunk)
+            if compressor.pending >= max_pending:
+                yield held + compressor.flush()
+                held, flush_by = b'', None
+            elif flush_by is None:
+                flush_by = time.monotonic() + interval
+        yield held + compressor.finish()
+    finally:
+        if pull is not None:
+            pull.cancel()
+        compressor.report()
+
+
+def stream_encoding(request, expected_bytes: Optional[int]) -> Optional[str]:
+    """Content-Encoding for a stream of about ``expected_bytes``, or None to send it raw"""
+    if not getattr(settings, 'SSE_COMPRESSION', False) or expected_bytes is None:
+        return None
+    if expected_bytes < getattr(settings, 'SSE_COMPRESSION_MIN_BYTES', 4096):
+        return None
+    available = ('br', 'gzip') if brotli is not None else ('gzip',)
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''), available)
+    return None if encoding == 'identity' else encoding
+
+
+class SSEResponse(StreamingHttpResponse):
+    """Event-stream response that runs its ``on_close`` callbacks exactly once"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._finalizers = []
+
+    def on_close(self, callback: Callable[[], None]):
+        """
+        Run ``callback`` when the response is closed. ASGI skips ``close()``
+        when the client disconnects before the body is sent, so it also runs
+        when the response is garbage collected. ``callback`` must not refer
+        to the response.
+        """
+        self._finalizers.append(weakref.finalize(self, callback))
+
+    def close(self):
+        try:
+            for finalizer in self._finalizers:
+                finalizer()
+        finally:
+            super().close()
+
+
+def sse_response(request, iterator: Iterable[str], expected_bytes: Optional[int] = None) -> SSEResponse:
+    """
+    Build a text/event-stream response for a sync chunk generator.
+    ``expected_bytes`` (roughly how much the stream will carry) makes it
+    eligible for compression.
+    """
+    chunks = tracked(iterator)
+    is_async = isinstance(request, ASGIRequest)
+    content = aiter_chunks(chunks) if is_async else chunks
+    encoding = stream_encoding(request, expected_bytes)
+    if encoding:
+        compressor = StreamCompressor(encoding)
+        content = compress_async(content, compressor) if is_async else compress_sync(content, compressor)
+    response = SSEResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if getattr(settings, 'SSE_COMPRESSION', False):
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
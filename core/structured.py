@@ -0,0 +1,164 @@
+"""
+Structured (JSON schema) word analysis.
+
+Templates with ``output_format='structured'`` get their word analysis back
+as a JSON object, using the provider's structured output. The object has
+dictionary fields that do not depend on the document (``headword``,
+``ipa``, ``senses``) followed by contextual fields (``sentence``,
+``sentence_translation``, ``contextual_meaning``). ``FieldScanner`` picks
+each top-level field out of the streamed JSON as soon as it is complete,
+and the service sends it to the page as a ``field`` event.
+
+Dictionary fields are stored in ``LexiconEntry`` per model, template prompt
+and headword. When a word is looked up again, the stored fields are sent
+immediately and only the short contextual part is requested upstream.
+"""
+import hashlib
+import json
+import logging
+import re
+from typing import Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from .models import LexiconEntry
+
+logger = logging.getLogger(__name__)
+
+FIELD_PREFIX = '__FIELD__:'
+
+LEXICAL_FIELDS = {
+    'headword': {'type': 'string', 'description': 'The selected word or phrase in its dictionary form'},
+    'ipa': {'type': 'string', 'description': 'IPA pronunciation, without slashes'},
+    'senses': {
+        'type': 'array',
+        'description': 'The 2-3 most common senses',
+        'items': {
+            'type': 'object',
+            'properties': {
+                'pos': {'type': 'string', 'description': 'Part of speech abbreviation, e.g. n. / v. / adj.'},
+                'meaning': {'type': 'string', 'description': 'Short translated meanings'},
+            },
+            'required': ['pos', 'meaning'],
+            'additionalProperties': False,
+        },
+    },
+}
+CONTEXT_FIELDS = {
+    'sentence': {'type': 'string', 'description': 'The sentence of the text the selection appears in'},
+    'sentence_translation': {'type': 'string', 'description': 'Translation of that sentence'},
+    'contextual_meaning': {'type': 'string', 'description': 'What the selection means in this context'},
+}
+CONTEXT_ONLY_NOTE = (
+    '\n\nThe dictionary entry for this word is already known: fill in only the '
+    'sentence, its translation and the contextual meaning.'
+)
+
+
+def response_schema(lexical: bool = True) -> dict:
+    """Strict JSON schema for the analysis; ``lexical=False`` asks for the contextual fields only"""
+    properties = {**(LEXICAL_FIELDS if lexical else {}), **CONTEXT_FIELDS}
+    return {
+        'name': 'word_analysis' if lexical else 'word_context',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': properties,
+            'required': list(properties),
+            'additionalProperties': False,
+        },
+    }
+
+
+def field_marker(name: str, value, cached: bool = False) -> str:
+    """Service chunk carrying one completed field (see ``pipeline.iter_events``)"""
+    return FIELD_PREFIX + json.dumps({'name': name, 'value': value, 'cached': cached}, ensure_ascii=False)
+
+
+class FieldScanner:
+    """Yields top-level fields of a JSON object streamed in pieces, as each one completes"""
+
+    def __init__(self):
+        self._member: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> Iterator[Tuple[str, object]]:
+        for char in text:
+            if self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+                continue
+            if self._in_string:
+                self._member.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    yield from self._finish()
+                    continue
+            elif char == ',' and self._depth == 1:
+                yield from self._finish()
+                continue
+            self._member.append(char)
+
+    def _finish(self) -> Iterator[Tuple[str, object]]:
+        member = ''.join(self._member).strip()
+        self._member = []
+        if not member:
+            return
+        try:
+            yield from json.loads('{' + member + '}').items()
+        except ValueError:
+            pass  # malformed member: skip it, keep the rest
+
+
+def normalize_headword(text: str) -> str:
+    return re.sub(r'\s+', ' ', text.strip()).lower()
+
+
+def lexicon_key(template, model: str, selected_text: str) -> str:
+    # Editing the prompt or switching models starts a fresh lexicon
+    material = '\0'.join((model, template.prompt_text, normalize_headword(selected_text)))
+    return hashlib.blake2b(material.encode(), digest_size=16).hexdigest()
+
+
+def cached_lexical(template, model: str, selected_text: str) -> Optional[dict]:
+    """Stored dictionary fields for the selection, if it was analysed before"""
+    if not getattr(settings, 'LEXICON_CACHE_ENABLED', True):
+        return None
+    entry = LexiconEntry.objects.filter(key=lexicon_key(template, model, selected_text)).only('fields').first()
+    return entry.fields if entry is not None else None
+
+
+def store_lexical(template, model: str, selected_text: str, fields: dict):
+    """Remember the dictionary fields of a completed analysis"""
+    lexical = {name: fields[name] for name in LEXICAL_FIELDS if name in fields}
+    if len(lexical) != len(LEXICAL_FIELDS) or not getattr(settings, 'LEXICON_CACHE_ENABLED', True):
+        return
+    # Called from the stream's worker thread, outside any request cycle:
+    # take and give back the thread's connection as request_started and
+    # request_finished would, so it is not left open when the thread idles
+    close_old_connections()
+    try:
+        LexiconEntry.objects.update_or_create(
+            key=lexicon_key(template, model, selected_text),
+            defaults={'headword': normalize_headword(selected_text)[:200], 'model': model, 'fields': lexical},
+        )
+    except DatabaseError as e:
+        logger.warning('could not store lexicon entry: %s', e)
+    finally:
+        close_old_connections()
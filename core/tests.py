@@ -1 +1,1211 @@
-# Create your tests here.
+import asyncio
+import io
+import json
+import logging
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.http import StreamingHttpResponse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import admission, config_snapshot, documents, log, profiling, semantic_cache, streaming, viewport, warmup
+from .admission import AdmissionController, Limits, client_key
+from .latency import RouteDecision
+from .models import APIConfiguration, Document, PromptTemplate, UsageRecord
+from .openai_service import OpenAIService
+from .pipeline import PreparedStream
+from .prompts import compile_prompt, validate_prompt
+from .scheduler import BULK, INTERACTIVE_ANALYSIS, INTERACTIVE_TRANSLATION, Dispatcher, SchedulerTimeout
+from .segmentation import count_words, get_index, selection_word_count
+from .structured import LEXICAL_FIELDS, FieldScanner, cached_lexical, store_lexical
+from .tokens import CHUNKED, SINGLE, WINDOWED, ContextOverflow, plan
+from .usage import UsageWriter
+from .viewport import ParagraphSchedule, translate_paragraphs
+from .websocket import CLOSE_NOT_ALLOWED, WebSocketApp, origin_allowed
+
+TEST_MODEL = 'test-model'
+
+
+def _template(template_type, prompt_text):
+    return PromptTemplate(name='test', template_type=template_type, prompt_text=prompt_text)
+
+
+def _document(sentences):
+    return ' '.join(f'Sentence number {number} says something short.' for number in range(sentences))
+
+
+@override_settings(MODEL_CONTEXT_WINDOWS={TEST_MODEL: 2000}, PREFLIGHT_OUTPUT_RESERVE=500,
+                   PREFLIGHT_SAFETY_MARGIN=0, PREFLIGHT_REROUTE=True)
+class PlanTests(SimpleTestCase):
+    route = RouteDecision(model=TEST_MODEL, reasoning_effort='medium', verbosity='medium')
+    translation = _template('translation', 'Translate into English:\n{all_input}')
+    analysis = _template('sentence_analysis', 'Context:\n{all_input}\n\nExplain: {input_select}')
+
+    def test_single_when_the_prompt_fits(self):
+        text = _document(5)
+        result = plan(self.translation, self.route, text)
+        self.assertEqual(result.strategy, SINGLE)
+        self.assertEqual(result.spans, ())
+        self.assertEqual(result.budget, 1500)
+        self.assertEqual(result.meta['chunks'], 1)
+
+    def test_chunked_spans_cover_the_text_in_order(self):
+        text = _document(400)
+        result = plan(self.translation, self.route, text)
+        self.assertEqual(result.strategy, CHUNKED)
+        self.assertGreater(len(result.spans), 1)
+        self.assertEqual(result.meta['chunks'], len(result.spans))
+        self.assertEqual(result.spans[0][0], 0)
+        self.assertEqual(result.spans[-1][1], len(text))
+        for (_, end), (start, _) in zip(result.spans, result.spans[1:]):
+            self.assertEqual(end, start)
+        index = get_index(text)
+        for start, end in result.spans:
+            # Cut between sentences, each piece within the input budget
+            self.assertTrue(text[start:end].rstrip().endswith('.'))
+            self.assertLessEqual(index.approx_tokens(start, end), result.budget)
+
+    def test_windowed_span_surrounds_the_selection(self):
+        text = _document(400)
+        selection = 'Sentence number 200 says something short.'
+        start = text.index(selection)
+        result = plan(self.analysis, self.route, text, selection, (start, start + len(selection)))
+        self.assertEqual(result.strategy, WINDOWED)
+        self.assertEqual(len(result.spans), 1)
+        window_start, window_end = result.spans[0]
+        self.assertLessEqual(window_start, start)
+        self.assertGreaterEqual(window_end, start + len(selection))
+        self.assertLess(window_end - window_start, len(text))
+        self.assertTrue(text[window_start:].startswith('Sentence number'))
+        self.assertLessEqual(get_index(text).approx_tokens(window_start, window_end), result.budget)
+
+    def test_windowed_needs_the_selection_span(self):
+        text = _document(400)
+        with self.assertRaises(ContextOverflow):
+            plan(self.analysis, self.route, text, 'Sentence number 200 says something short.')
+
+    def test_selection_too_long_for_any_window(self):
+        text = _document(400)
+        with self.assertRaises(ContextOverflow):
+            plan(self.analysis, self.route, text, text[:len(text) // 2], (0, len(text) // 2))
+
+    @override_settings(PREFLIGHT_REROUTE=False)
+    def test_overflow_without_rerouting(self):
+        with self.assertRaises(ContextOverflow):
+            plan(self.translation, self.route, _document(400))
+
+
+class SegmentationTests(SimpleTestCase):
+    def assertChunks(self, text, max_tokens):
+        index = get_index(text)
+        spans = index.chunks(max_tokens)
+        self.assertEqual(spans[0][0], 0)
+        self.assertEqual(spans[-1][1], len(text))
+        for (_, end), (start, _) in zip(spans, spans[1:]):
+            self.assertEqual(end, start)
+        for start, end in spans:
+            self.assertLessEqual(index.approx_tokens(start, end), max_tokens, text[start:end])
+        return spans
+
+    def test_chunks_cut_between_sentences(self):
+        text = _document(50)
+        spans = self.assertChunks(text, 40)
+        self.assertGreater(len(spans), 1)
+        for start, end in spans:
+            self.assertTrue(text[start:end].rstrip().endswith('.'))
+
+    def test_chunks_split_long_sentences_at_tokens(self):
+        text = 'Short one. ' + ' '.join(f'word{number}' for number in range(200)) + '. Tail.'
+        spans = self.assertChunks(text, 30)
+        self.assertGreater(len(spans), 5)
+        index = get_index(text)
+        for start, _ in spans:
+            self.assertIn(start, index.token_starts)
+
+    def test_chunks_count_punctuation(self):
+        text = ' '.join(f'a, b; c: {number}!' for number in range(60)).replace('!', ',') + '.'
+        self.assertChunks(text, 20)
+
+    def test_chunks_of_cjk_text(self):
+        text = '我们今天去公园散步，天气很好。' * 20
+        spans = self.assertChunks(text, 25)
+        self.assertGreater(len(spans), 1)
+
+    def test_short_document_is_one_chunk(self):
+        self.assertEqual(get_index('One sentence.').chunks(100), [(0, 13)])
+
+    def test_counts(self):
+        self.assertEqual(count_words("It's a well-known fact."), 4)
+        self.assertEqual(count_words('日本語のテキスト'), 8)
+        self.assertEqual(count_words('한국어 문장'), 2)
+        self.assertEqual(selection_word_count('  the quick brown fox '), 4)
+        index = get_index('Hello, world! 你好。')
+        self.assertEqual(index.word_count(), 4)
+        self.assertEqual(index.word_count(0, 5), 1)
+        # Words, CJK characters and punctuation each cost a token
+        self.assertEqual(index.approx_tokens(), 9)
+        self.assertEqual(index.approx_tokens(0, 6), 3)
+
+
+# Embeddings the stub endpoint returns, by input text
+EMBEDDINGS = {
+    'The cat sat on the mat.': [1.0, 0.0, 0.0],
+    'the cat sat on the mat': [1.0, 0.0, 0.0],
+    'A cat sat on a mat.': [0.96, 0.28, 0.0],  # cosine 0.96 with the first
+    'Dogs bark at night.': [0.0, 0.0, 1.0],
+}
+
+
+class _EmbeddingsStub(BaseHTTPRequestHandler):
+    calls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        type(self).calls += 1
+        payload = json.dumps({
+            'object': 'list', 'model': body['model'],
+            'data': [{'object': 'embedding', 'index': 0, 'embedding': EMBEDDINGS[body['input']]}],
+            'usage': {'prompt_tokens': 1, 'total_tokens': 1},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@skipUnless(semantic_cache.np is not None, 'NumPy is not installed')
+class SemanticCacheTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _EmbeddingsStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings = override_settings(
+            SEMANTIC_CACHE_ENABLED=True, SEMANTIC_CACHE_THRESHOLD=0.95,
+            SEMANTIC_CACHE_EMBEDDING_BASE_URL=f'http://127.0.0.1:{cls.server.server_address[1]}/v1')
+        cls.settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        semantic_cache.cache.clear()
+        self.template = PromptTemplate(
+            pk=1, name='test', template_type='sentence_analysis', prompt_text='Explain: {input_select}',
+            api_config=APIConfiguration(name='test', api_key='', model_name=TEST_MODEL),
+        )
+        self.upstream_calls = 0
+
+    def analyse(self, text):
+        def fresh():
+            self.upstream_calls += 1
+            yield f'analysis {self.upstream_calls}'
+        chunks = list(semantic_cache.cached_chunks(self.template, text, fresh))
+        outcome = json.loads(chunks[0][len(semantic_cache.CACHE_PREFIX):])
+        return outcome, ''.join(chunks[1:])
+
+    def test_miss_then_hit(self):
+        self.assertTrue(semantic_cache.usable(self.template))
+        self.assertEqual(self.analyse('The cat sat on the mat.'), ({'result': 'miss'}, 'analysis 1'))
+        outcome, analysis = self.analyse('A cat sat on a mat.')
+        self.assertEqual(outcome, {'result': 'hit', 'similarity': 0.96})
+        self.assertEqual(analysis, 'analysis 1')
+        self.assertEqual(self.upstream_calls, 1)
+
+    def test_normalized_text_hits_without_embedding(self):
+        self.analyse('The cat sat on the mat.')
+        calls = _EmbeddingsStub.calls
+        outcome, _ = self.analyse('the cat sat on the mat')
+        self.assertEqual(outcome, {'result': 'hit', 'similarity': 1.0})
+        self.assertEqual(_EmbeddingsStub.calls, calls)
+
+    def test_distant_selection_misses(self):
+        self.analyse('The cat sat on the mat.')
+        self.assertEqual(self.analyse('Dogs bark at night.'), ({'result': 'miss'}, 'analysis 2'))
+
+    def test_threshold(self):
+        self.analyse('The cat sat on the mat.')
+        with override_settings(SEMANTIC_CACHE_THRESHOLD=0.97):
+            self.assertEqual(self.analyse('A cat sat on a mat.'), ({'result': 'miss'}, 'analysis 2'))
+
+    def test_template_change_invalidates(self):
+        self.analyse('The cat sat on the mat.')
+        self.template.prompt_text = 'Explain in detail: {input_select}'
+        self.assertEqual(self.analyse('the cat sat on the mat'), ({'result': 'miss'}, 'analysis 2'))
+        self.template.api_config.model_name = 'other-model'
+        self.assertEqual(self.analyse('A cat sat on a mat.'), ({'result': 'miss'}, 'analysis 3'))
+
+    def test_superseded_version_is_evicted(self):
+        self.analyse('The cat sat on the mat.')
+        self.template.prompt_text = 'Explain in detail: {input_select}'
+        self.analyse('Dogs bark at night.')
+        snapshot = semantic_cache.cache.snapshot()
+        self.assertEqual((snapshot['template_versions'], snapshot['entries']), (1, 1))
+
+    def test_store_for_superseded_version_is_dropped(self):
+        chunks = semantic_cache.cached_chunks(self.template, 'The cat sat on the mat.', lambda: iter(['old']))
+        next(chunks)
+        self.template.prompt_text = 'Explain in detail: {input_select}'
+        self.analyse('Dogs bark at night.')
+        list(chunks)
+        self.assertEqual(semantic_cache.cache.snapshot()['entries'], 1)
+
+    def test_only_control_chunks_are_left_out(self):
+        def fresh():
+            yield '__THINKING__:hmm'
+            yield '__THINKING_DONE__'
+            yield '__init__ is '
+            yield 'a constructor'
+        list(semantic_cache.cached_chunks(self.template, 'The cat sat on the mat.', fresh))
+        self.assertEqual(self.analyse('the cat sat on the mat')[1], '__init__ is a constructor')
+
+    def test_failed_analysis_is_not_stored(self):
+        def failing():
+            yield 'Error: upstream refused'
+        list(semantic_cache.cached_chunks(self.template, 'The cat sat on the mat.', failing))
+        self.assertEqual(self.analyse('The cat sat on the mat.'), ({'result': 'miss'}, 'analysis 1'))
+
+    def test_lookup_waits_for_the_stream(self):
+        calls = _EmbeddingsStub.calls
+        chunks = semantic_cache.cached_chunks(self.template, 'The cat sat on the mat.', lambda: iter(()))
+        self.assertEqual(_EmbeddingsStub.calls, calls)
+        next(chunks)
+        self.assertEqual(_EmbeddingsStub.calls, calls + 1)
+
+
+def _replace_render(prompt_text, all_input='', input_select=''):
+    """How prompts were rendered before templates were compiled"""
+    return prompt_text.replace('{all_input}', all_input).replace('{input_select}', input_select)
+
+
+class CompiledPromptTests(SimpleTestCase):
+    templates = (
+        'Translate:\n{all_input}',
+        'Context: {all_input}\nExplain "{input_select}" ({input_select}) here.',
+        '{input_select}{all_input}{input_select}',
+        'JSON like {"word": "{input_select}", "note": {}} and {{all_input}} and {unknown}',
+        'No placeholders at all',
+        '',
+    )
+
+    def test_render_matches_str_replace(self):
+        for template in self.templates:
+            with self.subTest(template=template):
+                rendered = compile_prompt(template).render(all_input='A {b} c', input_select='sel')
+                self.assertEqual(rendered, _replace_render(template, 'A {b} c', 'sel'))
+
+    def test_values_are_not_scanned_for_placeholders(self):
+        # str.replace would substitute the selection into the document text
+        prompt = compile_prompt('{all_input} / {input_select}')
+        self.assertEqual(prompt.render(all_input='see {input_select}', input_select='x'),
+                         'see {input_select} / x')
+
+    def test_parts_skeleton_and_counts(self):
+        prompt = compile_prompt('a{input_select}b{all_input}c{input_select}')
+        self.assertEqual(prompt.parts, ('a', 'input_select', 'b', 'all_input', 'c', 'input_select', ''))
+        self.assertEqual(prompt.skeleton, 'abc')
+        self.assertEqual(prompt.count('input_select'), 2)
+        self.assertEqual(prompt.count('all_input'), 1)
+        self.assertEqual(prompt.placeholders, ('input_select', 'all_input'))
+
+    def test_missing_values_render_empty(self):
+        self.assertEqual(compile_prompt('[{all_input}|{input_select}]').render(all_input='x'), '[x|]')
+
+    def test_compiled_once_per_text(self):
+        self.assertIs(compile_prompt('Translate: {all_input}'), compile_prompt('Translate: {all_input}'))
+
+    def test_validate_prompt(self):
+        self.assertEqual(validate_prompt('translation', 'Translate: {all_input}'), [])
+        self.assertEqual(validate_prompt('word_analysis', 'Word {input_select} in {all_input}'), [])
+        self.assertEqual(validate_prompt('translation', 'Translate this'),
+                         ['translation templates must contain {all_input}'])
+        self.assertEqual(validate_prompt('translation', 'Translate {all_input} {input_select}'),
+                         ['{input_select} has no value in translation templates'])
+
+
+def _isolate_config_version(test):
+    """Point the config version stamp at a temporary file for the test"""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    stamp = override_settings(CONFIG_VERSION_FILE=f'{directory.name}/.config_version')
+    stamp.enable()
+    test.addCleanup(stamp.disable)
+    config_snapshot.invalidate()
+    test.addCleanup(config_snapshot.invalidate)
+
+
+class ConfigSnapshotTests(TestCase):
+    def setUp(self):
+        _isolate_config_version(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_config = APIConfiguration.objects.create(name='test', api_key='', model_name=TEST_MODEL)
+
+    def create_template(self, prompt_text='Translate: {all_input}'):
+        return PromptTemplate.objects.create(name='test', template_type='translation', prompt_text=prompt_text,
+                                             api_config=self.api_config)
+
+    def test_save_bumps_the_version_on_commit(self):
+        version = config_snapshot.read_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.create_template()
+        # Not before the transaction commits
+        self.assertEqual(config_snapshot.read_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(config_snapshot.read_version(), version)
+
+    def test_delete_bumps_the_version_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            template = self.create_template()
+        version = config_snapshot.read_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            template.delete()
+        self.assertNotEqual(config_snapshot.read_version(), version)
+
+    def test_next_read_rebuilds_the_snapshot(self):
+        before = config_snapshot.get_snapshot()
+        self.assertIs(config_snapshot.get_snapshot(), before)
+        self.assertNotIn('translation', before.templates)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_template()
+        after = config_snapshot.get_snapshot()
+        self.assertIsNot(after, before)
+        self.assertNotEqual(after.version, before.version)
+        self.assertEqual(after.templates['translation'].prompt_text, 'Translate: {all_input}')
+
+    def test_templates_are_handed_out_as_copies(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_template()
+        snapshot = config_snapshot.get_snapshot()
+        template = snapshot.templates['translation']
+        template.prompt_text = 'Changed: {all_input}'
+        template.api_config.model_name = 'other-model'
+        with self.assertNumQueries(0):
+            fresh = config_snapshot.get_snapshot().templates['translation']
+            self.assertEqual(fresh.prompt_text, 'Translate: {all_input}')
+            self.assertEqual(fresh.api_config.model_name, TEST_MODEL)
+        self.assertEqual(dict(snapshot.templates)['translation'].prompt_text, 'Translate: {all_input}')
+
+
+class WebSocketOriginTests(SimpleTestCase):
+    def test_same_origin_is_allowed(self):
+        self.assertTrue(origin_allowed({'host': 'reader.test:8000', 'origin': 'http://reader.test:8000'}))
+        self.assertTrue(origin_allowed({'host': 'reader.test'}))
+
+    def test_cross_site_origin_is_refused(self):
+        self.assertFalse(origin_allowed({'host': 'reader.test', 'origin': 'https://evil.test'}))
+
+    @override_settings(CSRF_TRUSTED_ORIGINS=['https://*.example.com'], ALLOWED_HOSTS=['*', 'reader.test'])
+    def test_trusted_origins_and_allowed_hosts(self):
+        self.assertTrue(origin_allowed({'host': 'internal:8000', 'origin': 'https://app.example.com'}))
+        self.assertFalse(origin_allowed({'host': 'internal:8000', 'origin': 'http://app.example.com'}))
+        self.assertTrue(origin_allowed({'host': 'internal:8000', 'origin': 'https://reader.test'}))
+
+    async def test_handshake_is_closed_before_accept(self):
+        async def app(scope, receive, send):
+            raise AssertionError('HTTP app called')
+
+        async def receive():
+            return {'type': 'websocket.connect'}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'websocket', 'path': '/ws/stream/', 'client': ('127.0.0.1', 1),
+                 'headers': [(b'host', b'reader.test'), (b'origin', b'https://evil.test')]}
+        with self.assertLogs('core.websocket', 'WARNING'):
+            await WebSocketApp(app)(scope, receive, send)
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': CLOSE_NOT_ALLOWED}])
+
+
+class ConditionalRequestTests(TestCase):
+    url = reverse('core:api_configs_list')
+
+    def setUp(self):
+        _isolate_config_version(self)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_config = APIConfiguration.objects.create(name='test', api_key='', model_name=TEST_MODEL)
+
+    def test_matching_etag_is_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+    def test_unchanged_since_last_modified_is_not_modified(self):
+        response = self.client.get(self.url)
+        again = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_config_write_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_config.model_name = 'other-model'
+            self.api_config.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['configs'][0]['model_name'], 'other-model')
+
+    def test_page_and_fields_change_the_etag(self):
+        etags = {self.client.get(self.url, query)['ETag']
+                 for query in ({}, {'page': 2}, {'fields': 'id,name'}, {'fields': 'id,model_name'})}
+        self.assertEqual(len(etags), 4)
+        etag = self.client.get(self.url, {'fields': 'id,name'})['ETag']
+        self.assertEqual(self.client.get(self.url, {'fields': 'id,name'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+def _usage_record(**fields):
+    return UsageRecord(created_at=timezone.now(), template_type='translation', model=TEST_MODEL,
+                       duration_ms=10.0, **fields)
+
+
+# The writer thread is not started: batches are written by flush() in the test's thread
+@mock.patch.object(UsageWriter, '_ensure_thread')
+class UsageWriterTests(TestCase):
+    def test_flush_writes_the_queued_batches(self, ensure_thread):
+        writer = UsageWriter(batch_size=2, flush_interval=1.0, max_queue=10)
+        for tokens in range(5):
+            writer.submit(_usage_record(prompt_tokens=tokens))
+        self.assertEqual(writer.pending, 5)
+        with self.assertNumQueries(3):
+            writer.flush()
+        self.assertEqual(writer.pending, 0)
+        self.assertEqual((writer.written, writer.dropped), (5, 0))
+        self.assertEqual(sorted(UsageRecord.objects.values_list('prompt_tokens', flat=True)), [0, 1, 2, 3, 4])
+
+    def test_full_queue_drops_and_counts(self, ensure_thread):
+        writer = UsageWriter(batch_size=10, flush_interval=1.0, max_queue=2)
+        for _ in range(5):
+            writer.submit(_usage_record())
+        self.assertEqual((writer.pending, writer.dropped), (2, 3))
+        writer.flush()
+        self.assertEqual((writer.written, writer.dropped), (2, 3))
+        self.assertEqual(UsageRecord.objects.count(), 2)
+
+    def test_failed_write_counts_the_batch_as_dropped(self, ensure_thread):
+        writer = UsageWriter(batch_size=10, flush_interval=1.0, max_queue=10)
+        writer.submit(_usage_record())
+        writer.submit(_usage_record())
+        with mock.patch.object(UsageRecord.objects, 'bulk_create', side_effect=RuntimeError('database is locked')), \
+                mock.patch('core.usage.connection'), self.assertLogs('core.usage', 'ERROR'):
+            writer.flush()
+        self.assertEqual((writer.written, writer.dropped), (0, 2))
+
+
+class OpsEndpointTests(TestCase):
+    urls = ('core:usage_summary', 'core:scheduler_stats', 'core:admission_stats')
+
+    def get(self, **headers):
+        return {name: self.client.get(reverse(name), **headers).status_code for name in self.urls}
+
+    @override_settings(DEBUG=False, OPS_TOKEN='')
+    def test_hidden_without_debug_or_token(self):
+        self.assertEqual(set(self.get().values()), {404})
+
+    @override_settings(DEBUG=True, OPS_TOKEN='')
+    def test_open_in_debug(self):
+        self.assertEqual(set(self.get().values()), {200})
+
+    @override_settings(DEBUG=True, OPS_TOKEN='secret')
+    def test_token_required_once_configured(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(set(self.get().values()), {403})
+            self.assertEqual(set(self.get(HTTP_X_OPS_TOKEN='wrong').values()), {403})
+        self.assertEqual(set(self.get(HTTP_X_OPS_TOKEN='secret').values()), {200})
+
+
+def _dispatcher(max_concurrency=1, interactive_reserve=0, **max_wait):
+    return Dispatcher(max_concurrency, interactive_reserve, weights={INTERACTIVE_ANALYSIS: 8,
+                      INTERACTIVE_TRANSLATION: 3, BULK: 1}, max_wait=max_wait)
+
+
+class DispatcherTests(SimpleTestCase):
+    def wait_until(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('condition not reached')
+
+    def queued(self, dispatcher, priority):
+        return dispatcher.snapshot()['classes'][priority]['queued']
+
+    def test_reserved_slots_only_go_to_interactive_work(self):
+        dispatcher = _dispatcher(max_concurrency=2, interactive_reserve=1)
+        dispatcher.acquire(BULK)
+        with self.assertRaises(SchedulerTimeout):
+            dispatcher.acquire(BULK, timeout=0.05)
+        dispatcher.acquire(INTERACTIVE_ANALYSIS, timeout=0.05)
+        self.assertEqual(dispatcher.snapshot()['running'], 2)
+
+    def test_slots_go_by_priority_not_arrival(self):
+        dispatcher = _dispatcher()
+        dispatcher.acquire(BULK)
+        order = []
+
+        def call(priority):
+            with dispatcher.slot(priority):
+                order.append(priority)
+
+        threads = []
+        for priority in (BULK, INTERACTIVE_TRANSLATION, INTERACTIVE_ANALYSIS):
+            thread = threading.Thread(target=call, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            self.wait_until(lambda: self.queued(dispatcher, priority) == 1)
+        dispatcher.release(BULK)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [INTERACTIVE_ANALYSIS, INTERACTIVE_TRANSLATION, BULK])
+        self.assertEqual(dispatcher.snapshot()['running'], 0)
+
+    def test_timeout_after_the_class_max_wait(self):
+        dispatcher = _dispatcher(**{INTERACTIVE_ANALYSIS: 0.1})
+        dispatcher.acquire(BULK)
+        started = time.perf_counter()
+        with self.assertRaises(SchedulerTimeout):
+            dispatcher.acquire(INTERACTIVE_ANALYSIS)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.1)
+        stats = dispatcher.snapshot()['classes'][INTERACTIVE_ANALYSIS]
+        self.assertEqual((stats['timeouts'], stats['queued'], stats['running']), (1, 0, 0))
+
+    def test_closing_the_stream_releases_its_slot(self):
+        dispatcher = _dispatcher()
+        service = OpenAIService(APIConfiguration(name='test', api_key='', model_name=TEST_MODEL))
+        route = RouteDecision(model=TEST_MODEL, reasoning_effort='low', verbosity='low')
+        with mock.patch('core.openai_service.dispatcher', dispatcher), \
+                mock.patch.object(service, '_stream_measured', return_value=iter(['a', 'b'])):
+            stream = service._stream_upstream('prompt', route, 'Test', priority=INTERACTIVE_ANALYSIS)
+            self.assertEqual(next(stream), 'a')
+            self.assertEqual(dispatcher.snapshot()['running'], 1)
+            stream.close()
+        self.assertEqual(dispatcher.snapshot()['running'], 0)
+        dispatcher.acquire(BULK, timeout=0.05)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdmissionTests(TestCase):
+    def controller(self, **limits):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        defaults = dict(rate=1.0, burst=100, max_streams=100, max_prompt_tokens=10 ** 6, lease_ttl=60,
+                        stream_retry_after=2)
+        return AdmissionController(f'{directory.name}/admission.sqlite3', Limits(**{**defaults, **limits}))
+
+    def open_streams(self, controller):
+        return controller.snapshot()['open_streams']
+
+    def test_token_bucket_refills_at_the_rate(self):
+        controller = self.controller(rate=2.0, burst=2)
+        clock = _Clock()
+        with mock.patch('core.admission.time.time', clock):
+            self.assertTrue(controller.admit('a').allowed)
+            self.assertTrue(controller.admit('a').allowed)
+            rejected = controller.admit('a')
+            self.assertEqual((rejected.allowed, rejected.reason, rejected.retry_after), (False, 'rate', 1))
+            # Other clients have their own bucket
+            self.assertTrue(controller.admit('b').allowed)
+            clock.now += 0.5
+            self.assertTrue(controller.admit('a').allowed)
+            self.assertFalse(controller.admit('a').allowed)
+            # Never more than the burst, however long the client was idle
+            clock.now += 3600
+            self.assertEqual([controller.admit('a').allowed for _ in range(3)], [True, True, False])
+        self.assertEqual(controller.snapshot()['rejections'], {'rate': 3})
+
+    def test_open_stream_limit(self):
+        controller = self.controller(max_streams=2)
+        first, second = controller.admit('a'), controller.admit('a')
+        self.assertEqual(controller.admit('a').reason, 'streams')
+        self.assertTrue(controller.admit('b').allowed)
+        controller.release(first.lease_id)
+        self.assertTrue(controller.admit('a').allowed)
+        self.assertEqual(self.open_streams(controller), 3)
+        self.assertIsNotNone(second.lease_id)
+
+    def test_expired_leases_do_not_count(self):
+        controller = self.controller(max_streams=1, lease_ttl=10)
+        clock = _Clock()
+        with mock.patch('core.admission.time.time', clock):
+            controller.admit('a')
+            self.assertFalse(controller.admit('a').allowed)
+            clock.now += 11
+            self.assertTrue(controller.admit('a').allowed)
+
+    def test_charge_after_admit_caps_prompt_tokens(self):
+        controller = self.controller(max_prompt_tokens=100)
+        first = controller.admit('a')
+        self.assertEqual(controller.charge('a', first, 80), first)
+        second = controller.admit('a')
+        rejected = controller.charge('a', second, 50)
+        self.assertEqual((rejected.allowed, rejected.reason, rejected.lease_id), (False, 'prompt_tokens', None))
+        # The refused request's lease is gone; the first is still charged
+        self.assertEqual(controller.snapshot()['clients'], [{'key': 'a', 'open_streams': 1, 'prompt_tokens': 80}])
+        controller.release(first.lease_id)
+        # A single oversized request is let through on its own
+        alone = controller.admit('a')
+        self.assertTrue(controller.charge('a', alone, 500).allowed)
+
+    def test_lease_is_released_when_the_response_closes(self):
+        controller = self.controller()
+        prepared = PreparedStream(template=None, route=None, chunks=lambda: iter(['Hello']), prompt_tokens=7,
+                                  meta={'prompt_tokens': 7, 'strategy': 'single'})
+        with mock.patch('core.views.admission_controller', controller), \
+                mock.patch('core.views.prepare_translation', return_value=prepared):
+            response = self.client.post(reverse('core:stream_translation'), {'text': 'Hello'},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(controller.snapshot()['clients'][0]['prompt_tokens'], 7)
+            b''.join(response.streaming_content)
+        self.assertEqual(self.open_streams(controller), 0)
+
+    def test_sync_endpoints_are_admitted(self):
+        controller = self.controller(rate=0.001, burst=2)
+        with mock.patch('core.views.admission_controller', controller):
+            for name in ('core:translate_text', 'core:analyze_word'):
+                response = self.client.post(reverse(name), {'text': 'x', 'all_text': 'x', 'selected_text': 'x'},
+                                            content_type='application/json')
+                # No templates are configured; the lease is still released
+                self.assertEqual(response.status_code, 400)
+            with self.assertLogs('django.request', 'WARNING'):
+                response = self.client.post(reverse('core:translate_text'), {'text': 'x'},
+                                            content_type='application/json')
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response)
+        self.assertEqual(self.open_streams(controller), 0)
+
+    def test_session_checks_are_cached(self):
+        admission.known_sessions.clear()
+        self.addCleanup(admission.known_sessions.clear)
+        session = SessionStore()
+        session.create()
+        cookies = {'sessionid': session.session_key}
+        key = client_key(cookies, '10.0.0.1')
+        self.assertTrue(key.startswith('session:'))
+        with self.assertNumQueries(0):
+            self.assertEqual(client_key(cookies, '10.0.0.1'), key)
+        self.assertEqual(client_key({'sessionid': 'made-up'}, '10.0.0.1'), 'addr:10.0.0.1')
+        with self.assertNumQueries(0):
+            self.assertEqual(client_key({'sessionid': 'made-up'}, '10.0.0.2'), 'addr:10.0.0.2')
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(profiling, 'store', profiling.ProfileStore(directory.name, 3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN='secret')
+    def test_ring_keeps_the_newest_profiles(self):
+        ids = []
+        for _ in range(5):
+            response = self.client.get(reverse('core:api_configs_list'), HTTP_X_PROFILE_TOKEN='secret')
+            ids.append(response['X-Profile-Id'])
+        # Requests without the token are not profiled
+        self.assertNotIn('X-Profile-Id', self.client.get(reverse('core:api_configs_list')))
+
+        listed = self.client.get(reverse('core:profile_index'), HTTP_X_PROFILE_TOKEN='secret').json()['profiles']
+        self.assertEqual([profile['id'] for profile in listed], ids[:-4:-1])
+        detail = self.client.get(reverse('core:profile_detail', args=[ids[-1]]), HTTP_X_PROFILE_TOKEN='secret').json()
+        self.assertEqual((detail['path'], detail['status'], detail['mode']), ('/api/configs/', 200, 'timing'))
+        self.assertIn('db', detail['phases'])
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.get(reverse('core:profile_detail', args=[ids[0]]),
+                                             HTTP_X_PROFILE_TOKEN='secret').status_code, 404)
+
+    def test_guard(self):
+        url = reverse('core:profile_index')
+        with self.assertLogs('django.request', 'WARNING'):
+            with override_settings(PROFILING_ENABLED=False, DEBUG=True):
+                self.assertEqual(self.client.get(url).status_code, 404)
+            with override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN='secret', DEBUG=True):
+                self.assertEqual(self.client.get(url).status_code, 403)
+                self.assertEqual(self.client.get(url, HTTP_X_PROFILE_TOKEN='wrong').status_code, 403)
+            with override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN='', DEBUG=False):
+                self.assertEqual(self.client.get(url).status_code, 403)
+        with override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_X_PROFILE_TOKEN='secret').json(), {'profiles': []})
+        with override_settings(PROFILING_ENABLED=True, PROFILING_TOKEN='', DEBUG=True):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+def _epub(chapters, spine=None):
+    """EPUB bytes with ``chapters`` (name -> XHTML) read in ``spine`` order"""
+    spine = spine or list(chapters)
+    manifest = ''.join(f'<item id="{name}" href="text/{name}" media-type="application/xhtml+xml"/>'
+                       for name in chapters)
+    itemrefs = ''.join(f'<itemref idref="{name}"/>' for name in spine)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('mimetype', 'application/epub+zip')
+        archive.writestr('META-INF/container.xml', (
+            '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+            '<rootfile full-path="OEBPS/content.opf"/></rootfiles></container>'))
+        archive.writestr('OEBPS/content.opf', (
+            f'<package xmlns="http://www.idpf.org/2007/opf"><manifest>{manifest}</manifest>'
+            f'<spine>{itemrefs}</spine></package>'))
+        for name, body in chapters.items():
+            archive.writestr(f'OEBPS/text/{name}', body)
+    return buffer.getvalue()
+
+
+class DocumentTests(TestCase):
+    url = reverse('core:documents_list')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(DOCUMENT_STORAGE_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.storage = directory.name
+
+    def upload(self, name, content, status=201, content_type='text/plain'):
+        response = self.client.post(self.url, {'file': SimpleUploadedFile(name, content, content_type)})
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def paragraphs(self, name, content):
+        handle = self.upload(name, content)['document']
+        document = Document.objects.get(handle=handle)
+        text_path, index_path = documents._paths(handle)
+        # The index holds each paragraph's byte offset and length in the text file
+        data = text_path.read_bytes()
+        offsets = array('Q', index_path.read_bytes())
+        self.assertEqual(len(offsets), 2 * document.paragraph_count)
+        stored = [data[offset:offset + length].decode('utf-8') for offset, length in zip(offsets[::2], offsets[1::2])]
+        self.assertEqual(b'\n\n'.join(paragraph.encode() for paragraph in stored), data)
+        self.assertEqual(documents.read_paragraphs(document, 0, document.paragraph_count), stored)
+        return stored
+
+    def test_text_round_trip(self):
+        content = 'First  paragraph,\r\nsecond line.\r\n\r\n\n  Second paragraph.  \n\n\nThird: 日本語。'
+        self.assertEqual(self.paragraphs('notes.txt', content.encode()),
+                         ['First  paragraph,\nsecond line.', 'Second paragraph.', 'Third: 日本語。'])
+
+    def test_paragraph_ranges(self):
+        handle = self.upload('many.txt', '\n\n'.join(f'Paragraph {n}.' for n in range(30)).encode())['document']
+        url = reverse('core:document_paragraphs', args=[handle])
+        page = self.client.get(url, {'start': 28, 'count': 5}).json()
+        self.assertEqual(page['paragraphs'], ['Paragraph 28.', 'Paragraph 29.'])
+        self.assertFalse(page['has_next'])
+        self.assertEqual(documents.document_text({'document': handle, 'start': 3, 'count': 2}),
+                         'Paragraph 3.\n\nParagraph 4.')
+
+    def test_long_paragraphs_are_split(self):
+        with override_settings(DOCUMENT_MAX_PARAGRAPH_CHARS=100):
+            stored = self.paragraphs('long.txt', ' '.join(['A sentence here.'] * 40).encode())
+        self.assertGreater(len(stored), 5)
+        self.assertTrue(all(len(paragraph) <= 100 for paragraph in stored))
+
+    def test_markdown_keeps_indentation(self):
+        content = b'# Title\n\n    code line\n    more code\n\n- item\n  continued\n'
+        self.assertEqual(self.paragraphs('readme.md', content),
+                         ['# Title', '    code line\n    more code', '- item\n  continued'])
+
+    def test_html_round_trip(self):
+        content = ('<html><head><title>T</title><style>p {}</style></head><body>'
+                   '<h1>Heading</h1><p>One &amp; <b>two</b>\n  words.</p><script>var x;</script>'
+                   '<div>Line<br>break</div></body></html>').encode()
+        self.assertEqual(self.paragraphs('page.html', content), ['Heading', 'One & two words.', 'Line\nbreak'])
+
+    def test_epub_follows_the_spine(self):
+        content = _epub({'a.xhtml': '<html><body><p>Chapter A.</p></body></html>',
+                         'b.xhtml': '<html><body><p>Chapter B.</p><p>More B.</p></body></html>'},
+                        spine=['b.xhtml', 'a.xhtml'])
+        self.assertEqual(self.paragraphs('book.epub', content), ['Chapter B.', 'More B.', 'Chapter A.'])
+
+    def test_broken_epub_is_refused(self):
+        self.assertIn('not a zip archive', self.upload('book.epub', b'not a zip', status=400)['error'])
+
+    def test_charsets(self):
+        self.assertEqual(self.paragraphs('gbk.txt', '简体中文文本。'.encode('gbk')), ['简体中文文本。'])
+        self.assertEqual(self.paragraphs('utf16.txt', '\ufeffÜber'.encode('utf-16-le')), ['Über'])
+        self.assertEqual(self.paragraphs('bom.txt', '\ufeffCafé'.encode('utf-8')), ['Café'])
+        html = '<html><head><meta charset="windows-1252"></head><body><p>Caf\xe9 \u201cquoted\u201d</p>'
+        self.assertEqual(self.paragraphs('page.html', html.encode('cp1252')), ['Café “quoted”'])
+
+    def test_undecodable_files_are_refused(self):
+        error = self.upload('bad.txt', b'Hello \xff\x80 world', status=400)['error']
+        self.assertIn('Could not detect the text encoding', error)
+        # A guessed encoding must hold for the whole file, not just the first chunk
+        with self.assertRaisesMessage(documents.IngestError, 'not valid utf-8 (near byte 9)'):
+            list(documents._decoded([b'First ok ', b'\xff\x80 later']))
+        self.assertEqual(Document.objects.count(), 0)
+        self.assertEqual(list(Path(self.storage).iterdir()), [])
+
+    def test_unsupported_type_and_empty_file(self):
+        self.upload('image.png', b'\x89PNG', status=415, content_type='image/png')
+        self.upload('empty.txt', b'\n\n  \n', status=400)
+
+    @override_settings(DOCUMENT_MAX_UPLOAD_BYTES=10 * 1024)
+    def test_size_limits(self):
+        self.upload('big.txt', b'x ' * 6 * 1024, status=413)
+        # Compressed under the limit, unpacked over it
+        bomb = _epub({'a.xhtml': '<html><body><p>' + 'a' * 50 * 1024 + '</p></body></html>'})
+        self.assertLess(len(bomb), 10 * 1024)
+        self.assertIn('unpacked', self.upload('bomb.epub', bomb, status=413)['error'])
+        self.assertEqual(list(Path(self.storage).iterdir()), [])
+
+    @override_settings(DOCUMENT_MAX_UPLOAD_BYTES=1024)
+    def test_content_length_is_checked_before_the_body_is_read(self):
+        with mock.patch.object(documents, 'ingest') as ingest:
+            response = self.client.post(self.url, {'file': SimpleUploadedFile('big.txt', b'x' * 200 * 1024)})
+        self.assertEqual(response.status_code, 413)
+        ingest.assert_not_called()
+
+    def test_files_are_removed_when_the_row_cannot_be_saved(self):
+        with mock.patch.object(Document.objects, 'create', side_effect=RuntimeError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                documents.ingest(SimpleUploadedFile('notes.txt', b'Some text.'))
+        self.assertEqual(list(Path(self.storage).iterdir()), [])
+
+
+ANALYSIS = {
+    'headword': 'run',
+    'ipa': 'rʌn',
+    'senses': [{'pos': 'v.', 'meaning': '跑, 奔'}, {'pos': 'n.', 'meaning': '跑步'}],
+    'sentence': 'She said "run, now!" \\ and left.\nThen {nothing}.',
+    'contextual_meaning': 'é',
+}
+
+
+class FieldScannerTests(SimpleTestCase):
+    def scan(self, pieces):
+        scanner = FieldScanner()
+        return [[field for field in scanner.feed(piece)] for piece in pieces]
+
+    def test_fields_from_any_split(self):
+        text = json.dumps(ANALYSIS, ensure_ascii=False, indent=1)
+        for size in (1, 2, 3, 7, 64, len(text)):
+            with self.subTest(size=size):
+                pieces = [text[start:start + size] for start in range(0, len(text), size)]
+                fields = [field for emitted in self.scan(pieces) for field in emitted]
+                self.assertEqual(fields, list(ANALYSIS.items()))
+
+    def test_escaped_quotes_and_unicode_escapes(self):
+        text = json.dumps(ANALYSIS)  # ASCII with \u escapes
+        self.assertEqual(dict(field for emitted in self.scan([text]) for field in emitted), ANALYSIS)
+
+    def test_a_field_is_emitted_once_complete(self):
+        emitted = self.scan(['{"head', 'word": "ru', 'n", "ip', 'a": "rʌn"', ', "senses": [{"pos": "v.",', ' "m": 1}]}'])
+        self.assertEqual(emitted, [[], [], [('headword', 'run')], [], [('ipa', 'rʌn')],
+                                   [('senses', [{'pos': 'v.', 'm': 1}])]])
+
+    def test_malformed_member_is_skipped(self):
+        emitted = self.scan(['{"a": tru, "b": 2}'])
+        self.assertEqual(emitted, [[('b', 2)]])
+
+
+@override_settings(LEXICON_CACHE_ENABLED=True)
+class LexiconTests(TestCase):
+    template = _template('word_analysis', 'Explain {input_select} in {all_input}')
+    lexical = {name: ANALYSIS[name] for name in LEXICAL_FIELDS}
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(cached_lexical(self.template, TEST_MODEL, 'run'))
+        store_lexical(self.template, TEST_MODEL, 'run', ANALYSIS)
+        self.assertEqual(cached_lexical(self.template, TEST_MODEL, 'run'), self.lexical)
+        # The headword is normalized
+        self.assertEqual(cached_lexical(self.template, TEST_MODEL, '  RUN\n'), self.lexical)
+
+    def test_keyed_on_model_prompt_and_headword(self):
+        store_lexical(self.template, TEST_MODEL, 'run', ANALYSIS)
+        self.assertIsNone(cached_lexical(self.template, 'other-model', 'run'))
+        self.assertIsNone(cached_lexical(_template('word_analysis', 'Define {input_select}'), TEST_MODEL, 'run'))
+        self.assertIsNone(cached_lexical(self.template, TEST_MODEL, 'runs'))
+
+    def test_incomplete_analysis_is_not_stored(self):
+        store_lexical(self.template, TEST_MODEL, 'run', {'headword': 'run', 'ipa': 'rʌn'})
+        self.assertIsNone(cached_lexical(self.template, TEST_MODEL, 'run'))
+
+    def test_store_replaces_the_entry(self):
+        store_lexical(self.template, TEST_MODEL, 'run', ANALYSIS)
+        store_lexical(self.template, TEST_MODEL, 'run', {**ANALYSIS, 'ipa': 'ɹʌn'})
+        self.assertEqual(cached_lexical(self.template, TEST_MODEL, 'run')['ipa'], 'ɹʌn')
+
+    @override_settings(LEXICON_CACHE_ENABLED=False)
+    def test_disabled(self):
+        store_lexical(self.template, TEST_MODEL, 'run', ANALYSIS)
+        self.assertIsNone(cached_lexical(self.template, TEST_MODEL, 'run'))
+
+    def test_store_gives_back_its_connection(self):
+        with mock.patch('core.structured.close_old_connections') as close:
+            store_lexical(self.template, TEST_MODEL, 'run', ANALYSIS)
+        self.assertEqual(close.call_count, 2)
+
+
+class RequestIdTests(SimpleTestCase):
+    def ids_seen_by_the_body(self, content, headers=None):
+        def view(request):
+            return StreamingHttpResponse(content)
+
+        request = RequestFactory().get('/', headers=headers or {})
+        response = log.RequestIdMiddleware(view)(request)
+        # The view has returned: the id is only bound while the body is pulled
+        self.assertEqual(log.request_id(), '-')
+        return response['X-Request-ID'], response
+
+    def test_offered_id_reaches_the_streamed_body(self):
+        def body():
+            for _ in range(3):
+                yield log.request_id()
+
+        rid, response = self.ids_seen_by_the_body(body(), {'X-Request-ID': 'client-id.1'})
+        self.assertEqual(rid, 'client-id.1')
+        self.assertEqual(b''.join(response.streaming_content), b'client-id.1' * 3)
+        self.assertEqual(log.request_id(), '-')
+
+    def test_invalid_id_is_replaced(self):
+        def body():
+            yield log.request_id()
+
+        rid, response = self.ids_seen_by_the_body(body(), {'X-Request-ID': 'bad id\n'})
+        self.assertRegex(rid, r'^[0-9a-f]{16}$')
+        self.assertEqual(b''.join(response.streaming_content), rid.encode())
+
+    async def test_async_body(self):
+        async def body():
+            for _ in range(2):
+                yield log.request_id()
+
+        rid, response = self.ids_seen_by_the_body(body(), {'X-Request-ID': 'async-id'})
+        self.assertEqual([chunk async for chunk in response.streaming_content], [b'async-id', b'async-id'])
+
+
+class SharedLevelsTests(SimpleTestCase):
+    logger_name = 'core.tests.shared'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        levels_file = override_settings(LOG_LEVELS_FILE=f'{directory.name}/.log_levels', DEBUG=True)
+        levels_file.enable()
+        self.addCleanup(levels_file.disable)
+        logger = logging.getLogger(self.logger_name)
+        self.addCleanup(logger.setLevel, logger.level)
+
+    def test_change_reaches_other_processes(self):
+        with self.assertLogs('core.log', 'INFO'):
+            response = self.client.post(reverse('core:logging_levels'), {'levels': {self.logger_name: 'debug'}},
+                                        content_type='application/json')
+        self.assertEqual(response.json()['levels'][self.logger_name], 'DEBUG')
+        # Another worker: its own logger state, the same file
+        logging.getLogger(self.logger_name).setLevel('WARNING')
+        worker = log.SharedLevels()
+        worker.apply()
+        self.assertEqual(logging.getLogger(self.logger_name).level, logging.DEBUG)
+        logging.getLogger(self.logger_name).setLevel('WARNING')
+        worker.apply()  # unchanged file: nothing re-applied
+        self.assertEqual(logging.getLogger(self.logger_name).level, logging.WARNING)
+        log.SharedLevels().publish({self.logger_name: 'ERROR'})
+        worker.apply()
+        self.assertEqual(logging.getLogger(self.logger_name).level, logging.ERROR)
+
+    def test_invalid_levels_are_refused(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            response = self.client.post(reverse('core:logging_levels'), {'levels': {self.logger_name: 'LOUD'}},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class LifespanTests(TestCase):
+    def setUp(self):
+        api_config = APIConfiguration(pk=1, name='upstream', api_key='sk-test', model_name=TEST_MODEL)
+        template = PromptTemplate(pk=1, name='test', template_type='translation',
+                                  prompt_text='Translate: {all_input}', api_config=api_config)
+        snapshot = config_snapshot.ConfigSnapshot(version='1', templates=config_snapshot.TemplateCopies(
+            {'translation': template}))
+        for patcher in (mock.patch.object(warmup, 'get_snapshot', return_value=snapshot),
+                        mock.patch.dict(warmup._state, {'status': 'not_run'}, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def run_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        async def app(scope, receive, send):
+            raise AssertionError('HTTP app called')
+
+        await warmup.LifespanApp(app)({'type': 'lifespan'}, receive, send)
+        return sent
+
+    async def test_failed_step_is_reported_and_startup_completes(self):
+        with mock.patch.object(warmup, '_probe', side_effect=ConnectionError('upstream unreachable')), \
+                self.assertLogs('core.warmup', 'WARNING') as logs:
+            sent = await self.run_lifespan()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        state = warmup.state()
+        self.assertEqual(state['status'], 'done')
+        self.assertEqual(state['errors'], {'connect:upstream': 'upstream unreachable'})
+        self.assertIn('connect:upstream', state['steps'])
+        self.assertIn('warm-up step connect:upstream failed', logs.output[0])
+
+    async def test_crashing_warm_up_does_not_block_startup(self):
+        with mock.patch.object(warmup, 'warm_up', side_effect=RuntimeError('bug')), \
+                self.assertLogs('core.warmup', 'ERROR'):
+            sent = await self.run_lifespan()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(warmup.state(), {'status': 'failed', 'error': 'bug'})
+
+    def test_readiness_while_warming_up(self):
+        with mock.patch.dict(warmup._state, {'status': 'running'}, clear=True):
+            response = self.client.get(reverse('core:readyz'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['checks']['warmup'], {'status': 'running'})
+
+
+FRAMES = [f'data: {json.dumps({"type": "content", "content": f"Paragraph {number}: 翻译 " * 5})}\n\n'
+          for number in range(40)] + ['data: {"type": "done"}\n\n']
+
+
+class StreamCompressorTests(SimpleTestCase):
+    def decompressors(self):
+        yield 'gzip', zlib.decompressobj(31).decompress
+        if streaming.brotli is not None:
+            yield 'br', streaming.brotli.Decompressor().process
+
+    def test_every_frame_decodes_on_arrival(self):
+        for encoding, decompress in self.decompressors():
+            with self.subTest(encoding=encoding), self.assertLogs('core.streaming', 'INFO'):
+                compressor = streaming.StreamCompressor(encoding)
+                pieces = list(streaming.compress_sync(iter(FRAMES), compressor))
+                # Flushed per frame: each piece decodes to exactly its frame
+                self.assertEqual([decompress(piece).decode() for piece in pieces[:-1]], FRAMES)
+                self.assertEqual(decompress(pieces[-1]), b'')
+                self.assertEqual(compressor.raw_bytes, len(''.join(FRAMES).encode()))
+                self.assertEqual(compressor.wire_bytes, sum(map(len, pieces)))
+                self.assertLess(compressor.wire_bytes, compressor.raw_bytes / 2)
+
+    @override_settings(SSE_COMPRESSION_FLUSH_MS=5, SSE_COMPRESSION_FLUSH_BYTES=1024)
+    async def test_async_stream_round_trip(self):
+        async def frames():
+            for number, frame in enumerate(FRAMES):
+                if number % 10 == 0:
+                    await asyncio.sleep(0.02)
+                yield frame
+
+        for encoding, decompress in self.decompressors():
+            with self.subTest(encoding=encoding), self.assertLogs('core.streaming', 'INFO'):
+                pieces = [piece async for piece in
+                          streaming.compress_async(frames(), streaming.StreamCompressor(encoding))]
+                self.assertGreater(len(pieces), 2)
+                self.assertLess(len(pieces), len(FRAMES))
+                self.assertEqual(b''.join(decompress(piece) for piece in pieces).decode(), ''.join(FRAMES))
+
+    @override_settings(SSE_COMPRESSION=True, SSE_COMPRESSION_MIN_BYTES=4096)
+    def test_stream_encoding(self):
+        request = RequestFactory().get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(streaming.stream_encoding(request, 10000), 'gzip')
+        self.assertIsNone(streaming.stream_encoding(request, 100))
+        self.assertIsNone(streaming.stream_encoding(request, None))
+        self.assertIsNone(streaming.stream_encoding(RequestFactory().get('/'), 10000))
+
+
+class ParagraphScheduleTests(SimpleTestCase):
+    def drain(self, schedule):
+        order = []
+        index = schedule.take()
+        while index is not None:
+            order.append(index)
+            index = schedule.take()
+        return order
+
+    def test_visible_first_then_below_before_above(self):
+        self.assertEqual(self.drain(ParagraphSchedule(6, (2, 3))), [2, 3, 4, 1, 5, 0])
+
+    def test_scroll_reorders_pending_paragraphs(self):
+        schedule = ParagraphSchedule(6, (0, 1))
+        self.assertEqual([schedule.take(), schedule.take()], [0, 1])
+        before = viewport.stats.snapshot()['reprioritized']
+        schedule.reprioritize(4, 4)
+        self.assertEqual(self.drain(schedule), [4, 5, 3, 2])
+        self.assertEqual(viewport.stats.snapshot()['reprioritized'], before + 1)
+
+    def test_unchanged_range_is_not_a_scroll(self):
+        schedule = ParagraphSchedule(4, (1, 2))
+        before = viewport.stats.snapshot()['reprioritized']
+        schedule.reprioritize(1, 2)
+        self.assertEqual(viewport.stats.snapshot()['reprioritized'], before)
+
+    def test_scroll_is_clamped(self):
+        schedule = ParagraphSchedule(4, (0, 0))
+        schedule.reprioritize(10, 20)
+        self.assertEqual(schedule.visible, (3, 3))
+        self.assertEqual(schedule.take(), 3)
+
+    def test_visible_done_reports_the_scrolled_range(self):
+        schedule = ParagraphSchedule(4, (0, 0))
+        schedule.reprioritize(2, 3)
+        with self.assertLogs('core.viewport', 'INFO'):
+            self.assertIsNone(schedule.finish(2))
+            self.assertIsNone(schedule.finish(0))
+            done = json.loads(schedule.finish(3)[len(viewport.PARAGRAPH_PREFIX):])
+        self.assertEqual((done['type'], done['first'], done['last'], done['trigger']),
+                         ('visible_done', 2, 3, 'scroll'))
+        self.assertIsNone(schedule.finish(1))
+
+    def test_stop(self):
+        schedule = ParagraphSchedule(3, (0, 0))
+        schedule.stop()
+        self.assertIsNone(schedule.take())
+
+    @override_settings(TRANSLATION_PARAGRAPH_WORKERS=1)
+    def test_translation_follows_the_schedule(self):
+        priorities = []
+
+        def translate(text, priority):
+            priorities.append((text, priority))
+            yield text.upper()
+
+        before = viewport.stats.snapshot()
+        with self.assertLogs('core.viewport', 'INFO'):
+            events = [json.loads(chunk[len(viewport.PARAGRAPH_PREFIX):]) for chunk in
+                      translate_paragraphs(['a', 'b', 'c'], ParagraphSchedule(3, (1, 1)), translate)]
+        self.assertEqual(priorities, [('b', INTERACTIVE_TRANSLATION), ('c', BULK), ('a', BULK)])
+        self.assertEqual([(event['type'], event['paragraph']) for event in events if event['type'] == 'content'],
+                         [('content', 1), ('content', 2), ('content', 0)])
+        self.assertEqual(sum(event['type'] == 'visible_done' for event in events), 1)
+        after = viewport.stats.snapshot()
+        self.assertEqual((after['translations'], after['paragraphs']),
+                         (before['translations'] + 1, before['paragraphs'] + 3))
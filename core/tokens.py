@@ -0,0 +1,238 @@
+"""
+Local prompt token counting and context-window preflight.
+
+``count_tokens`` uses the model's tiktoken encoding when the optional
+``tiktoken`` package is installed and the text is not huge, and falls back
+to the segmentation index's approximate count otherwise. Counts are cached
+by content digest, so re-estimating the same document for every selection
+costs one hash. ``estimate_prompt`` counts a rendered template without
+rendering it: the template skeleton (placeholders removed) plus each
+placeholder's text times the number of times it appears.
+
+``plan`` compares that estimate with the model's context window (minus the
+reserved output budget) and decides how the request is sent: ``single``,
+``chunked`` (translation split into pieces that each fit) or ``windowed``
+(analysis context narrowed to the sentences around the selection). Requests
+that cannot be made to fit are rejected before any network call.
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+from .latency import REASONING_ALLOWANCE, is_reasoning_model
+from .prompts import compiled
+from .segmentation import content_digest, get_index
+
+try:
+    import tiktoken
+except ImportError:  # optional: approximate counts only
+    tiktoken = None
+
+# Input context per model family, longest prefix wins. Override or extend
+# with settings.MODEL_CONTEXT_WINDOWS.
+DEFAULT_CONTEXT_WINDOWS = {
+    'gpt-5': 272000,
+    'gpt-4.1': 1047576,
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'o4': 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+# Encodings for model families tiktoken may not know by name yet
+ENCODING_PREFIXES = (
+    ('gpt-5', 'o200k_base'),
+    ('gpt-4.1', 'o200k_base'),
+    ('gpt-4o', 'o200k_base'),
+    ('o1', 'o200k_base'),
+    ('o3', 'o200k_base'),
+    ('o4', 'o200k_base'),
+    ('gpt-4', 'cl100k_base'),
+    ('gpt-3.5', 'cl100k_base'),
+)
+COUNT_CACHE_SIZE = 256
+
+SINGLE = 'single'
+CHUNKED = 'chunked'
+WINDOWED = 'windowed'
+
+
+class ContextOverflow(Exception):
+    """The prompt cannot be made to fit the model's context window"""
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    for prefix, name in ENCODING_PREFIXES:
+        if model.startswith(prefix):
+            return tiktoken.get_encoding(name)
+    return tiktoken.get_encoding('o200k_base')
+
+
+class _CountCache:
+    """LRU of token counts keyed by (encoding, content digest)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: 'OrderedDict[Tuple[str, str], int]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[int]:
+        with self._lock:
+            count = self._entries.get(key)
+            if count is not None:
+                self._entries.move_to_end(key)
+            return count
+
+    def put(self, key, count: int):
+        with self._lock:
+            self._entries[key] = count
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+_counts = _CountCache(COUNT_CACHE_SIZE)
+
+
+def count_tokens(text: str, model: str) -> Tuple[int, bool]:
+    """(token count, exact?) of ``text`` for ``model``"""
+    if not text:
+        return 0, True
+    encoding = _encoding(model)
+    if encoding is None or len(text) > getattr(settings, 'TOKEN_EXACT_MAX_CHARS', 400000):
+        return get_index(text).approx_tokens(), False
+    key = (encoding.name, content_digest(text))
+    count = _counts.get(key)
+    if count is None:
+        count = len(encoding.encode(text, disallowed_special=()))
+        _counts.put(key, count)
+    return count, True
+
+
+def context_window(model: str) -> int:
+    """Input context size of ``model`` in tokens"""
+    windows = {**DEFAULT_CONTEXT_WINDOWS, **getattr(settings, 'MODEL_CONTEXT_WINDOWS', {})}
+    matches = [prefix for prefix in windows if model.startswith(prefix)]
+    if not matches:
+        return getattr(settings, 'DEFAULT_CONTEXT_WINDOW', DEFAULT_CONTEXT_WINDOW)
+    return windows[max(matches, key=len)]
+
+
+def output_reserve(route) -> int:
+    """Tokens kept free for the answer (and reasoning) of a routed call"""
+    reserve = route.max_output_tokens or getattr(settings, 'PREFLIGHT_OUTPUT_RESERVE', 4096)
+    if is_reasoning_model(route.model):
+        reserve += REASONING_ALLOWANCE.get(route.reasoning_effort, 0)
+    return reserve
+
+
+@dataclass(frozen=True)
+class PromptEstimate:
+    prompt_tokens: int
+    template_tokens: int
+    input_tokens: int  # the {all_input} text, per occurrence
+    selection_tokens: int
+    input_occurrences: int
+    exact: bool
+
+
+def estimate_prompt(template, model: str, all_input: str = '', input_select: str = '') -> PromptEstimate:
+    """Token count of the rendered prompt, from cached per-part counts"""
+    prompt = compiled(template)
+    template_tokens, template_exact = count_tokens(prompt.skeleton, model)
+    input_tokens, input_exact = count_tokens(all_input, model)
+    selection_tokens, selection_exact = count_tokens(input_select, model)
+    input_occurrences = prompt.count('all_input')
+    return PromptEstimate(
+        prompt_tokens=(template_tokens + input_occurrences * input_tokens
+                       + prompt.count('input_select') * selection_tokens),
+        template_tokens=template_tokens,
+        input_tokens=input_tokens,
+        selection_tokens=selection_tokens,
+        input_occurrences=input_occurrences,
+        exact=template_exact and input_exact and selection_exact,
+    )
+
+
+@dataclass(frozen=True)
+class PromptPlan:
+    strategy: str
+    estimate: PromptEstimate
+    budget: int  # prompt tokens that fit next to the output reserve
+    context_window: int
+    spans: Tuple[Tuple[int, int], ...] = ()  # character spans of all_input to send
+
+    @property
+    def meta(self) -> dict:
+        return {
+            'prompt_tokens': self.estimate.prompt_tokens,
+            'token_count_exact': self.estimate.exact,
+            'context_window': self.context_window,
+            'strategy': self.strategy,
+            'chunks': len(self.spans) if self.strategy == CHUNKED else 1,
+        }
+
+
+def _input_budget(estimate: PromptEstimate, budget: int) -> int:
+    """Approximate-index tokens of ``{all_input}`` that still fit the budget"""
+    fixed = estimate.prompt_tokens - estimate.input_occurrences * estimate.input_tokens
+    return (budget - fixed) // max(1, estimate.input_occurrences)
+
+
+def _to_index_units(tokens: int, text: str, estimate: PromptEstimate) -> int:
+    # Spans are cut with the segmentation index, whose approximate counts
+    # differ from the tokenizer's; scale the budget into its units.
+    approx = get_index(text).approx_tokens()
+    if not estimate.input_tokens or not approx:
+        return tokens
+    return int(tokens * approx / estimate.input_tokens)
+
+
+def plan(template, route, all_input: str, input_select: str = '', selection_span=None) -> PromptPlan:
+    """
+    How to send a prompt within the model's context window.
+
+    Translations too large for one call are ``chunked``; analyses are
+    ``windowed`` around ``selection_span`` (character offsets in
+    ``all_input``). Raises ``ContextOverflow`` when neither helps.
+    """
+    estimate = estimate_prompt(template, route.model, all_input, input_select)
+    window = context_window(route.model)
+    margin = getattr(settings, 'PREFLIGHT_SAFETY_MARGIN', 0.05)
+    budget = int(window * (1 - margin)) - output_reserve(route)
+    if estimate.prompt_tokens <= budget:
+        return PromptPlan(SINGLE, estimate, budget, window)
+
+    limit = _input_budget(estimate, budget)
+    if not getattr(settings, 'PREFLIGHT_REROUTE', True) or limit <= 0 or not estimate.input_occurrences:
+        raise ContextOverflow(
+            f'Prompt is about {estimate.prompt_tokens} tokens; {route.model} accepts {budget} '
+            f'next to its output. Shorten the text.')
+
+    index = get_index(all_input)
+    index_limit = _to_index_units(limit, all_input, estimate)
+    if template.template_type == 'translation':
+        # Leave room for the chunk's own tokenizer/approximation mismatch
+        spans = tuple(index.chunks(max(1, int(index_limit * 0.9))))
+        return PromptPlan(CHUNKED, estimate, budget, window, spans)
+
+    if selection_span is None:
+        raise ContextOverflow('The text is too long for the model and the selection could not be located in it.')
+    start, end = index.context_window(selection_span[0], selection_span[1], int(index_limit * 0.9))
+    if index.approx_tokens(start, end) > index_limit:
+        raise ContextOverflow('The selection alone is too long for the model. Select less text.')
+    return PromptPlan(WINDOWED, estimate, budget, window, ((start, end),))
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import health, log, profiling, views
 
 app_name = 'core'
 
@@ -9,11 +9,29 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('settings/', views.settings_view, name='settings'),
 
+    # Health checks
+    path('healthz', health.healthz, name='healthz'),
+    path('readyz', health.readyz, name='readyz'),
+
     # API endpoints
     path('api/translate/', views.translate_text, name='translate_text'),
     path('api/analyze/', views.analyze_word, name='analyze_word'),
     path('api/stream-translate/', views.stream_translation, name='stream_translation'),
     path('api/stream-analyze/', views.stream_word_analysis, name='stream_word_analysis'),
+    path('api/config-version/', views.config_version, name='config_version'),
+    path('api/usage/', views.usage_summary, name='usage_summary'),
+    path('api/scheduler/', views.scheduler_stats, name='scheduler_stats'),
+    path('api/viewport/', views.viewport_stats, name='viewport_stats'),
+    path('api/semantic-cache/', views.semantic_cache_stats, name='semantic_cache_stats'),
+    path('api/admission/', views.admission_stats, name='admission_stats'),
+
+    # Stored request profiles (PROFILING_ENABLED only)
+    path('api/profiles/', profiling.profile_index, name='profile_index'),
+    path('api/profiles/<str:profile_id>/', profiling.profile_detail, name='profile_detail'),
+    path('api/profiles/<str:profile_id>/cprofile/', profiling.profile_download, name='profile_download'),
+
+    # Runtime logger levels (DEBUG or LOG_ADMIN_TOKEN only)
+    path('api/logging/', log.logging_levels, name='logging_levels'),
 
     # API Configuration CRUD
     path('api/configs/', views.APIConfigurationView.as_view(), name='api_configs_list'),
@@ -23,6 +41,11 @@ urlpatterns = [
     path('api/templates/', views.PromptTemplateView.as_view(), name='prompt_templates_list'),
     path('api/templates/<int:template_id>/', views.PromptTemplateView.as_view(), name='prompt_templates_detail'),
 
+    # Uploaded documents
+    path('api/documents/', views.DocumentView.as_view(), name='documents_list'),
+    path('api/documents/<str:handle>/', views.DocumentView.as_view(), name='documents_detail'),
+    path('api/documents/<str:handle>/paragraphs/', views.document_paragraphs, name='document_paragraphs'),
+
     # Analysis Configuration
     path('api/analysis-config/', views.AnalysisConfigurationView.as_view(), name='analysis_config'),
 ]
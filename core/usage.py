@@ -0,0 +1,200 @@
+"""
+Per-call usage and latency ledger.
+
+``OpenAIService`` calls ``record`` once per upstream call with the token
+counts reported by the API, TTFT, total duration and outcome. ``record``
+only appends to an in-memory queue; a daemon thread in each worker drains
+it and writes ``UsageRecord`` rows with one ``bulk_create`` per batch, so
+the stream path never waits on the database. If the queue is full (the DB
+is stuck) records are dropped and counted rather than blocking.
+
+``rollup`` aggregates the ledger by hour, template or model for the
+``usage_report`` command and the ``/api/usage/`` endpoint.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Avg, Count, F, Max, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import UsageRecord
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = ('prompt_tokens', 'cached_tokens', 'completion_tokens', 'reasoning_tokens')
+ROLLUP_GROUPS = {
+    'hour': 'hour',
+    'template': 'template__name',
+    'model': 'model',
+}
+
+
+def usage_from_chat(usage) -> dict:
+    """Token counts from a chat-completions ``usage`` object"""
+    if usage is None:
+        return {}
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'cached_tokens': getattr(prompt_details, 'cached_tokens', 0) or 0,
+        'reasoning_tokens': getattr(completion_details, 'reasoning_tokens', 0) or 0,
+    }
+
+
+def usage_from_responses(usage) -> dict:
+    """Token counts from a responses-API ``usage`` object"""
+    if usage is None:
+        return {}
+    input_details = getattr(usage, 'input_tokens_details', None)
+    output_details = getattr(usage, 'output_tokens_details', None)
+    return {
+        'prompt_tokens': usage.input_tokens or 0,
+        'completion_tokens': usage.output_tokens or 0,
+        'cached_tokens': getattr(input_details, 'cached_tokens', 0) or 0,
+        'reasoning_tokens': getattr(output_details, 'reasoning_tokens', 0) or 0,
+    }
+
+
+class UsageWriter:
+    """Bounded queue plus a lazily started background writer thread"""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self.dropped = 0
+        self.written = 0
+
+    def _ensure_thread(self):
+        # Workers are forked from a preloaded parent: start one thread per process
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, record: UsageRecord):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _take_batch(self, timeout: Optional[float]) -> List[UsageRecord]:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[UsageRecord]):
+        try:
+            UsageRecord.objects.bulk_create(batch)
+            self.written += len(batch)
+        except Exception:
+            self.dropped += len(batch)
+            logger.exception('usage: failed to write %d records', len(batch))
+            connection.close()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Write everything still queued from the calling thread (shutdown)"""
+        while True:
+            batch = self._take_batch(timeout=0)
+            if not batch:
+                break
+            self._write(batch)
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+
+writer = UsageWriter(
+    batch_size=getattr(settings, 'USAGE_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'USAGE_FLUSH_INTERVAL', 1.0),
+    max_queue=getattr(settings, 'USAGE_MAX_QUEUE', 10000),
+)
+atexit.register(writer.flush)
+
+
+def record(template, model: str, reasoning_effort: str, usage: dict, ttft_ms: Optional[float],
+           duration_ms: float, outcome: str):
+    """Queue one upstream call for the ledger (never blocks)"""
+    if not getattr(settings, 'USAGE_LEDGER_ENABLED', True):
+        return
+    writer.submit(UsageRecord(
+        created_at=timezone.now(),
+        template_id=template.pk,
+        template_type=template.template_type,
+        api_config_id=template.api_config_id,
+        model=model,
+        reasoning_effort=reasoning_effort or '',
+        ttft_ms=round(ttft_ms, 2) if ttft_ms is not None else None,
+        duration_ms=round(duration_ms, 2),
+        outcome=outcome,
+        **{name: usage.get(name, 0) for name in USAGE_FIELDS},
+    ))
+
+
+def rollup(group: str = 'hour', hours: float = 24, now=None) -> List[dict]:
+    """Calls, tokens and latency over the last ``hours``, grouped by hour/template/model"""
+    if group not in ROLLUP_GROUPS:
+        raise ValueError(f"group must be one of: {', '.join(ROLLUP_GROUPS)}")
+    since = (now or timezone.now()) - timedelta(hours=hours)
+    records = UsageRecord.objects.filter(created_at__gte=since)
+    if group == 'hour':
+        records = records.annotate(hour=TruncHour('created_at'))
+    key = ROLLUP_GROUPS[group]
+
+    rows = (
+        records.values(key)
+        .annotate(
+            calls=Count('id'),
+            errors=Count('id', filter=Q(outcome='error')),
+            cancelled=Count('id', filter=Q(outcome='cancelled')),
+            # Aliased: an annotation may not shadow a model field
+            **{f'sum_{name}': Sum(name) for name in USAGE_FIELDS},
+            avg_ttft_ms=Avg('ttft_ms'),
+            max_ttft_ms=Max('ttft_ms'),
+            avg_duration_ms=Avg('duration_ms'),
+            total_duration_ms=Sum('duration_ms'),
+        )
+        .order_by(key if group == 'hour' else F('total_duration_ms').desc(nulls_last=True))
+    )
+
+    result = []
+    for row in rows:
+        group_value = row.pop(key)
+        if group == 'hour':
+            group_value = group_value.isoformat() if group_value else None
+        row = {name.removeprefix('sum_'): round(value, 2) if isinstance(value, float) else value
+               for name, value in row.items()}
+        row['total_tokens'] = (row['prompt_tokens'] or 0) + (row['completion_tokens'] or 0)
+        result.append({group: group_value, **row})
+    return result
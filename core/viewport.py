@@ -0,0 +1,242 @@
+"""
+Viewport-first paragraph translation.
+
+A translation request may send ``"order": "viewport"`` with the paragraph
+range the reader is looking at (``"visible": [first, last]``, indexes into
+``split_paragraphs`` of the text). The text is then translated paragraph by
+paragraph by ``TRANSLATION_PARAGRAPH_WORKERS`` threads that take the next
+paragraph from a ``ParagraphSchedule``: visible paragraphs first (in the
+``interactive_translation`` scheduler class), then the ones below and
+above, nearest first (as ``bulk``). Over the WebSocket,
+``{"type": "viewport", "id": ..., "visible": [a, b]}`` moves the range
+while the translation runs; over HTTP the initial range is used throughout.
+
+Output is paragraph-tagged: ``content`` events carry ``paragraph``, each
+finished paragraph sends ``paragraph_done``, and ``visible_done`` reports
+how long the range in view took from the request (or the last scroll) to
+be fully translated. Those times are kept in ``stats`` and served by
+``/api/viewport/``.
+"""
+import contextvars
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from .openai_service import TRUNCATED
+from .scheduler import BULK, INTERACTIVE_TRANSLATION
+
+logger = logging.getLogger(__name__)
+
+PARAGRAPH_PREFIX = '__PARAGRAPH__:'
+PARAGRAPHS = 'paragraphs'  # prompt strategy reported for viewport-ordered translations
+# Same rule as splitParagraphs in main.js: blank lines separate paragraphs
+_PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+STAT_SAMPLES = 512
+_FINISHED = object()
+
+
+def split_paragraphs(text: str) -> List[str]:
+    """Non-empty paragraphs of ``text``, stripped"""
+    return [part.strip() for part in _PARAGRAPH_BREAK_RE.split(text) if part.strip()]
+
+
+def paragraph_marker(event_type: str, paragraph: int, **fields) -> str:
+    """Service chunk carrying one paragraph-tagged event (see ``pipeline.iter_events``)"""
+    return PARAGRAPH_PREFIX + json.dumps({'type': event_type, 'paragraph': paragraph, **fields},
+                                         ensure_ascii=False)
+
+
+def _clamp(first: int, last: int, count: int) -> Tuple[int, int]:
+    first = min(max(first, 0), count - 1)
+    return first, min(max(last, first), count - 1)
+
+
+def visible_range(data: dict, count: int) -> Optional[Tuple[int, int]]:
+    """The ``visible`` hint of a message clamped to ``count`` paragraphs, or None if there is none"""
+    try:
+        first, last = (int(value) for value in data['visible'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return _clamp(first, last, count)
+
+
+class ViewportStats:
+    """Time until the paragraphs in view were translated, per worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {'initial': deque(maxlen=STAT_SAMPLES), 'scroll': deque(maxlen=STAT_SAMPLES)}
+        self.translations = 0
+        self.paragraphs = 0
+        self.reprioritized = 0
+
+    def observe(self, trigger: str, ms: float):
+        with self._lock:
+            self.samples[trigger].append(ms)
+
+    def count(self, counter: str):
+        """Increment ``translations``, ``paragraphs`` or ``reprioritized``"""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {'translations': self.translations, 'paragraphs': self.paragraphs,
+                      'reprioritized': self.reprioritized}
+            for trigger, samples in self.samples.items():
+                ordered = sorted(samples)
+                result[trigger] = {
+                    'count': len(ordered),
+                    'visible_ms_p50': round(ordered[len(ordered) // 2], 1) if ordered else None,
+                    'visible_ms_p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1)
+                    if ordered else None,
+                }
+            return result
+
+
+stats = ViewportStats()
+
+
+class ParagraphSchedule:
+    """Which paragraph to translate next, given the range the reader is looking at"""
+
+    def __init__(self, count: int, visible: Tuple[int, int]):
+        self.count = count
+        self._lock = threading.Lock()
+        self._pending = set(range(count))
+        self._done = set()
+        self.stopped = False
+        self._set_visible(visible, 'initial')
+
+    def _set_visible(self, visible: Tuple[int, int], trigger: str):
+        self.visible = visible
+        self._visible_since = time.perf_counter()
+        self._trigger = trigger
+        self._reported = self._visible_complete()
+
+    def _visible_complete(self) -> bool:
+        first, last = self.visible
+        return all(index in self._done for index in range(first, last + 1))
+
+    def _distance(self, index: int) -> int:
+        first, last = self.visible
+        if index < first:
+            return (first - index) * 2  # reading runs downwards: prefer what comes next
+        return max(0, index - last)
+
+    def reprioritize(self, first: int, last: int):
+        """The reader scrolled; what is now in view goes next"""
+        visible = _clamp(first, last, self.count)
+        with self._lock:
+            if visible == self.visible:
+                return
+            self._set_visible(visible, 'scroll')
+        stats.count('reprioritized')
+
+    def is_visible(self, index: int) -> bool:
+        first, last = self.visible
+        return first <= index <= last
+
+    def take(self) -> Optional[int]:
+        """The nearest pending paragraph to the visible range, or None when none are left"""
+        with self._lock:
+            if self.stopped or not self._pending:
+                return None
+            index = min(self._pending, key=lambda i: (self._distance(i), i))
+            self._pending.discard(index)
+            return index
+
+    def finish(self, index: int) -> Optional[str]:
+        """Mark a paragraph translated; returns a ``visible_done`` marker when the range in view completes"""
+        with self._lock:
+            self._done.add(index)
+            if self._reported or not self._visible_complete():
+                return None
+            self._reported = True
+            ms = (time.perf_counter() - self._visible_since) * 1000
+            first, last = self.visible
+            trigger = self._trigger
+        stats.observe(trigger, ms)
+        logger.info('visible paragraphs translated',
+                    extra={'first': first, 'last': last, 'trigger': trigger, 'ms': round(ms, 1)})
+        return PARAGRAPH_PREFIX + json.dumps({'type': 'visible_done', 'first': first, 'last': last,
+                                              'trigger': trigger, 'ms': round(ms, 1)})
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+
+
+def translate_paragraphs(paragraphs: List[str], schedule: ParagraphSchedule,
+                         translate: Callable[[str, str], Iterator[str]]) -> Iterator[str]:
+    """
+    Paragraph-tagged chunks for ``paragraphs``, translated in schedule order.
+
+    ``translate(text, priority)`` streams the translation of one paragraph.
+    Closing the generator stops the workers after their current chunk.
+    """
+    events = queue.Queue()
+    workers = max(1, min(getattr(settings, 'TRANSLATION_PARAGRAPH_WORKERS', 3), len(paragraphs)))
+    stats.count('translations')
+
+    def translate_one(index: int) -> bool:
+        priority = INTERACTIVE_TRANSLATION if schedule.is_visible(index) else BULK
+        stream = translate(paragraphs[index], priority)
+        try:
+            for chunk in stream:
+                if schedule.stopped:
+                    return False
+                if chunk.startswith('Error:'):
+                    events.put(paragraph_marker('error', index, content=chunk))
+                    return False
+                if chunk == TRUNCATED:
+                    events.put(paragraph_marker('truncated', index))
+                elif not chunk.startswith('__'):  # thinking is not shown per paragraph
+                    events.put(paragraph_marker('content', index, content=chunk))
+        finally:
+            stream.close()
+        stats.count('paragraphs')
+        events.put(paragraph_marker('paragraph_done', index))
+        completed = schedule.finish(index)
+        if completed:
+            events.put(completed)
+        return True
+
+    def work():
+        try:
+            index = schedule.take()
+            while index is not None:
+                try:
+                    translated = translate_one(index)
+                except Exception as e:
+                    events.put(paragraph_marker('error', index, content=f'Error: {e}'))
+                    translated = False
+                if not translated:
+                    # One failure (bad key, quota) would repeat for every paragraph
+                    schedule.stop()
+                    return
+                index = schedule.take()
+        finally:
+            events.put(_FINISHED)
+
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(work,), daemon=True,
+                                name=f'paragraphs-{number}') for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = workers
+        while running:
+            event = events.get()
+            if event is _FINISHED:
+                running -= 1
+            else:
+                yield event
+    finally:
+        schedule.stop()
@@ -1,52 +1,120 @@
+import hmac
 import json
+from functools import partial, wraps
 
-from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models.functions import Substr
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from .models import APIConfiguration, PromptTemplate, AnalysisConfiguration
+from . import documents, semantic_cache, viewport
+from .admission import controller as admission_controller, rejected_response, request_key
+from .conditional import config_conditional
+from .config_snapshot import get_snapshot
+from .models import APIConfiguration, PromptTemplate, AnalysisConfiguration, Document
 from .openai_service import get_active_templates, create_openai_service
+from .pipeline import (StreamRequestError, analysis_texts, iter_events, prepare_analysis, prepare_translation,
+                       sse_frame, translation_text)
+from .prompts import validate_prompt
+from .scheduler import dispatcher
+from .segmentation import get_index
+from .streaming import draining_response, sse_response, streams
+from .usage import rollup
+from .websocket import WEBSOCKET_PATH
+
+# Settings page prompt previews only need the start of each prompt
+PROMPT_PREVIEW_CHARS = 400
+LIST_PAGE_SIZE = 50
+MAX_LIST_PAGE_SIZE = 200
 
 
 def index(request):
     """Main page view"""
-    return render(request, 'core/index.html')
+    # The stream socket only exists under ASGI (manage.py serve / uvicorn)
+    websocket = getattr(settings, 'WEBSOCKET_ENABLED', True) and isinstance(request, ASGIRequest)
+    return render(request, 'core/index.html', {'stream_socket_path': WEBSOCKET_PATH if websocket else ''})
 
 
+@config_conditional(templates=('core/settings.html',))
 def settings_view(request):
     """Settings page view"""
-    api_configs = APIConfiguration.objects.all()
-    translation_templates = PromptTemplate.objects.filter(template_type='translation')
-    analysis_templates = PromptTemplate.objects.filter(template_type='word_analysis')
-    sentence_templates = PromptTemplate.objects.filter(template_type='sentence_analysis')
-    analysis_config = AnalysisConfiguration.get_current()
+    api_configs = list(APIConfiguration.objects.only('id', 'name', 'base_url', 'model_name').order_by('id'))
+
+    # One query for all template types; only the start of each prompt is needed for the preview
+    templates_by_type = {template_type: [] for template_type, _ in PromptTemplate.TEMPLATE_TYPES}
+    templates = (
+        PromptTemplate.objects.select_related('api_config')
+        .defer('prompt_text', 'api_config__api_key')
+        .annotate(prompt_preview=Substr('prompt_text', 1, PROMPT_PREVIEW_CHARS))
+        .order_by('id')
+    )
+    for template in templates:
+        templates_by_type.setdefault(template.template_type, []).append(template)
 
     context = {
         'api_configs': api_configs,
-        'translation_templates': translation_templates,
-        'analysis_templates': analysis_templates,
-        'sentence_templates': sentence_templates,
-        'analysis_config': analysis_config,
+        'translation_templates': templates_by_type['translation'],
+        'analysis_templates': templates_by_type['word_analysis'],
+        'sentence_templates': templates_by_type['sentence_analysis'],
+        # Thresholds come from the cached config snapshot (no query)
+        'analysis_config': get_snapshot(),
     }
     return render(request, 'core/settings.html', context)
 
 
+def _list_fields(request, allowed, default):
+    """Fields requested with ?fields=a,b (validated against ``allowed``)"""
+    requested = request.GET.get('fields')
+    if not requested:
+        return list(default)
+    fields = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = sorted(set(fields) - set(allowed))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    return fields
+
+
+def _list_page(request, queryset):
+    """Slice ``queryset`` by ?page=&page_size=; returns the rows and paging info"""
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(MAX_LIST_PAGE_SIZE, max(1, int(request.GET.get('page_size', LIST_PAGE_SIZE))))
+    except ValueError:
+        raise ValueError('page and page_size must be integers')
+    count = queryset.count()
+    start = (page - 1) * page_size
+    rows = list(queryset[start:start + page_size])
+    return rows, {'count': count, 'page': page, 'page_size': page_size, 'has_next': start + page_size < count}
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def translate_text(request):
     """API endpoint for full text translation"""
+    # Same per-client limits as the stream endpoints; the lease is held for the call
+    key = request_key(request)
+    admission = admission_controller.admit(key)
+    if not admission.allowed:
+        return rejected_response(admission)
+
     try:
         data = json.loads(request.body)
-        text = data.get('text', '')
+        text = translation_text(data)
 
         templates = get_active_templates()
         if 'translation' not in templates:
             return JsonResponse({'error': 'No active translation template found'}, status=400)
 
         template = templates['translation']
+        admission = admission_controller.charge(key, admission, get_index(text).approx_tokens())
+        if not admission.allowed:
+            return rejected_response(admission)
         service = create_openai_service(template)
 
         result = service.get_translation_sync(template, text)
@@ -56,24 +124,36 @@ def translate_text(request):
             'status': 'success'
         })
 
+    except StreamRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+    finally:
+        admission_controller.release(admission.lease_id)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def analyze_word(request):
     """API endpoint for word/phrase analysis"""
+    # Same per-client limits as the stream endpoints; the lease is held for the call
+    key = request_key(request)
+    admission = admission_controller.admit(key)
+    if not admission.allowed:
+        return rejected_response(admission)
+
     try:
         data = json.loads(request.body)
-        all_text = data.get('all_text', '')
-        selected_text = data.get('selected_text', '')
+        all_text, selected_text = analysis_texts(data)
 
         templates = get_active_templates()
         if 'word_analysis' not in templates:
             return JsonResponse({'error': 'No active word analysis template found'}, status=400)
 
         template = templates['word_analysis']
+        admission = admission_controller.charge(key, admission, get_index(all_text).approx_tokens())
+        if not admission.allowed:
+            return rejected_response(admission)
         service = create_openai_service(template)
 
         result = service.get_word_analysis_sync(template, all_text, selected_text)
@@ -83,8 +163,12 @@ def analyze_word(request):
             'status': 'success'
         })
 
+    except StreamRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+    finally:
+        admission_controller.release(admission.lease_id)
 
 
 @csrf_exempt
@@ -92,63 +176,43 @@ def stream_translation(request):
     """Streaming API endpoint for translation"""
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
+    if streams.draining:
+        return draining_response()
+
+    # Rate and open-stream limits before any work; prompt tokens once counted
+    key = request_key(request)
+    admission = admission_controller.admit(key)
+    if not admission.allowed:
+        return rejected_response(admission)
 
     try:
         data = json.loads(request.body)
-        text = data.get('text', '')
-
-        if not text.strip():
-            return JsonResponse({'error': 'No text provided'}, status=400)
-
-        templates = get_active_templates()
-        if 'translation' not in templates:
-            return JsonResponse({'error': 'No active translation template found. Please configure API settings first.'},
-                                status=400)
-
-        template = templates['translation']
-
-        # Note: API key check is now handled in the service layer to allow demo mode
-        service = create_openai_service(template)
+        text = translation_text(data)
+        prepared = prepare_translation(text, hint=data)
+        admission = admission_controller.charge(key, admission, prepared.prompt_tokens)
+        if not admission.allowed:
+            return rejected_response(admission)
 
         def generate_stream():
-            try:
-                chunk_count = 0
-                for chunk in service.stream_translation_sync(template, text):
-                    chunk_count += 1
-                    
-                    # Debug log
-                    print(f"Django view received chunk: {repr(chunk)}")
-                    
-                    # Check if this is thinking content
-                    if chunk.startswith('__THINKING__:'):
-                        thinking_text = chunk[13:]  # Remove __THINKING__: prefix
-                        print(f"Django view sending thinking: {thinking_text}")
-                        yield f"data: {json.dumps({'content': thinking_text, 'type': 'thinking'})}\n\n"
-                    elif chunk == '__THINKING_DONE__':
-                        print("Django view sending thinking done")
-                        yield f"data: {json.dumps({'type': 'thinking_done'})}\n\n"
-                    else:
-                        yield f"data: {json.dumps({'content': chunk, 'type': 'content'})}\n\n"
-
-                if chunk_count == 0:
-                    yield f"data: {json.dumps({'content': 'No response received from API. Check your API key and model settings.', 'type': 'error'})}\n\n"
-
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            except Exception as e:
-                yield f"data: {json.dumps({'content': f'Stream error: {str(e)}', 'type': 'error'})}\n\n"
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-
-        response = StreamingHttpResponse(
-            generate_stream(),
-            content_type='text/event-stream'
-        )
-        response['Cache-Control'] = 'no-cache'
+            for event in iter_events(prepared.chunks()):
+                yield sse_frame(event)
+
+        # The translation is about as long as the text, so long ones may be compressed
+        response = sse_response(request, generate_stream(), expected_bytes=len(text))
+        response.on_close(partial(admission_controller.release, admission.lease_id))
         response['Access-Control-Allow-Origin'] = '*'
         response['Access-Control-Allow-Headers'] = 'Content-Type'
+        response['Access-Control-Expose-Headers'] = 'X-Prompt-Tokens, X-Prompt-Strategy'
+        response['X-Prompt-Tokens'] = str(prepared.meta['prompt_tokens'])
+        response['X-Prompt-Strategy'] = prepared.meta['strategy']
 
         return response
 
+    except StreamRequestError as e:
+        admission_controller.release(admission.lease_id)
+        return JsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
+        admission_controller.release(admission.lease_id)
         return JsonResponse({'error': str(e)}, status=500)
 
 
@@ -157,82 +221,120 @@ def stream_word_analysis(request):
     """Streaming API endpoint for word analysis"""
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
+    if streams.draining:
+        return draining_response()
+
+    # Rate and open-stream limits before any work; prompt tokens once counted
+    key = request_key(request)
+    admission = admission_controller.admit(key)
+    if not admission.allowed:
+        return rejected_response(admission)
 
     try:
         data = json.loads(request.body)
-        all_text = data.get('all_text', '')
-        selected_text = data.get('selected_text', '')
-
-        if not all_text.strip() or not selected_text.strip():
-            return JsonResponse({'error': 'No text or selection provided'}, status=400)
-
-        templates = get_active_templates()
-        analysis_config = AnalysisConfiguration.get_current()
-        selected_words = len(selected_text.split())
-        
-        # 使用配置的阈值判断是句子还是词汇/短语
-        if selected_words > analysis_config.word_group_threshold:
-            # 句子分析
-            if 'sentence_analysis' not in templates:
-                return JsonResponse(
-                    {'error': 'No active sentence analysis template found. Please configure API settings first.'}, status=400)
-            template = templates['sentence_analysis']
-        else:
-            # 单词/短语分析 
-            if 'word_analysis' not in templates:
-                return JsonResponse(
-                    {'error': 'No active word analysis template found. Please configure API settings first.'}, status=400)
-            template = templates['word_analysis']
-
-        # Note: API key check is now handled in the service layer to allow demo mode
-        service = create_openai_service(template)
+        prepared = prepare_analysis(*analysis_texts(data))
+        admission = admission_controller.charge(key, admission, prepared.prompt_tokens)
+        if not admission.allowed:
+            return rejected_response(admission)
 
         def generate_stream():
-            try:
-                chunk_count = 0
-                for chunk in service.stream_word_analysis_sync(template, all_text, selected_text, selected_words > analysis_config.word_group_threshold):
-                    chunk_count += 1
-                    
-                    # Debug log
-                    # print(f"Django analysis view received chunk: {repr(chunk)}")
-                    
-                    # Check if this is thinking content
-                    if chunk.startswith('__THINKING__:'):
-                        thinking_text = chunk[13:]  # Remove __THINKING__: prefix
-                        # print(f"Django analysis view sending thinking: {thinking_text}")
-                        yield f"data: {json.dumps({'content': thinking_text, 'type': 'thinking'})}\n\n"
-                    elif chunk == '__THINKING_DONE__':
-                        print("Django analysis view sending thinking done")
-                        yield f"data: {json.dumps({'type': 'thinking_done'})}\n\n"
-                    else:
-                        yield f"data: {json.dumps({'content': chunk, 'type': 'content'})}\n\n"
-
-                if chunk_count == 0:
-                    yield f"data: {json.dumps({'content': 'No response received from API. Check your API key and model settings.', 'type': 'error'})}\n\n"
-
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            except Exception as e:
-                yield f"data: {json.dumps({'content': f'Stream error: {str(e)}', 'type': 'error'})}\n\n"
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-
-        response = StreamingHttpResponse(
-            generate_stream(),
-            content_type='text/event-stream'
-        )
-        response['Cache-Control'] = 'no-cache'
+            for event in iter_events(prepared.chunks()):
+                yield sse_frame(event)
+
+        response = sse_response(request, generate_stream())
+        response.on_close(partial(admission_controller.release, admission.lease_id))
         response['Access-Control-Allow-Origin'] = '*'
         response['Access-Control-Allow-Headers'] = 'Content-Type'
+        response['Access-Control-Expose-Headers'] = (
+            'X-Analysis-Type, X-Config-Version, X-Prompt-Tokens, X-Prompt-Strategy')
+        response['X-Analysis-Type'] = prepared.meta['analysis_type']
+        response['X-Config-Version'] = prepared.meta['config_version']
+        response['X-Prompt-Tokens'] = str(prepared.meta['prompt_tokens'])
+        response['X-Prompt-Strategy'] = prepared.meta['strategy']
 
         return response
 
+    except StreamRequestError as e:
+        admission_controller.release(admission.lease_id)
+        return JsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
+        admission_controller.release(admission.lease_id)
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@never_cache
+@require_http_methods(["GET"])
+def config_version(request):
+    """Current configuration version; browser-side analysis caches are only valid for it"""
+    return JsonResponse({'version': get_snapshot().version})
+
+
+def ops_endpoint(view):
+    """
+    Restrict an operational endpoint to DEBUG, or to requests sending
+    X-Ops-Token matching OPS_TOKEN when one is configured
+    """
+    @wraps(view)
+    def guarded(request, *args, **kwargs):
+        token = getattr(settings, 'OPS_TOKEN', '')
+        if not token:
+            if not settings.DEBUG:
+                raise Http404('Operational endpoints are disabled')
+        else:
+            offered = request.headers.get('X-Ops-Token', '')
+            if not (offered and hmac.compare_digest(token.encode(), offered.encode())):
+                return JsonResponse({'error': 'Missing or wrong X-Ops-Token'}, status=403)
+        return view(request, *args, **kwargs)
+    return guarded
+
+
+@require_http_methods(["GET"])
+@ops_endpoint
+def usage_summary(request):
+    """Usage ledger rollup: ?group=hour|template|model&hours=24"""
+    group = request.GET.get('group', 'hour')
+    try:
+        hours = float(request.GET.get('hours', 24))
+        rows = rollup(group, hours)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'group': group, 'hours': hours, 'rows': rows})
+
+
+@require_http_methods(["GET"])
+@ops_endpoint
+def scheduler_stats(request):
+    """Upstream dispatcher queue depth, running calls and wait times per priority class"""
+    return JsonResponse(dispatcher.snapshot())
+
+
+@require_http_methods(["GET"])
+def viewport_stats(request):
+    """Time until the paragraphs in view were translated, for viewport-ordered translations"""
+    return JsonResponse(viewport.stats.snapshot())
+
+
+@require_http_methods(["GET"])
+def semantic_cache_stats(request):
+    """Semantic cache size, hit rate, lookup latency and hit similarity"""
+    return JsonResponse(semantic_cache.cache.snapshot())
+
+
+@require_http_methods(["GET"])
+@ops_endpoint
+def admission_stats(request):
+    """Admission limits, clients with open streams and rejection counts (all workers)"""
+    return JsonResponse(admission_controller.snapshot())
+
+
 @method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(config_conditional, name='get')
 class APIConfigurationView(View):
     """CRUD operations for API configurations"""
 
+    LIST_FIELDS = ('id', 'name', 'base_url', 'model_name', 'created_at', 'updated_at')
+    DEFAULT_LIST_FIELDS = ('id', 'name', 'base_url', 'model_name')
+
     def get(self, request, config_id=None):
         if config_id:
             config = get_object_or_404(APIConfiguration, id=config_id)
@@ -244,8 +346,12 @@ class APIConfigurationView(View):
                 'has_api_key': bool(config.api_key and config.api_key.strip()),
             })
         else:
-            configs = APIConfiguration.objects.all().values('id', 'name', 'base_url', 'model_name')
-            return JsonResponse({'configs': list(configs)})
+            try:
+                fields = _list_fields(request, self.LIST_FIELDS, self.DEFAULT_LIST_FIELDS)
+                configs, page = _list_page(request, APIConfiguration.objects.order_by('id').values(*fields))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            return JsonResponse({'configs': configs, **page})
 
     def post(self, request):
         try:
@@ -297,12 +403,18 @@ class APIConfigurationView(View):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(config_conditional, name='get')
 class PromptTemplateView(View):
     """CRUD operations for prompt templates"""
 
+    LIST_FIELDS = ('id', 'name', 'template_type', 'prompt_text', 'api_config_id', 'api_config__name',
+                   'reasoning_effort', 'output_format', 'is_active', 'created_at', 'updated_at')
+    # prompt_text can be large; list it only when asked for with ?fields=
+    DEFAULT_LIST_FIELDS = ('id', 'name', 'template_type', 'api_config__name', 'reasoning_effort', 'is_active')
+
     def get(self, request, template_id=None):
         if template_id:
-            template = get_object_or_404(PromptTemplate, id=template_id)
+            template = get_object_or_404(PromptTemplate.objects.select_related('api_config'), id=template_id)
             return JsonResponse({
                 'id': template.id,
                 'name': template.name,
@@ -310,14 +422,20 @@ class PromptTemplateView(View):
                 'prompt_text': template.prompt_text,
                 'api_config_id': template.api_config.id,
                 'reasoning_effort': template.reasoning_effort,
+                'output_format': template.output_format,
                 'is_active': template.is_active,
             })
         else:
-            templates = PromptTemplate.objects.all().values(
-                'id', 'name', 'template_type', 'prompt_text',
-                'api_config__name', 'reasoning_effort', 'is_active'
-            )
-            return JsonResponse({'templates': list(templates)})
+            try:
+                fields = _list_fields(request, self.LIST_FIELDS, self.DEFAULT_LIST_FIELDS)
+                queryset = PromptTemplate.objects.order_by('id')
+                template_type = request.GET.get('template_type')
+                if template_type:
+                    queryset = queryset.filter(template_type=template_type)
+                templates, page = _list_page(request, queryset.values(*fields))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            return JsonResponse({'templates': templates, **page})
 
     def post(self, request):
         try:
@@ -336,6 +454,14 @@ class PromptTemplateView(View):
             if data['template_type'] not in valid_types:
                 return JsonResponse({'error': f'Invalid template_type. Must be one of: {valid_types}'}, status=400)
 
+            valid_formats = [choice[0] for choice in PromptTemplate._meta.get_field('output_format').choices]
+            if data.get('output_format', 'markdown') not in valid_formats:
+                return JsonResponse({'error': f'Invalid output_format. Must be one of: {valid_formats}'}, status=400)
+
+            problems = validate_prompt(data['template_type'], data['prompt_text'])
+            if problems:
+                return JsonResponse({'error': '; '.join(problems)}, status=400)
+
             # Deactivate other templates of the same type if this is active
             if data.get('is_active', False):
                 PromptTemplate.objects.filter(
@@ -349,6 +475,7 @@ class PromptTemplateView(View):
                 prompt_text=data['prompt_text'],
                 api_config=api_config,
                 reasoning_effort=data.get('reasoning_effort', 'low'),
+                output_format=data.get('output_format', 'markdown'),
                 is_active=data.get('is_active', False)
             )
 
@@ -367,6 +494,11 @@ class PromptTemplateView(View):
             template = get_object_or_404(PromptTemplate, id=template_id)
             data = json.loads(request.body)
 
+            if 'prompt_text' in data:
+                problems = validate_prompt(template.template_type, data['prompt_text'])
+                if problems:
+                    return JsonResponse({'error': '; '.join(problems)}, status=400)
+
             # Deactivate other templates of the same type if this is being activated
             if data.get('is_active', False) and not template.is_active:
                 PromptTemplate.objects.filter(
@@ -377,6 +509,7 @@ class PromptTemplateView(View):
             template.name = data.get('name', template.name)
             template.prompt_text = data.get('prompt_text', template.prompt_text)
             template.reasoning_effort = data.get('reasoning_effort', template.reasoning_effort)
+            template.output_format = data.get('output_format', template.output_format)
             template.is_active = data.get('is_active', template.is_active)
 
             if 'api_config_id' in data:
@@ -404,6 +537,7 @@ class PromptTemplateView(View):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(config_conditional, name='get')
 class AnalysisConfigurationView(View):
     """CRUD operations for analysis configuration"""
 
@@ -430,3 +564,68 @@ class AnalysisConfigurationView(View):
             })
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
+
+
+def _document_json(document):
+    return {
+        'document': document.handle,
+        'name': document.name,
+        'format': document.format,
+        'size_bytes': document.size_bytes,
+        'char_count': document.char_count,
+        'paragraph_count': document.paragraph_count,
+        'created_at': document.created_at.isoformat(),
+    }
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class DocumentView(View):
+    """Upload, list and delete ingested documents"""
+
+    def get(self, request, handle=None):
+        if handle:
+            return JsonResponse(_document_json(get_object_or_404(Document, handle=handle)))
+        try:
+            rows, page = _list_page(request, Document.objects.order_by('-created_at'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'documents': [_document_json(document) for document in rows], **page})
+
+    def post(self, request):
+        try:
+            # Oversized uploads are refused before the body is read
+            documents.check_content_length(request.META.get('CONTENT_LENGTH'))
+            upload = request.FILES.get('file')
+            if upload is None:
+                return JsonResponse({'error': 'No file uploaded (multipart field "file")'}, status=400)
+            document = documents.ingest(upload)
+        except documents.IngestError as e:
+            return JsonResponse({'error': e.message}, status=e.status)
+        return JsonResponse(_document_json(document), status=201)
+
+    def delete(self, request, handle):
+        documents.delete(get_object_or_404(Document, handle=handle))
+        return JsonResponse({
+            'status': 'success',
+            'message': 'Document deleted successfully'
+        })
+
+
+@require_http_methods(["GET"])
+def document_paragraphs(request, handle):
+    """A range of a document's paragraphs: ?start=0&count=50"""
+    document = get_object_or_404(Document, handle=handle)
+    max_count = getattr(settings, 'DOCUMENT_MAX_PARAGRAPHS_PER_REQUEST', 200)
+    try:
+        start = max(0, int(request.GET.get('start', 0)))
+        count = min(max_count, max(1, int(request.GET.get('count', LIST_PAGE_SIZE))))
+    except ValueError:
+        return JsonResponse({'error': 'start and count must be integers'}, status=400)
+    paragraphs = documents.read_paragraphs(document, start, count)
+    return JsonResponse({
+        'document': document.handle,
+        'start': start,
+        'paragraphs': paragraphs,
+        'paragraph_count': document.paragraph_count,
+        'has_next': start + len(paragraphs) < document.paragraph_count,
+    })
@@ -0,0 +1,164 @@
+"""
+Worker warm-up.
+
+A fresh worker would otherwise pay on its first request for the config
+snapshot, URL resolver, lazy ``openai`` import, client construction, DNS and
+the TLS handshake to each ``base_url``. ``LifespanApp`` runs ``warm_up`` on
+the ASGI ``lifespan.startup`` event, and uvicorn only starts accepting
+connections on the worker once it completes. ``/readyz`` reports the
+warm-up and stays unavailable while it is running.
+
+Steps: ``database``, ``config``, ``urls``, ``imports`` (openai SDK and the
+tokenizers of the active models), then ``connect:<config>`` per API
+configuration in use: the shared client is built and ``GET /models/<model>``
+opens its pooled connection and checks the model exists. With
+``WARMUP_PROBE_RESPONSES`` a one-token responses-API call also tells whether
+the endpoint supports it (it is billed, hence off by default); endpoints
+without it are sent straight to chat completions. Failures are logged and
+reported but never block startup.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.urls import get_resolver
+
+from .config_snapshot import get_snapshot
+from .latency import is_reasoning_model
+from .openai_service import (close_shared_clients, has_api_key, mark_responses_api_unsupported,
+                             shared_client)
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_state = {'status': 'not_run'}
+
+
+def state() -> dict:
+    """
+    ``not_run`` (no lifespan, e.g. runserver), ``running``, ``done`` with the
+    report, or ``failed`` if the warm-up itself raised
+    """
+    with _lock:
+        return dict(_state)
+
+
+class _Report:
+    def __init__(self):
+        self.steps = {}
+        self.errors = {}
+        self.capabilities = {}
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+            logger.warning('warm-up step %s failed: %s', name, e)
+        finally:
+            self.steps[name] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _probe(config, models, report: _Report):
+    timeout = getattr(settings, 'WARMUP_PROBE_TIMEOUT', 5.0)
+    client = shared_client(config).with_options(timeout=timeout, max_retries=0)
+    for model in models:
+        # Cheap authenticated GET: resolves DNS, opens the pooled TLS connection
+        client.models.retrieve(model)
+        capabilities = {'model': True}
+        if is_reasoning_model(model) and getattr(settings, 'WARMUP_PROBE_RESPONSES', False):
+            try:
+                client.responses.create(model=model, input='ping', max_output_tokens=16,
+                                        reasoning={'effort': 'minimal'}, store=False)
+                capabilities['responses_api'] = True
+            except Exception as e:
+                if getattr(e, 'status_code', None) not in (404, 405):
+                    raise
+                mark_responses_api_unsupported(config, model)
+                capabilities['responses_api'] = False
+        report.capabilities[f'{config.name}/{model}'] = capabilities
+
+
+def warm_up() -> dict:
+    """Prime this worker's caches and upstream connections; returns the report"""
+    with _lock:
+        _state.clear()
+        _state['status'] = 'running'
+    started = time.perf_counter()
+    report = _Report()
+
+    with report.step('database'):
+        connection.ensure_connection()
+    snapshot = None
+    with report.step('config'):
+        snapshot = get_snapshot()
+    with report.step('urls'):
+        get_resolver().resolve('/api/stream-translate/')
+
+    templates = list(snapshot.templates.values()) if snapshot is not None else []
+    with report.step('imports'):
+        import openai  # noqa: F401  (lazy in the request path)
+        for template in templates:
+            count_tokens('warm-up', template.api_config.model_name)
+
+    configs = {}
+    for template in templates:
+        if has_api_key(template.api_config):
+            config, models = configs.setdefault(template.api_config.id, (template.api_config, set()))
+            models.add(template.api_config.model_name)
+            fallback = getattr(settings, 'LATENCY_FALLBACK_MODELS', {}).get(template.api_config.model_name)
+            if fallback:
+                models.add(fallback)
+    for config, models in configs.values():
+        with report.step(f'connect:{config.name}'):
+            _probe(config, sorted(models), report)
+
+    # Requests open their own connections; don't keep this thread's around
+    connection.close()
+    result = {
+        'status': 'done',
+        'ms': round((time.perf_counter() - started) * 1000, 2),
+        'steps': report.steps,
+        'errors': report.errors,
+        'capabilities': report.capabilities,
+    }
+    with _lock:
+        _state.clear()
+        _state.update(result)
+    logger.info('warm-up complete', extra={key: value for key, value in result.items() if key != 'status'})
+    return result
+
+
+class LifespanApp:
+    """ASGI lifespan handling: warm the worker up before it accepts requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.app(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if getattr(settings, 'WARMUP_ENABLED', True):
+                    try:
+                        await sync_to_async(warm_up, thread_sensitive=False)()
+                    except Exception as e:
+                        # Best effort: a bug in the warm-up must not keep the worker down
+                        logger.exception('warm-up failed')
+                        with _lock:
+                            _state.clear()
+                            _state.update(status='failed', error=str(e))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await sync_to_async(close_shared_clients, thread_sensitive=False)()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
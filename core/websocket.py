@@ -0,0 +1,245 @@
+"""
+WebSocket transport for the translation/analysis streams.
+
+One connection per page carries any number of concurrent streams, each
+tagged by a client-chosen ``id``. Client messages::
+
+    {"type": "translate", "id": "t1", "text": "..."}
+    {"type": "analyze", "id": "a7", "all_text": "...", "selected_text": "..."}
+    {"type": "cancel", "id": "a7"}
+    {"type": "translate", "id": "t2", "document": "<handle>", "start": 0, "count": 20}
+    {"type": "translate", "id": "t3", "text": "...", "order": "viewport", "visible": [4, 9]}
+    {"type": "viewport", "id": "t3", "visible": [12, 18]}
+    {"type": "ping"}
+
+Server messages are the same events the SSE endpoints send, plus the
+request ``id``: ``meta`` (prompt tokens and strategy, analysis type), ``thinking``, ``thinking_done``,
+``content``, ``error`` and a final ``done`` (``cancelled`` after a cancel).
+Viewport-ordered translations (``core.viewport``) add paragraph-tagged
+events and take ``viewport`` messages as the reader scrolls.
+Requests go through the same ``core.pipeline`` functions as the SSE views.
+"""
+import asyncio
+import json
+import logging
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http.cookie import parse_cookie
+from django.utils.http import is_same_domain
+
+from .admission import REJECTION_MESSAGES, client_key, controller as admission_controller
+from .pipeline import (StreamRequestError, analysis_texts, iter_events, prepare_analysis, prepare_translation,
+                       translation_text)
+from .streaming import DRAIN_RETRY_AFTER_SECONDS, aiter_chunks, streams, tracked
+from .viewport import visible_range
+
+WEBSOCKET_PATH = '/ws/stream/'
+# Close codes: policy violation / try again later
+CLOSE_NOT_ALLOWED = 1008
+CLOSE_TRY_AGAIN = 1013
+
+logger = logging.getLogger(__name__)
+
+
+def _prepare(kind: str, message: dict):
+    if kind == 'translate':
+        return prepare_translation(translation_text(message), hint=message)
+    return prepare_analysis(*analysis_texts(message))
+
+
+class StreamConnection:
+    """State for one accepted socket: its send lock and running streams"""
+
+    def __init__(self, send, key: str):
+        self._send = send
+        self.key = key
+        self._lock = asyncio.Lock()
+        self.tasks = {}
+        self.schedules = {}  # request id -> ParagraphSchedule of a viewport-ordered translation
+        self.max_streams = getattr(settings, 'WEBSOCKET_MAX_STREAMS', 8)
+
+    async def send(self, payload: dict):
+        async with self._lock:
+            await self._send({'type': 'websocket.send', 'text': json.dumps(payload)})
+
+    async def handle(self, text: str):
+        try:
+            message = json.loads(text)
+            kind = message['type']
+        except (ValueError, TypeError, KeyError):
+            await self.send({'type': 'error', 'content': 'Invalid message'})
+            return
+
+        request_id = message.get('id')
+        if request_id is not None and (not isinstance(request_id, (str, int)) or isinstance(request_id, bool)):
+            # Ids key the task and schedule dicts: lists and objects are not hashable
+            await self.send({'id': request_id, 'type': 'error', 'content': 'Request id must be a string or integer'})
+            return
+        if kind == 'ping':
+            await self.send({'type': 'pong', 'id': request_id})
+        elif kind == 'cancel':
+            task = self.tasks.get(request_id)
+            if task is not None:
+                task.cancel()
+        elif kind == 'viewport':
+            schedule = self.schedules.get(request_id)
+            visible = visible_range(message, schedule.count) if schedule is not None else None
+            if visible is not None:
+                schedule.reprioritize(*visible)
+        elif kind in ('translate', 'analyze'):
+            await self.start(kind, request_id, message)
+        else:
+            await self.send({'id': request_id, 'type': 'error', 'content': f'Unknown message type: {kind}'})
+
+    async def start(self, kind: str, request_id, message: dict):
+        if request_id is None or request_id in self.tasks:
+            await self.send({'id': request_id, 'type': 'error', 'content': 'Missing or duplicate request id'})
+            return
+        if streams.draining:
+            await self.send({'id': request_id, 'type': 'error', 'status': 503,
+                             'retry_after': DRAIN_RETRY_AFTER_SECONDS,
+                             'content': 'Server is restarting, please retry shortly.'})
+            await self.send({'id': request_id, 'type': 'done'})
+            return
+        if len(self.tasks) >= self.max_streams:
+            await self.send({'id': request_id, 'type': 'error', 'status': 429,
+                             'content': f'Too many concurrent streams (max {self.max_streams})'})
+            await self.send({'id': request_id, 'type': 'done'})
+            return
+
+        task = asyncio.create_task(self.run(kind, request_id, message))
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+
+    async def run(self, kind: str, request_id, message: dict):
+        admission = None
+        try:
+            # Rate and open-stream limits before any work; prompt tokens once counted
+            admission = await sync_to_async(admission_controller.admit, thread_sensitive=False)(self.key)
+            if not admission.allowed:
+                await self.reject(request_id, admission)
+                return
+            try:
+                prepared = await sync_to_async(_prepare)(kind, message)
+            except StreamRequestError as e:
+                await self.send({'id': request_id, 'type': 'error', 'status': e.status, 'content': e.message})
+                await self.send({'id': request_id, 'type': 'done'})
+                return
+            except Exception as e:
+                await self.send({'id': request_id, 'type': 'error', 'status': 500, 'content': str(e)})
+                await self.send({'id': request_id, 'type': 'done'})
+                return
+
+            admission = await sync_to_async(admission_controller.charge, thread_sensitive=False)(
+                self.key, admission, prepared.prompt_tokens)
+            if not admission.allowed:
+                await self.reject(request_id, admission)
+                return
+
+            if prepared.meta:
+                await self.send({'id': request_id, 'type': 'meta', **prepared.meta})
+            if prepared.schedule is not None:
+                self.schedules[request_id] = prepared.schedule
+            async for event in aiter_chunks(tracked(iter_events(prepared.chunks()))):
+                await self.send({'id': request_id, **event})
+        except asyncio.CancelledError:
+            try:
+                await self.send({'id': request_id, 'type': 'cancelled'})
+            except Exception:
+                pass  # socket already gone
+            raise
+        except OSError:
+            pass  # client disconnected mid-stream
+        finally:
+            schedule = self.schedules.pop(request_id, None)
+            if schedule is not None:
+                schedule.stop()  # the stream may still be parked in a worker thread
+            if admission is not None:
+                # Also when cancelled before the first chunk was pulled
+                await sync_to_async(admission_controller.release, thread_sensitive=False)(admission.lease_id)
+
+    async def reject(self, request_id, admission):
+        await self.send({'id': request_id, 'type': 'error', 'status': 429, 'reason': admission.reason,
+                         'retry_after': admission.retry_after, 'content': REJECTION_MESSAGES[admission.reason]})
+        await self.send({'id': request_id, 'type': 'done'})
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def origin_allowed(headers: dict) -> bool:
+    """
+    Whether a handshake's ``Origin`` may open a connection. WebSockets are
+    not covered by CSRF protection, so without this check any site could
+    open streams with the visitor's cookies. Same-origin pages, origins in
+    ``CSRF_TRUSTED_ORIGINS`` and hosts matching ``ALLOWED_HOSTS`` (other than
+    ``'*'``) are allowed; clients that send no ``Origin`` are not browsers.
+    """
+    origin = headers.get('origin')
+    if origin is None:
+        return True
+    parts = urlsplit(origin)
+    host = headers.get('host')
+    if settings.USE_X_FORWARDED_HOST and headers.get('x-forwarded-host'):
+        host = headers['x-forwarded-host'].split(',')[0].strip()
+    if parts.netloc and parts.netloc == host:
+        return True
+    for trusted in settings.CSRF_TRUSTED_ORIGINS:
+        trusted_parts = urlsplit(trusted)
+        if origin == trusted or (trusted_parts.scheme == parts.scheme
+                                 and is_same_domain(parts.netloc, trusted_parts.netloc.lstrip('*'))):
+            return True
+    return any(pattern != '*' and is_same_domain(parts.hostname or '', pattern)
+               for pattern in settings.ALLOWED_HOSTS)
+
+
+class WebSocketApp:
+    """ASGI wrapper that answers ``WEBSOCKET_PATH`` and passes HTTP through"""
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = getattr(settings, 'WEBSOCKET_ENABLED', True)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            await self.app(scope, receive, send)
+            return
+
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if not self.enabled or scope['path'] != WEBSOCKET_PATH:
+            await send({'type': 'websocket.close', 'code': CLOSE_NOT_ALLOWED})
+            return
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in scope.get('headers', [])}
+        if not origin_allowed(headers):
+            logger.warning('WebSocket handshake from disallowed origin %s', headers.get('origin'))
+            await send({'type': 'websocket.close', 'code': CLOSE_NOT_ALLOWED})
+            return
+        if streams.draining:
+            await send({'type': 'websocket.close', 'code': CLOSE_TRY_AGAIN})
+            return
+        await send({'type': 'websocket.accept'})
+
+        address = scope['client'][0] if scope.get('client') else None
+        key = await sync_to_async(client_key)(parse_cookie(headers.get('cookie', '')), address,
+                                              headers.get('x-forwarded-for'))
+        connection = StreamConnection(send, key)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message['type'] == 'websocket.receive':
+                    text = message.get('text')
+                    if text is None and message.get('bytes') is not None:
+                        text = message['bytes'].decode('utf-8', 'replace')
+                    await connection.handle(text or '')
+        finally:
+            await connection.close()
@@ -17,6 +17,7 @@ uv sync
 echo "Running database migrations..."
 uv run python manage.py migrate
 
-echo "Starting Django development server..."
+echo "Starting ContextLens server..."
 echo "Access the application at: http://0.0.0.0:8000"
-uv run python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
+# Use `uv run python manage.py runserver` instead for auto-reload during development
+exec uv run python manage.py serve --host 0.0.0.0 --port 8000
\ No newline at end of file
@@ -1,4 +1,377 @@
 // ContextLens Main JavaScript
+
+// One WebSocket per page multiplexing every translation/analysis stream by request id
+class StreamSocket {
+    constructor(url) {
+        this.url = url;
+        this.ws = null;
+        this.ready = null;
+        this.handlers = new Map();
+        this.nextId = 1;
+    }
+
+    connect() {
+        if (this.ready) return this.ready;
+        this.ready = new Promise((resolve, reject) => {
+            const ws = new WebSocket(this.url);
+            ws.onopen = () => {
+                this.ws = ws;
+                resolve(ws);
+            };
+            ws.onmessage = (event) => {
+                let data;
+                try {
+                    data = JSON.parse(event.data);
+                } catch (e) {
+                    console.warn('Failed to parse socket message:', e);
+                    return;
+                }
+                const handler = this.handlers.get(data.id);
+                if (!handler) return;
+                if (data.type === 'done' || data.type === 'cancelled') {
+                    this.handlers.delete(data.id);
+                }
+                handler.onEvent(data);
+            };
+            ws.onclose = () => {
+                const wasOpen = this.ws === ws;
+                this.ws = null;
+                this.ready = null; // reconnect on the next request
+                const pending = [...this.handlers.values()];
+                this.handlers.clear();
+                pending.forEach((handler) => handler.onClose());
+                if (!wasOpen) reject(new Error('WebSocket connection failed'));
+            };
+        });
+        return this.ready;
+    }
+
+    async request(type, payload, onEvent, onClose) {
+        const ws = await this.connect();
+        const id = `${type}-${this.nextId++}`;
+        this.handlers.set(id, {onEvent, onClose});
+        ws.send(JSON.stringify({type, id, ...payload}));
+        return {
+            id,
+            cancel: () => {
+                if (this.handlers.has(id) && this.ws) {
+                    this.ws.send(JSON.stringify({type: 'cancel', id}));
+                }
+            },
+            // Follow-up message for the running stream (e.g. a viewport update)
+            send: (messageType, message) => {
+                if (this.handlers.has(id) && this.ws) {
+                    this.ws.send(JSON.stringify({type: messageType, id, ...message}));
+                }
+            }
+        };
+    }
+}
+
+// Incremental markdown renderer for streamed output: completed blocks are parsed
+// once and frozen, only the trailing open block is re-rendered, once per frame
+class StreamingMarkdown {
+    static parse(markdown) {
+        if (!StreamingMarkdown.configured) {
+            // Configure marked with normal spacing for better readability
+            const renderer = new marked.Renderer();
+
+            // Override paragraph rendering with normal margins
+            renderer.paragraph = function (text) {
+                return '<p style="margin-bottom:1em;line-height:1.5;">' + text + '</p>';
+            };
+
+            // Override list rendering with normal spacing
+            renderer.list = function (body, ordered, start) {
+                const type = ordered ? 'ol' : 'ul';
+                const startatt = (ordered && start !== 1) ? (' start="' + start + '"') : '';
+                return '<' + type + startatt + ' style="margin-bottom:1em;padding-left:2em;">' + body + '</' + type + '>';
+            };
+
+            renderer.listitem = function (text) {
+                return '<li style="margin-bottom:0.5em;line-height:1.5;">' + text + '</li>';
+            };
+
+            // Override heading rendering with normal spacing
+            renderer.heading = function (text, level, raw) {
+                const marginTop = level <= 2 ? '1.5em' : '1em';
+                const marginBottom = '0.5em';
+                return '<h' + level + ' style="margin-top:' + marginTop + ';margin-bottom:' + marginBottom + ';line-height:1.3;font-weight:bold;">' + text + '</h' + level + '>';
+            };
+
+            // Configure marked options
+            marked.setOptions({
+                renderer: renderer,
+                breaks: false,
+                gfm: true
+            });
+            StreamingMarkdown.configured = true;
+        }
+        return marked.parse(markdown);
+    }
+
+    constructor(element) {
+        this.element = element;
+        this.source = '';
+        this.frozenLength = 0; // source[0:frozenLength] is rendered into this.frozen for good
+        this.frozen = document.createElement('div');
+        this.tail = document.createElement('div');
+        this.frame = null;
+        this.stats = {frames: 0, renderMs: 0, parsedChars: 0};
+        element.innerHTML = '';
+        element.append(this.frozen, this.tail);
+    }
+
+    append(text) {
+        this.source += text;
+        if (this.frame === null) {
+            this.frame = requestAnimationFrame(() => this.render());
+        }
+    }
+
+    // Render everything that is left (end of stream)
+    flush() {
+        this.cancel();
+        this.render(true);
+    }
+
+    cancel() {
+        if (this.frame !== null) {
+            cancelAnimationFrame(this.frame);
+            this.frame = null;
+        }
+    }
+
+    render(final = false) {
+        this.frame = null;
+        const started = performance.now();
+        if (!window.marked) {
+            this.tail.textContent = this.source;
+        } else {
+            const boundary = final ? this.source.length : this.findBoundary();
+            if (boundary > this.frozenLength) {
+                const block = this.source.slice(this.frozenLength, boundary);
+                this.frozen.insertAdjacentHTML('beforeend', StreamingMarkdown.parse(block));
+                this.stats.parsedChars += block.length;
+                this.frozenLength = boundary;
+            }
+            const open = this.source.slice(this.frozenLength);
+            this.tail.innerHTML = open ? StreamingMarkdown.parse(open) : '';
+            this.stats.parsedChars += open.length;
+        }
+        this.stats.frames++;
+        this.stats.renderMs += performance.now() - started;
+        // Auto-scroll to bottom
+        this.element.scrollTop = this.element.scrollHeight;
+    }
+
+    // Offset where the last complete block ends: a blank line outside a code
+    // fence followed by a new unindented line (indented lines may continue a list item)
+    findBoundary() {
+        const lines = this.source.slice(this.frozenLength).split('\n');
+        let boundary = 0;
+        let offset = 0;
+        let inFence = false;
+        let sawBlank = false;
+        // The last line may still be incomplete
+        for (let i = 0; i < lines.length - 1; i++) {
+            const line = lines[i];
+            const blank = line.trim() === '';
+            if (!inFence && !blank && sawBlank && !/^[ \t]/.test(line)) {
+                boundary = offset;
+            }
+            if (/^ {0,3}(```|~~~)/.test(line)) {
+                inFence = !inFence;
+            }
+            sawBlank = !inFence && blank;
+            offset += line.length + 1;
+        }
+        return this.frozenLength + boundary;
+    }
+}
+
+// Persistent analysis cache in IndexedDB. Entries are keyed by document hash and
+// normalized selection, valid only for the server config version they were made
+// with, and evicted least-recently-used first beyond a size quota.
+class AnalysisCache {
+    constructor({quotaBytes = 5 * 1024 * 1024, maxEntries = 500, revalidateMs = 60 * 1000} = {}) {
+        this.quotaBytes = quotaBytes;
+        this.maxEntries = maxEntries;
+        this.revalidateMs = revalidateMs;
+        this.version = null;
+        this.checkedAt = 0;
+        this.lastDocument = null; // [text, hash] of the last hashed document
+        this.db = this.open();
+        this.ready = this.revalidate();
+    }
+
+    open() {
+        return new Promise((resolve) => {
+            if (!window.indexedDB) return resolve(null);
+            const request = indexedDB.open('contextlens', 1);
+            request.onupgradeneeded = () => {
+                const store = request.result.createObjectStore('analyses', {keyPath: 'key'});
+                store.createIndex('lastUsed', 'lastUsed');
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => resolve(null);
+        });
+    }
+
+    // Cheap check of the server's config version (templates, thresholds)
+    async revalidate() {
+        try {
+            const response = await fetch('/api/config-version/');
+            if (response.ok) {
+                this.setVersion((await response.json()).version);
+            }
+        } catch (error) {
+            console.warn('Config version check failed:', error.message);
+        } finally {
+            this.checkedAt = Date.now();
+        }
+    }
+
+    setVersion(version) {
+        if (!version || version === this.version) return;
+        const changed = this.version !== null;
+        this.version = version;
+        if (changed) {
+            this.db.then((db) => db && this.evict(db));
+        }
+    }
+
+    static hashFallback(text) {
+        // cyrb53: used where crypto.subtle is unavailable (plain http on a LAN address)
+        let h1 = 0xdeadbeef, h2 = 0x41c6ce57;
+        for (let i = 0; i < text.length; i++) {
+            const ch = text.charCodeAt(i);
+            h1 = Math.imul(h1 ^ ch, 2654435761);
+            h2 = Math.imul(h2 ^ ch, 1597334677);
+        }
+        h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+        h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+        return (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(16) + '-' + text.length.toString(16);
+    }
+
+    async documentHash(text) {
+        if (this.lastDocument && this.lastDocument[0] === text) return this.lastDocument[1];
+        let hash;
+        if (window.crypto && crypto.subtle) {
+            const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+            hash = Array.from(new Uint8Array(digest).slice(0, 16), (b) => b.toString(16).padStart(2, '0')).join('');
+        } else {
+            hash = AnalysisCache.hashFallback(text);
+        }
+        this.lastDocument = [text, hash];
+        return hash;
+    }
+
+    async key(allText, selectedText) {
+        const selection = selectedText.normalize('NFC').replace(/\s+/g, ' ').trim();
+        return `${await this.documentHash(allText)}:${selection}`;
+    }
+
+    static request(db, mode, action) {
+        return new Promise((resolve) => {
+            const request = action(db.transaction('analyses', mode).objectStore('analyses'));
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => resolve(null);
+        });
+    }
+
+    async get(allText, selectedText) {
+        const db = await this.db;
+        if (!db) return null;
+        await this.ready;
+        if (Date.now() - this.checkedAt > this.revalidateMs) {
+            this.ready = this.revalidate(); // in the background; the next lookup waits for it
+        }
+
+        const key = await this.key(allText, selectedText);
+        const entry = await AnalysisCache.request(db, 'readonly', (store) => store.get(key));
+        if (!entry) return null;
+        if (entry.version !== this.version) {
+            AnalysisCache.request(db, 'readwrite', (store) => store.delete(key));
+            return null;
+        }
+        entry.lastUsed = Date.now();
+        AnalysisCache.request(db, 'readwrite', (store) => store.put(entry));
+        return entry;
+    }
+
+    async put(allText, selectedText, {markdown, analysisType, version}) {
+        const db = await this.db;
+        if (!db || !markdown) return;
+        this.setVersion(version);
+        const key = await this.key(allText, selectedText);
+        await AnalysisCache.request(db, 'readwrite', (store) => store.put({
+            key,
+            version: version || this.version,
+            markdown,
+            analysisType,
+            size: (key.length + markdown.length) * 2,
+            lastUsed: Date.now()
+        }));
+        await this.evict(db);
+    }
+
+    // Drop entries of other config versions, then the least recently used over quota
+    evict(db) {
+        return new Promise((resolve) => {
+            const entries = [];
+            const store = db.transaction('analyses', 'readwrite').objectStore('analyses');
+            const cursorRequest = store.index('lastUsed').openCursor();
+            cursorRequest.onsuccess = () => {
+                const cursor = cursorRequest.result;
+                if (cursor) {
+                    if (cursor.value.version !== this.version) {
+                        cursor.delete();
+                    } else {
+                        entries.push([cursor.primaryKey, cursor.value.size]);
+                    }
+                    cursor.continue();
+                    return;
+                }
+                let total = entries.reduce((sum, [, size]) => sum + size, 0);
+                let count = entries.length;
+                for (const [key, size] of entries) { // oldest first
+                    if (total <= this.quotaBytes && count <= this.maxEntries) break;
+                    store.delete(key);
+                    total -= size;
+                    count--;
+                }
+                resolve();
+            };
+            cursorRequest.onerror = () => resolve();
+        });
+    }
+}
+
+// Markdown for each field of a structured word analysis, in the order the
+// server sends them (dictionary fields first, then the contextual ones)
+const ANALYSIS_FIELD_MARKDOWN = {
+    headword: (value) => `**${value}**`,
+    ipa: (value) => (value ? ` /${value}/` : '') + '\n\n',
+    senses: (value) => value.map((sense) => `- *${sense.pos}* ${sense.meaning}`).join('\n') + '\n\n',
+    sentence: (value) => `> ${value}\n>\n`,
+    sentence_translation: (value) => `> ${value}\n\n`,
+    contextual_meaning: (value) => `**语境含义**：${value}\n`
+};
+
+// Paragraphs of an uploaded document loaded into the input at a time
+const DOCUMENT_WINDOW_PARAGRAPHS = 50;
+
+// Texts with at least this many paragraphs are translated in viewport order:
+// the paragraphs the reader is looking at first, re-ordered as they scroll
+const VIEWPORT_ORDER_MIN_PARAGRAPHS = 6;
+const VIEWPORT_UPDATE_DELAY_MS = 150;
+
+// Same rule as core.viewport.split_paragraphs: blank lines separate paragraphs
+function splitParagraphs(text) {
+    return text.split(/\n\s*\n/).map((part) => part.trim()).filter(Boolean);
+}
+
 class ContextLens {
     constructor() {
         this.init();
@@ -62,6 +435,8 @@ class ContextLens {
         this.analysisThinking = document.getElementById('analysisThinking');
         this.translateBtn = document.getElementById('translateBtn');
         this.clearBtn = document.getElementById('clearBtn');
+        this.openFileBtn = document.getElementById('openFileBtn');
+        this.fileInput = document.getElementById('fileInput');
 
         // Collapsible sections
         this.translationHeader = document.getElementById('translationHeader');
@@ -79,23 +454,33 @@ class ContextLens {
         this.isTranslating = false;
         this.isAnalyzing = false;
         this.selectionTimeout = null; // For delayed text selection processing
-        this.analysisBuffer = ''; // Buffer for streaming markdown content
-        this.analysisConfig = null; // Cache for analysis configuration
+        this.activeAnalysis = null; // Stream state of the analysis in progress
+        this.analysisCache = new AnalysisCache();
+        this.openDocument = null; // Uploaded document whose paragraph window is in the input
+
+        // Shared stream socket when the server offers one (ASGI), else per-request HTTP streams
+        const socketMeta = document.querySelector('meta[name="stream-socket"]');
+        this.streamSocket = socketMeta && window.WebSocket
+            ? new StreamSocket(`${location.protocol === 'https:' ? 'wss:' : 'ws:'}//${location.host}${socketMeta.content}`)
+            : null;
 
         // Initialize collapsed states from localStorage
         this.loadCollapsedStates();
         
         // Load persisted input text
         this.loadInputText();
-        
-        // Load analysis configuration
-        this.loadAnalysisConfig();
     }
 
     bindEvents() {
         // Button events
         this.translateBtn.addEventListener('click', () => this.translateText());
         this.clearBtn.addEventListener('click', () => this.clearAll());
+        this.openFileBtn.addEventListener('click', () => this.fileInput.click());
+        this.fileInput.addEventListener('change', () => {
+            const file = this.fileInput.files[0];
+            this.fileInput.value = '';
+            if (file) this.uploadDocument(file);
+        });
 
         // Text selection events
         this.inputText.addEventListener('mouseup', (e) => this.handleTextSelection(e));
@@ -151,6 +536,46 @@ class ContextLens {
         }, 300); // 300ms delay to allow for double-click completion
     }
 
+    async uploadDocument(file) {
+        const form = new FormData();
+        form.append('file', file);
+        this.openFileBtn.disabled = true;
+        this.openFileBtn.textContent = 'Uploading...';
+        try {
+            // Multipart body: let the browser set the Content-Type boundary
+            const response = await fetch('/api/documents/', {
+                method: 'POST',
+                body: form,
+                headers: {'X-CSRFToken': ContextLens.getCookie('csrftoken')}
+            });
+            const info = await response.json().catch(() => ({}));
+            if (!response.ok) {
+                throw new Error(info.error || `HTTP error! status: ${response.status}`);
+            }
+
+            const page = await ContextLens.apiRequest(
+                `/api/documents/${info.document}/paragraphs/?start=0&count=${DOCUMENT_WINDOW_PARAGRAPHS}`);
+            const text = page.paragraphs.join('\n\n');
+            this.inputText.value = text;
+            this.openDocument = {handle: info.document, start: 0, count: page.paragraphs.length, text};
+            this.saveInputText();
+            this.showToast(`Loaded ${info.name}: ${page.paragraphs.length} of ${info.paragraph_count} paragraphs`, 'success');
+        } catch (error) {
+            console.error('Upload error:', error);
+            this.showToast(error.message, 'error');
+        } finally {
+            this.openFileBtn.disabled = false;
+            this.openFileBtn.textContent = 'Open File';
+        }
+    }
+
+    // Reference the stored paragraphs instead of resending them while the input is unedited
+    documentPayload() {
+        const doc = this.openDocument;
+        if (!doc || this.inputText.value !== doc.text) return null;
+        return {document: doc.handle, start: doc.start, count: doc.count};
+    }
+
     async translateText() {
         const text = this.inputText.value.trim();
         if (!text) {
@@ -167,28 +592,27 @@ class ContextLens {
         this.translationOutput.style.color = ''; // Reset color
         this.translationLoading.classList.remove('hidden');
 
+        const state = this.createStreamState(this.translationOutput, false);
+        let payload = this.documentPayload() || {text};
+        const paragraphs = splitParagraphs(text);
+        if (paragraphs.length >= VIEWPORT_ORDER_MIN_PARAGRAPHS) {
+            this.startViewportOrder(state, paragraphs);
+            state.visible = this.visibleParagraphs(state);
+            payload = {...payload, order: 'viewport', visible: state.visible};
+        }
         try {
-            const response = await fetch('/api/stream-translate/', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-Requested-With': 'XMLHttpRequest'
-                },
-                body: JSON.stringify({text})
+            await this.runStream('translate', payload, state, (meta) => {
+                if (meta.strategy === 'chunked') {
+                    this.showToast(`Long text (~${meta.prompt_tokens} tokens): translating in parts`, 'info');
+                }
             });
-
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
-            }
-
-            await this.handleStreamResponse(response, this.translationOutput);
         } catch (error) {
             console.error('Translation error:', error);
             this.translationOutput.textContent = `Error: ${error.message}`;
             this.translationOutput.style.color = 'var(--error-color)';
             this.showToast(error.message, 'error');
         } finally {
+            this.finishStream(state);
             this.isTranslating = false;
             this.translateBtn.disabled = false;
             this.translateBtn.textContent = 'Translate';
@@ -196,166 +620,317 @@ class ContextLens {
         }
     }
 
+    // One slot per paragraph showing the source until its translation arrives;
+    // scrolling either pane tells the server which paragraphs to do next
+    startViewportOrder(state, paragraphs) {
+        state.outputElement.textContent = '';
+        state.paragraphSource = paragraphs;
+        state.paragraphs = paragraphs.map((paragraph) => {
+            const slot = document.createElement('div');
+            slot.className = 'translation-paragraph pending';
+            slot.textContent = paragraph;
+            state.outputElement.appendChild(slot);
+            return slot;
+        });
+        state.translatedParagraphs = 0;
+
+        const outputPane = state.outputElement.closest('.output-container') || state.outputElement;
+        state.visibleFrom = this.inputText;
+        let timer = null;
+        const onScroll = (event) => {
+            state.visibleFrom = event.target;
+            clearTimeout(timer);
+            timer = setTimeout(() => this.sendViewport(state), VIEWPORT_UPDATE_DELAY_MS);
+        };
+        this.inputText.addEventListener('scroll', onScroll);
+        outputPane.addEventListener('scroll', onScroll);
+        state.stopViewport = () => {
+            clearTimeout(timer);
+            this.inputText.removeEventListener('scroll', onScroll);
+            outputPane.removeEventListener('scroll', onScroll);
+        };
+    }
+
+    // [first, last] paragraph indexes in view, from whichever pane was scrolled last
+    visibleParagraphs(state) {
+        if (state.visibleFrom !== this.inputText) {
+            const view = state.visibleFrom.getBoundingClientRect();
+            const inView = [];
+            state.paragraphs.forEach((slot, index) => {
+                const rect = slot.getBoundingClientRect();
+                if (rect.height && rect.bottom > view.top && rect.top < view.bottom) inView.push(index);
+            });
+            if (inView.length) return [inView[0], inView[inView.length - 1]];
+        }
+
+        // The textarea has no per-line geometry: map its scrolled fraction onto
+        // each paragraph's share of the text
+        const input = this.inputText;
+        if (!input.scrollHeight) return [0, 0];
+        const top = input.scrollTop / input.scrollHeight;
+        const bottom = (input.scrollTop + input.clientHeight) / input.scrollHeight;
+        const total = state.paragraphSource.reduce((sum, paragraph) => sum + paragraph.length, 0);
+        let offset = 0;
+        let first = null;
+        let last = 0;
+        state.paragraphSource.forEach((paragraph, index) => {
+            const start = offset / total;
+            offset += paragraph.length;
+            if (offset / total > top && start < bottom) {
+                if (first === null) first = index;
+                last = index;
+            }
+        });
+        return first === null ? [0, 0] : [first, last];
+    }
+
+    sendViewport(state) {
+        // Only the WebSocket can re-prioritize a running translation
+        if (!state.send || state.cancelled) return;
+        const visible = this.visibleParagraphs(state);
+        if (state.visible && visible[0] === state.visible[0] && visible[1] === state.visible[1]) return;
+        state.visible = visible;
+        state.send('viewport', {visible});
+    }
+
+    // Viewport-ordered translation: place each event in its paragraph's slot
+    handleParagraphEvent(state, data) {
+        const slot = state.paragraphs[data.paragraph];
+        if (data.type === 'content' && slot && data.content) {
+            if (slot.classList.contains('pending')) {
+                slot.classList.remove('pending');
+                slot.textContent = '';
+            }
+            slot.textContent += data.content;
+        } else if (data.type === 'paragraph_done') {
+            state.translatedParagraphs += 1;
+            state.thinkingElement.textContent =
+                `Translated ${state.translatedParagraphs} of ${state.paragraphs.length} paragraphs`;
+        } else if (data.type === 'truncated') {
+            state.truncated = true;
+            if (slot) slot.classList.add('truncated');
+            this.showToast(`Paragraph ${data.paragraph + 1} was cut off at the model's output limit`, 'warning');
+        } else if (data.type === 'visible_done') {
+            console.debug(`Paragraphs ${data.first}-${data.last} in view translated in ${data.ms} ms ` +
+                `(${data.trigger})`);
+        } else if (data.type === 'error' && data.content) {
+            state.failed = true;
+            if (slot) {
+                slot.classList.remove('pending');
+                slot.classList.add('failed');
+                slot.textContent = data.content;
+            }
+            this.showToast(data.content, 'error');
+        }
+        return false;
+    }
+
     async analyzeSelection(selectedText) {
         const allText = this.inputText.value.trim();
-        if (!allText || this.isAnalyzing) return;
+        if (!allText) return;
 
-        // Ensure we have analysis config loaded
-        if (!this.analysisConfig) {
-            await this.loadAnalysisConfig();
+        // A newer selection supersedes the analysis that is still streaming
+        if (this.activeAnalysis) {
+            this.cancelStream(this.activeAnalysis);
         }
 
-        // 使用配置的阈值判断是单词/短语还是句子
-        const wordCount = selectedText.split(/\s+/).filter(word => word.length > 0).length;
-        const isWord = wordCount <= this.analysisConfig.word_group_threshold;
-        const analysisType = isWord ? '词汇分析' : '句子分析';
-        
-        // 更新分析标题
         const analysisTitle = document.querySelector('#analysisHeader h3');
-        if (analysisTitle) {
-            analysisTitle.textContent = `Word Analysis (${analysisType})`;
-        }
+        const state = this.createStreamState(this.analysisOutput, true);
+        this.activeAnalysis = state;
 
         this.isAnalyzing = true;
-        this.analysisOutput.innerHTML = ''; // Use innerHTML for markdown
         this.analysisOutput.style.color = ''; // Reset color
-        this.analysisBuffer = ''; // Reset buffer
         this.analysisLoading.classList.remove('hidden');
 
+        // 词汇/句子的判断由服务端基于分词索引完成（支持中日文），这里只更新标题
+        const showAnalysisType = (type) => {
+            const analysisType = type === 'sentence_analysis' ? '句子分析' : '词汇分析';
+            if (analysisTitle) {
+                analysisTitle.textContent = `Word Analysis (${analysisType})`;
+            }
+        };
+
         try {
-            const response = await fetch('/api/stream-analyze/', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-Requested-With': 'XMLHttpRequest'
-                },
-                body: JSON.stringify({
-                    all_text: allText,
-                    selected_text: selectedText
-                })
+            // Repeat lookups are served from the browser cache without a request
+            const cached = await this.analysisCache.get(allText, selectedText);
+            if (state.cancelled) return;
+            if (cached) {
+                showAnalysisType(cached.analysisType);
+                state.markdown.append(cached.markdown);
+                state.markdown.flush();
+                return;
+            }
+
+            let meta = {};
+            const context = this.documentPayload() || {all_text: allText};
+            await this.runStream('analyze', {
+                ...context,
+                selected_text: selectedText
+            }, state, (streamMeta) => {
+                meta = streamMeta;
+                showAnalysisType(meta.analysis_type);
             });
 
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+            // Upstream failures arrive as an "Error: ..." body; never cache those,
+            // nor analyses cut off at the output limit
+            const source = state.markdown.source;
+            if (!state.cancelled && !state.failed && !state.truncated && source && !source.startsWith('Error:')) {
+                this.analysisCache.put(allText, selectedText, {
+                    markdown: source,
+                    analysisType: meta.analysis_type,
+                    version: meta.config_version
+                });
             }
-
-            await this.handleStreamResponse(response, this.analysisOutput, true); // true for markdown
         } catch (error) {
-            console.error('Analysis error:', error);
-            this.analysisOutput.textContent = `Error: ${error.message}`;
-            this.analysisOutput.style.color = 'var(--error-color)';
-            this.showToast(error.message, 'error');
+            if (!state.cancelled) {
+                console.error('Analysis error:', error);
+                this.analysisOutput.textContent = `Error: ${error.message}`;
+                this.analysisOutput.style.color = 'var(--error-color)';
+                this.showToast(error.message, 'error');
+            }
         } finally {
-            this.isAnalyzing = false;
-            this.analysisLoading.classList.add('hidden');
-            
-            // 恢复原始标题
-            if (analysisTitle) {
-                analysisTitle.textContent = 'Word Analysis';
+            if (this.activeAnalysis === state) {
+                this.finishStream(state);
+                this.activeAnalysis = null;
+                this.isAnalyzing = false;
+                this.analysisLoading.classList.add('hidden');
+
+                // 恢复原始标题
+                if (analysisTitle) {
+                    analysisTitle.textContent = 'Word Analysis';
+                }
+            }
+        }
+    }
+
+    createStreamState(outputElement, isMarkdown) {
+        return {
+            outputElement,
+            isMarkdown,
+            // Get the appropriate thinking element
+            thinkingElement: isMarkdown ? this.analysisThinking : this.translationThinking,
+            hasStartedContent: false, // Track if we've started receiving content
+            markdown: isMarkdown ? new StreamingMarkdown(outputElement) : null,
+            received: false,
+            failed: false,
+            truncated: false, // Cut off at the output limit: shown, but never cached
+            cancelled: false,
+            cancel: null
+        };
+    }
+
+    cancelStream(state) {
+        state.cancelled = true;
+        if (state.markdown) {
+            state.markdown.cancel();
+        }
+        if (state.cancel) {
+            state.cancel();
+        }
+    }
+
+    finishStream(state) {
+        if (state.stopViewport) {
+            state.stopViewport();
+        }
+        // Reset thinking text
+        state.thinkingElement.textContent = state.isMarkdown ? 'Analyzing...' : 'Translating...';
+    }
+
+    async runStream(kind, payload, state, onMeta = null) {
+        // Prefer the shared WebSocket; fall back to one HTTP stream per request
+        if (this.streamSocket) {
+            try {
+                await this.streamOverSocket(kind, payload, state, onMeta);
+                return;
+            } catch (error) {
+                if (!error.retryOverHttp || state.cancelled) throw error;
+                if (error.disableSocket) {
+                    this.streamSocket = null;
+                }
+                console.warn('WebSocket stream unavailable, using HTTP streaming:', error.message);
             }
         }
+
+        const controller = new AbortController();
+        state.cancel = () => controller.abort();
+        const response = await fetch(kind === 'translate' ? '/api/stream-translate/' : '/api/stream-analyze/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest'
+            },
+            body: JSON.stringify(payload),
+            signal: controller.signal
+        });
+
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+        }
+
+        if (onMeta) {
+            onMeta({
+                analysis_type: response.headers.get('X-Analysis-Type'),
+                config_version: response.headers.get('X-Config-Version'),
+                prompt_tokens: Number(response.headers.get('X-Prompt-Tokens')),
+                strategy: response.headers.get('X-Prompt-Strategy')
+            });
+        }
+        await this.handleStreamResponse(response, state);
+    }
+
+    streamOverSocket(kind, payload, state, onMeta) {
+        return new Promise((resolve, reject) => {
+            const onEvent = (data) => {
+                if (data.type === 'meta') {
+                    if (onMeta) onMeta(data);
+                } else if (data.type === 'cancelled') {
+                    resolve();
+                } else {
+                    state.received = true;
+                    if (this.handleStreamEvent(state, data)) resolve();
+                }
+            };
+            const onClose = () => {
+                const error = new Error('Connection lost');
+                // Nothing shown yet: safe to replay the request over HTTP
+                error.retryOverHttp = !state.received;
+                reject(error);
+            };
+            this.streamSocket.request(kind, payload, onEvent, onClose)
+                .then((handle) => {
+                    state.cancel = handle.cancel;
+                    state.send = handle.send;
+                    if (state.cancelled) handle.cancel();
+                })
+                .catch((error) => {
+                    error.retryOverHttp = true;
+                    error.disableSocket = true;
+                    reject(error);
+                });
+        });
     }
 
-    async handleStreamResponse(response, outputElement, isMarkdown = false) {
+    async handleStreamResponse(response, state) {
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
-        
-        // Get the appropriate thinking element
-        const thinkingElement = isMarkdown ? this.analysisThinking : this.translationThinking;
-        let hasStartedContent = false; // Track if we've started receiving content
+        let pending = ''; // partial line carried over between reads
 
         try {
             while (true) {
                 const {done, value} = await reader.read();
                 if (done) break;
 
-                const chunk = decoder.decode(value, {stream: true});
-                const lines = chunk.split('\n');
+                pending += decoder.decode(value, {stream: true});
+                const lines = pending.split('\n');
+                pending = lines.pop();
 
                 for (const line of lines) {
                     if (line.startsWith('data: ')) {
                         try {
                             const data = JSON.parse(line.slice(6));
-                            console.log('Received data:', data); // Debug log
-                            
-                            if (data.type === 'thinking' && data.content) {
-                                console.log('Processing thinking content:', data.content); // Debug log
-                                // Display thinking content, accumulate the text
-                                const currentText = thinkingElement.textContent || '';
-                                thinkingElement.textContent = currentText + data.content;
-                            } else if (data.type === 'thinking_done') {
-                                console.log('Thinking done, starting new thinking section'); // Debug log
-                                // Clear thinking content for next section
-                                thinkingElement.textContent = '';
-                            } else if (data.type === 'content' && data.content) {
-                                // Clear thinking content when we start receiving actual content
-                                if (!hasStartedContent) {
-                                    thinkingElement.textContent = isMarkdown ? 'Analyzing...' : 'Translating...';
-                                    hasStartedContent = true;
-                                }
-                                
-                                if (isMarkdown) {
-                                    // For analysis output, accumulate content and render as markdown
-                                    this.analysisBuffer += data.content;
-                                    // Parse and render markdown with custom renderer
-                                    if (window.marked) {
-                                        // Configure marked with normal spacing for better readability
-                                        const renderer = new marked.Renderer();
-
-                                        // Override paragraph rendering with normal margins
-                                        renderer.paragraph = function (text) {
-                                            return '<p style="margin-bottom:1em;line-height:1.5;">' + text + '</p>';
-                                        };
-
-                                        // Override list rendering with normal spacing
-                                        renderer.list = function (body, ordered, start) {
-                                            const type = ordered ? 'ol' : 'ul';
-                                            const startatt = (ordered && start !== 1) ? (' start="' + start + '"') : '';
-                                            return '<' + type + ' style="margin-bottom:1em;padding-left:2em;">' + body + '</' + type + '>';
-                                        };
-
-                                        renderer.listitem = function (text) {
-                                            return '<li style="margin-bottom:0.5em;line-height:1.5;">' + text + '</li>';
-                                        };
-
-                                        // Override heading rendering with normal spacing
-                                        renderer.heading = function (text, level, raw) {
-                                            const marginTop = level <= 2 ? '1.5em' : '1em';
-                                            const marginBottom = '0.5em';
-                                            return '<h' + level + ' style="margin-top:' + marginTop + ';margin-bottom:' + marginBottom + ';line-height:1.3;font-weight:bold;">' + text + '</h' + level + '>';
-                                        };
-
-                                        // Configure marked options
-                                        marked.setOptions({
-                                            renderer: renderer,
-                                            breaks: false,
-                                            gfm: true
-                                        });
-
-                                        outputElement.innerHTML = marked.parse(this.analysisBuffer);
-                                    } else {
-                                        outputElement.textContent = this.analysisBuffer;
-                                    }
-                                } else {
-                                    // For translation output, append directly as text
-                                    outputElement.textContent += data.content;
-                                }
-                                // Auto-scroll to bottom
-                                outputElement.scrollTop = outputElement.scrollHeight;
-                            } else if (data.type === 'error' && data.content) {
-                                if (isMarkdown) {
-                                    outputElement.innerHTML = `<p style="color: var(--error-color);">${data.content}</p>`;
-                                } else {
-                                    outputElement.textContent += data.content;
-                                    outputElement.style.color = 'var(--error-color)';
-                                }
-                                this.showToast(data.content, 'error');
-                            } else if (data.type === 'done') {
-                                // Reset thinking text when done
-                                thinkingElement.textContent = isMarkdown ? 'Analyzing...' : 'Translating...';
-                                return;
-                            }
+                            if (this.handleStreamEvent(state, data)) return;
                         } catch (e) {
                             console.warn('Failed to parse streaming data:', e);
                         }
@@ -363,28 +938,94 @@ class ContextLens {
                 }
             }
         } catch (error) {
+            if (state.cancelled) return;
             const errorMsg = `Connection error: ${error.message}`;
-            if (isMarkdown) {
-                outputElement.innerHTML = `<p style="color: var(--error-color);">${errorMsg}</p>`;
+            if (state.isMarkdown) {
+                state.outputElement.innerHTML = `<p style="color: var(--error-color);">${errorMsg}</p>`;
             } else {
-                outputElement.textContent += `\n\n${errorMsg}`;
-                outputElement.style.color = 'var(--error-color)';
+                state.outputElement.textContent += `\n\n${errorMsg}`;
+                state.outputElement.style.color = 'var(--error-color)';
             }
             this.showToast('Connection failed. Please check your network and try again.', 'error');
         } finally {
             reader.releaseLock();
-            // Reset thinking text
+        }
+    }
+
+    // Apply one stream event (shared by the SSE and WebSocket transports); true once done
+    handleStreamEvent(state, data) {
+        if (state.cancelled) return true;
+        if (state.paragraphs && (data.paragraph !== undefined || data.type === 'visible_done')) {
+            return this.handleParagraphEvent(state, data);
+        }
+        const {outputElement, isMarkdown, thinkingElement} = state;
+
+        if (data.type === 'thinking' && data.content) {
+            // Display thinking content, accumulate the text
+            thinkingElement.textContent += data.content;
+        } else if (data.type === 'thinking_done') {
+            // Clear thinking content for next section
+            thinkingElement.textContent = '';
+        } else if (data.type === 'content' && data.content) {
+            // Clear thinking content when we start receiving actual content
+            if (!state.hasStartedContent) {
+                thinkingElement.textContent = isMarkdown ? 'Analyzing...' : 'Translating...';
+                state.hasStartedContent = true;
+            }
+
+            if (isMarkdown) {
+                // For analysis output, render markdown incrementally (batched per frame)
+                state.markdown.append(data.content);
+            } else {
+                // For translation output, append directly as text
+                outputElement.textContent += data.content;
+                // Auto-scroll to bottom
+                outputElement.scrollTop = outputElement.scrollHeight;
+            }
+        } else if (data.type === 'field' && isMarkdown) {
+            // Structured analysis: each completed field is rendered as its own markdown block
+            const render = ANALYSIS_FIELD_MARKDOWN[data.name];
+            if (render) {
+                if (!state.hasStartedContent) {
+                    thinkingElement.textContent = 'Analyzing...';
+                    state.hasStartedContent = true;
+                }
+                state.markdown.append(render(data.value));
+            }
+        } else if (data.type === 'truncated') {
+            state.truncated = true;
+            if (data.content) this.showToast(data.content, 'warning');
+        } else if (data.type === 'error' && data.content) {
+            state.failed = true;
+            if (isMarkdown) {
+                state.markdown.cancel();
+                outputElement.innerHTML = `<p style="color: var(--error-color);">${data.content}</p>`;
+            } else {
+                outputElement.textContent += data.content;
+                outputElement.style.color = 'var(--error-color)';
+            }
+            this.showToast(data.content, 'error');
+        } else if (data.type === 'done') {
+            if (isMarkdown && state.markdown.source) {
+                state.markdown.flush();
+                const {frames, renderMs, parsedChars} = state.markdown.stats;
+                console.debug(`Analysis render: ${state.markdown.source.length} chars, ${frames} frames, ` +
+                    `${renderMs.toFixed(1)} ms, ${parsedChars} chars parsed`);
+            }
+            // Reset thinking text when done
             thinkingElement.textContent = isMarkdown ? 'Analyzing...' : 'Translating...';
+            return true;
         }
+        return false;
     }
 
     clearAll() {
         this.inputText.value = '';
+        this.openDocument = null;
         this.translationOutput.textContent = 'Translation will appear here...';
         this.translationOutput.style.color = ''; // Reset color
         this.analysisOutput.innerHTML = 'Select a word or phrase in the input text to see detailed analysis...';
         this.analysisOutput.style.color = ''; // Reset color
-        this.analysisBuffer = ''; // Reset buffer
         this.currentSelection = '';
         
         // Reset thinking content
@@ -519,27 +1160,6 @@ class ContextLens {
     clearInputText() {
         localStorage.removeItem('contextlens_input_text');
     }
-
-    async loadAnalysisConfig() {
-        try {
-            const response = await fetch('/api/analysis-config/');
-            if (response.ok) {
-                this.analysisConfig = await response.json();
-            } else {
-                console.warn('Failed to load analysis configuration, using defaults');
-                this.analysisConfig = {
-                    word_group_threshold: 4,
-                    sentence_threshold: 20
-                };
-            }
-        } catch (error) {
-            console.error('Error loading analysis configuration:', error);
-            this.analysisConfig = {
-                word_group_threshold: 4,
-                sentence_threshold: 20
-            };
-        }
-    }
 }
 
 // Initialize the application when DOM is loaded
@@ -273,6 +273,7 @@ class SettingsManager {
             document.getElementById('templateType').value = data.template_type;
             document.getElementById('apiConfigSelect').value = data.api_config_id;
             document.getElementById('reasoningEffort').value = data.reasoning_effort;
+            document.getElementById('outputFormat').value = data.output_format;
             document.getElementById('isActive').checked = data.is_active;
             document.getElementById('promptText').value = data.prompt_text;
 